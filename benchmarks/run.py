@@ -0,0 +1,495 @@
+"""
+Benchmarks for writing, reading and converting results and for
+rendering screenshots.
+
+Every case runs in a fresh process against fsspec's memory:// or
+file:// protocol, so no network access is needed and the peak RSS of
+one case is not inflated by the cases before it. The results are
+written to a JSON file that can be compared with the results of
+another version:
+
+    python -m benchmarks.run --output new.json
+    python -m benchmarks.run --compare old.json new.json
+
+The encode and decode cases time an output's serializer on its own.
+Run them with --json-backend orjson or --binary-arrays and compare the
+results with a default run to see the effect on bokeh outputs.
+
+The pack case builds a category zip file from PACK_PARTS outputs of
+the payload without uploading it. Run it with --pack-workers 1 2 4 8 to
+see how packing scales with the number of threads and cores, and add
+--pack-processes to pack on processes instead of threads.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+try:
+    import resource
+except ImportError:
+    # Peak RSS is not reported on Windows.
+    resource = None
+
+import cs_storage
+
+MB = 2 ** 20
+
+# Payload name -> (media type, size in bytes at scale 1.0). The sizes
+# range from a small Markdown file up to large videos and HDF5 files.
+PAYLOADS = {
+    "markdown-small": ("Markdown", 2 ** 10),
+    "csv-medium": ("CSV", 4 * MB),
+    "bokeh-large": ("bokeh", 16 * MB),
+    "png-medium": ("PNG", 2 * MB),
+    "mp4-large": ("MP4", 64 * MB),
+    "hdf5-large": ("HDF5", 64 * MB),
+}
+
+OPERATIONS = [
+    "write",
+    "write-stream",
+    "write-dedupe",
+    "read",
+    "read-selected",
+    "serialize_to_json",
+    "deserialize_from_json",
+    "encode",
+    "decode",
+    "pack",
+    "screenshot",
+]
+
+PROTOCOLS = ["memory", "file"]
+
+# Operations that do not touch storage only run once, not per protocol.
+LOCAL_OPERATIONS = {
+    "serialize_to_json",
+    "deserialize_from_json",
+    "encode",
+    "decode",
+    "pack",
+    "screenshot",
+}
+
+# Number of outputs the payload is split into for the pack case.
+PACK_PARTS = 8
+
+# Only renderable outputs that can be shown on the screenshot template.
+SCREENSHOT_MEDIA_TYPES = {"Markdown", "bokeh", "PNG"}
+
+
+def make_data(media_type, size, seed=0):
+    """
+    Generate synthetic output data of about size bytes in its local
+    format. The data is pseudo random, so binary data does not compress
+    and text data compresses about as well as real model output.
+    """
+    rng = random.Random(seed)
+    if media_type == "Markdown":
+        words = ["model", "result", "**tax**", "revenue", "| 1.5 |", "\n"]
+        text = []
+        while sum(map(len, text)) < size:
+            text.append(rng.choice(words) + " ")
+        return "".join(text)
+    if media_type == "CSV":
+        row = ",".join(["{:.6f}"] * 8) + "\n"
+        rows = []
+        nbytes = 0
+        while nbytes < size:
+            rows.append(row.format(*(rng.random() for _ in range(8))))
+            nbytes += len(rows[-1])
+        return "".join(rows)
+    if media_type == "bokeh":
+        n = size // 40
+        return {
+            "target_id": None,
+            "root_id": "1001",
+            "doc": {
+                "roots": {
+                    "references": [
+                        {
+                            "type": "ColumnDataSource",
+                            "id": "1002",
+                            "attributes": {
+                                "data": {
+                                    "x": [rng.random() for _ in range(n)],
+                                    "y": [rng.random() for _ in range(n)],
+                                }
+                            },
+                        }
+                    ]
+                }
+            },
+        }
+    return rng.getrandbits(size * 8).to_bytes(size, "little")
+
+
+def make_result(payload, scale, parts=1):
+    """
+    Build a result with the payload and a small text output. If parts
+    is more than 1, the payload is split into that many outputs with
+    different data.
+    """
+    media_type, size = PAYLOADS[payload]
+    size = max(int(size * scale) // parts, 1)
+    category = "renderable" if media_type in SCREENSHOT_MEDIA_TYPES else "downloadable"
+    result = {"renderable": [], "downloadable": []}
+    for part in range(parts):
+        result[category].append(
+            {
+                "media_type": media_type,
+                "title": payload if parts == 1 else f"{payload}-{part}",
+                "data": make_data(media_type, size, seed=part),
+            }
+        )
+    # A small second output, so that selective reads have something to
+    # skip.
+    result["downloadable"].append(
+        {"media_type": "Text", "title": "notes", "data": "benchmark notes"}
+    )
+    return result
+
+
+def payload_bytes(loc_result):
+    """
+    Size of the serialized outputs in loc_result.
+    """
+    return sum(
+        len(cs_storage.get_serializer(output["media_type"]).serialize(output["data"]))
+        for outputs in loc_result.values()
+        for output in outputs
+    )
+
+
+def _payload_output(loc_result):
+    return (loc_result["renderable"] + loc_result["downloadable"])[0]
+
+
+def _peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _operation(op, client, loc_result, pack_workers=1):
+    """
+    Return a function that runs op once. The remote result that reads
+    need is written before the function is returned, so it is not part
+    of the measurement.
+    """
+    if op == "write":
+        return lambda: client.write("bench", loc_result)
+    if op == "write-stream":
+        return lambda: client.write("bench", loc_result, stream=True)
+    if op == "write-dedupe":
+        return lambda: client.write("bench", loc_result, dedupe=True)
+    if op in ("read", "read-selected"):
+        rem_result = client.write("bench", loc_result)
+        outputs = None if op == "read" else ["notes"]
+        return lambda: client.read(rem_result, json_serializable=False, outputs=outputs)
+    if op == "serialize_to_json":
+        return lambda: cs_storage.serialize_to_json(loc_result)
+    if op == "deserialize_from_json":
+        json_result = cs_storage.serialize_to_json(loc_result)
+        return lambda: cs_storage.deserialize_from_json(json_result)
+    if op in ("encode", "decode"):
+        # The serializer of the payload's output on its own, e.g. the
+        # JSON encoding of a bokeh plot.
+        output = _payload_output(loc_result)
+        serializer = cs_storage.get_serializer(output["media_type"])
+        if op == "encode":
+            return lambda: serializer.serialize(output["data"])
+        data = serializer.serialize(output["data"])
+        return lambda: serializer.deserialize(data, json_serializable=False)
+    if op == "pack":
+        outputs = loc_result["renderable"] + loc_result["downloadable"]
+        executor = client._pack_executor(pack_workers)
+        return lambda: cs_storage._write_zip(
+            io.BytesIO(), outputs, workers=pack_workers, executor=executor
+        )
+    if op == "screenshot":
+        outputs = loc_result["renderable"]
+        return lambda: cs_storage.screenshot_many(outputs)
+    raise ValueError(f"Unknown operation: {op}")
+
+
+def run_case(
+    op,
+    payload,
+    protocol,
+    scale,
+    repeat,
+    json_settings=None,
+    pack_workers=1,
+    pack_processes=False,
+):
+    """
+    Run one benchmark case and return its record. This runs in a
+    child process. json_settings are passed to configure_json and
+    pack_workers is the number of threads, or processes if
+    pack_processes is True, that pack zip files.
+    """
+    cs_storage.configure_json(**(json_settings or {}))
+    loc_result = make_result(payload, scale, PACK_PARTS if op == "pack" else 1)
+    record = {
+        "operation": op,
+        "payload": payload,
+        "media_type": PAYLOADS[payload][0],
+        "protocol": protocol,
+        "pack_workers": pack_workers,
+        "payload_bytes": payload_bytes(loc_result),
+    }
+    if op == "screenshot" and not cs_storage.SCREENSHOT_ENABLED:
+        return dict(record, skipped=True)
+    # Writes warn about every result if screenshots are not enabled.
+    warnings.simplefilter("ignore", UserWarning)
+
+    directory = tempfile.mkdtemp() if protocol == "file" else None
+    metrics = cs_storage.RecordingSink()
+    client = cs_storage.StorageClient(
+        bucket=directory or "cs-storage-bench",
+        protocol=protocol or "memory",
+        metrics=metrics,
+        pack_workers=pack_workers,
+        pack_processes=pack_processes,
+    )
+    try:
+        func = _operation(op, client, loc_result, pack_workers)
+        if pack_processes and pack_workers > 1:
+            # Start the packing processes before the measurement.
+            func()
+        del metrics.timings[:]
+        times = []
+        tracemalloc.start()
+        for _ in range(repeat):
+            s = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - s)
+        _, peak_traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+        elif protocol is not None:
+            client.fs.rm("/cs-storage-bench", recursive=True)
+        client.close()
+        cs_storage.shutdown_pool()
+
+    moved = {}
+    for timing in metrics.timings:
+        if timing.phase in ("upload", "download") and timing.nbytes:
+            moved[timing.phase] = moved.get(timing.phase, 0) + timing.nbytes
+    if op in ("encode", "decode"):
+        # The stored size of the output before zip compression.
+        output = _payload_output(loc_result)
+        serializer = cs_storage.get_serializer(output["media_type"])
+        record["encoded_bytes"] = len(serializer.serialize(output["data"]))
+    return dict(
+        record,
+        skipped=False,
+        repeat=repeat,
+        wall_seconds=min(times),
+        wall_seconds_all=times,
+        peak_traced_bytes=peak_traced,
+        peak_rss_bytes=_peak_rss(),
+        bytes_uploaded=moved.get("upload", 0) // repeat,
+        bytes_downloaded=moved.get("download", 0) // repeat,
+    )
+
+
+def cases(operations, payloads, protocols, pack_workers=(1,)):
+    for op in operations:
+        for payload in payloads:
+            if (
+                op == "screenshot"
+                and PAYLOADS[payload][0] not in SCREENSHOT_MEDIA_TYPES
+            ):
+                continue
+            for protocol in [None] if op in LOCAL_OPERATIONS else protocols:
+                for workers in pack_workers:
+                    yield op, payload, protocol, workers
+
+
+def run(
+    operations,
+    payloads,
+    protocols,
+    scale=1.0,
+    repeat=3,
+    json_settings=None,
+    pack_workers=(1,),
+    pack_processes=False,
+):
+    context = get_context("spawn")
+    records = []
+    for op, payload, protocol, workers in cases(
+        operations, payloads, protocols, pack_workers
+    ):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            record = executor.submit(
+                run_case,
+                op,
+                payload,
+                protocol,
+                scale,
+                repeat,
+                json_settings,
+                workers,
+                pack_processes,
+            ).result()
+        records.append(record)
+        print(_format(record), file=sys.stderr)
+    return {
+        "cs_storage_version": cs_storage.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "scale": scale,
+        "json_settings": json_settings or {},
+        "pack_processes": pack_processes,
+        "results": records,
+    }
+
+
+def _key(record):
+    return (
+        record["operation"],
+        record["payload"],
+        record["protocol"],
+        record.get("pack_workers", 1),
+    )
+
+
+def _name(record):
+    operation, payload, protocol, workers = _key(record)
+    name = "/".join(part for part in (operation, payload, protocol) if part)
+    return name if workers == 1 else f"{name}/{workers} workers"
+
+
+def _format(record):
+    name = _name(record)
+    if record["skipped"]:
+        return f"{name:<45} skipped"
+    rss = record["peak_rss_bytes"]
+    return (
+        f"{name:<45} {record['wall_seconds'] * 1000:10.1f} ms "
+        f"{record['peak_traced_bytes'] / MB:8.1f} MB traced "
+        + (f"{rss / MB:8.1f} MB rss" if rss is not None else "")
+    )
+
+
+def compare(old, new):
+    """
+    Print the ratio of new to old wall time and peak memory for the
+    cases that are in both result files, and of the encoded size for
+    encode and decode cases.
+    """
+    old_records = {_key(record): record for record in old["results"]}
+    if old["scale"] != new["scale"]:
+        print(f"warning: the payloads were scaled by {old['scale']} and {new['scale']}")
+    print(
+        f"{old['cs_storage_version']} -> {new['cs_storage_version']}: "
+        "new / old wall time, traced memory, encoded size"
+    )
+    for record in new["results"]:
+        old_record = old_records.get(_key(record))
+        if old_record is None or record["skipped"] or old_record["skipped"]:
+            continue
+        name = _name(record)
+        time_ratio = record["wall_seconds"] / old_record["wall_seconds"]
+        memory_ratio = record["peak_traced_bytes"] / max(
+            old_record["peak_traced_bytes"], 1
+        )
+        line = f"{name:<45} {time_ratio:6.2f}x {memory_ratio:6.2f}x"
+        if "encoded_bytes" in record and "encoded_bytes" in old_record:
+            size_ratio = record["encoded_bytes"] / max(old_record["encoded_bytes"], 1)
+            line += f" {size_ratio:6.2f}x"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument(
+        "--operations", nargs="+", choices=OPERATIONS, default=OPERATIONS
+    )
+    parser.add_argument(
+        "--payloads", nargs="+", choices=list(PAYLOADS), default=list(PAYLOADS)
+    )
+    parser.add_argument("--protocols", nargs="+", choices=PROTOCOLS, default=PROTOCOLS)
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiply the payload sizes by this factor.",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--json-backend",
+        choices=["json", "orjson"],
+        default="json",
+        help="Library that encodes and decodes bokeh outputs.",
+    )
+    parser.add_argument(
+        "--binary-arrays",
+        action="store_true",
+        help="Store the numeric arrays of bokeh outputs as binary buffers.",
+    )
+    parser.add_argument(
+        "--pack-workers",
+        nargs="+",
+        type=int,
+        default=[1],
+        help="Run every case with each number of threads that pack zip files.",
+    )
+    parser.add_argument(
+        "--pack-processes",
+        action="store_true",
+        help="Pack zip files on processes instead of threads.",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("OLD", "NEW"),
+        help="Compare two result files instead of running the benchmarks.",
+    )
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        old, new = [json.load(open(path)) for path in args.compare]
+        compare(old, new)
+        return
+
+    json_settings = dict(backend=args.json_backend, binary_arrays=args.binary_arrays)
+    results = run(
+        args.operations,
+        args.payloads,
+        args.protocols,
+        args.scale,
+        args.repeat,
+        json_settings,
+        args.pack_workers,
+        args.pack_processes,
+    )
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {os.path.abspath(args.output)}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,95 @@
+import array
+import asyncio
 import base64
-import copy
+import binascii
+import codecs
+import hashlib
 import io
+import itertools
 import json
 import os
+import struct
+import sys
 import uuid
+import weakref
 import zipfile
+import zlib
+import threading
 import time
-from collections import namedtuple
+import multiprocessing
+from collections import deque, namedtuple
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+    FIRST_EXCEPTION,
+)
 
 import fsspec as fs
-from marshmallow import Schema, fields, validate
+from fsspec.spec import AbstractBufferedFile
+from marshmallow import Schema, ValidationError, fields, validate
 
+try:
+    # orjson is optional. It encodes and decodes large JSON documents
+    # several times faster than json.
+    import orjson
+except ImportError:
+    orjson = None
 
-from .screenshot import screenshot, ScreenshotError, SCREENSHOT_ENABLED
+from .cache import ReadCache, ScreenshotCache
+from .metrics import (
+    MetricsSink,
+    CallbackSink,
+    RecordingSink,
+    Timing,
+    NULL_SINK,
+    configure_metrics,
+    get_metrics_sink,
+)
+from .staging import UploadQueue
+from .table import Table, ROW_GROUP_SIZE, encode_table, table_from_csv
+from .table import read_table as _read_stored_table
+from .screenshot import (
+    screenshot,
+    screenshot_many,
+    ascreenshot_many,
+    ScreenshotError,
+    ScreenshotResult,
+    SCREENSHOT_ENABLED,
+    screenshot_key,
+    KEY_OUTPUT_ID,
+    BrowserPool,
+    configure_pool,
+    shutdown_pool,
+)
 
 __version__ = "1.11.1"
 
 
 BUCKET = os.environ.get("BUCKET", None)
 
+# Locations of the content addressed blobs and screenshots that are
+# written by write(dedupe=True).
+BLOB_PREFIX = "blobs"
+SCREENSHOT_PREFIX = "screenshots"
+
+
+# Size of the chunks that serializers convert at a time. It is a
+# multiple of 3 and 4, so that base64 chunks line up with whole groups
+# of encoded and decoded bytes.
+CHUNK_SIZE = 3 * 2 ** 18
+
 
 class Serializer:
     """
     Base class for serializng input data to bytes and back.
     """
 
+    # True if serialize_to and deserialize_from convert data in chunks
+    # instead of holding a second full size copy of it in memory.
+    chunked = False
+
     def __init__(self, ext):
         self.ext = ext
 
@@ -34,13 +99,268 @@ class Serializer:
     def deserialize(self, data, json_serializable=True):
         return data
 
+    def serialize_to(self, data, fileobj, chunk_size=CHUNK_SIZE):
+        """
+        Write the serialized data to fileobj, e.g. a zip member opened
+        with ZipFile.open, and return the number of bytes written.
+        """
+        ser = self.serialize(data)
+        fileobj.write(ser)
+        return len(ser)
+
+    def deserialize_from(self, fileobj, json_serializable=True, chunk_size=CHUNK_SIZE):
+        """
+        Read serialized data from fileobj and deserialize it.
+        """
+        return self.deserialize(fileobj.read(), json_serializable)
+
+    def iter_deserialize(self, fileobj, json_serializable=True, chunk_size=CHUNK_SIZE):
+        """
+        Read serialized data from fileobj and yield it in chunks of
+        about chunk_size bytes, e.g. to forward it to an HTTP response.
+        Binary data is yielded as bytes, or as base64 text if
+        json_serializable is True, and text as str. The chunks join to
+        the result of deserialize, except for JSON documents, which are
+        yielded as text.
+        """
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def to_json(self, data):
+        """
+        Convert output data to its JSON serializable form. Subclasses
+        skip the round trip through bytes when it does not change data.
+        """
+        return self.deserialize(self.serialize(data), json_serializable=True)
+
+    def from_json(self, data):
+        """
+        Convert output data from its JSON serializable form to the form
+        that is returned by read(json_serializable=False).
+        """
+        return self.deserialize(self.serialize(data), json_serializable=False)
+
+
+def _iter_text(fileobj, chunk_size, head=b""):
+    # Characters may span chunks, so the chunks are decoded
+    # incrementally. head is data that was already read from fileobj.
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if head:
+            chunk, head = head + chunk, b""
+        text = decoder.decode(chunk, final=not chunk)
+        if text:
+            yield text
+        if not chunk:
+            return
+
+
+# Settings of JSONSerializer. See configure_json.
+JSON_SETTINGS = {"backend": "json", "binary_arrays": False}
+
+# Binary JSON documents start with this header, which is never valid
+# JSON, so that JSONSerializer can tell them apart from JSON text.
+BINARY_JSON_MAGIC = b"\x00csjson1"
+
+# Numeric lists with fewer items stay in the JSON document.
+MIN_BINARY_ARRAY_LENGTH = 64
+
+
+def configure_json(backend="json", binary_arrays=False):
+    """
+    Choose how JSON outputs, i.e. bokeh plots, are written. Calling it
+    without arguments restores the defaults.
+
+    backend is "json" or "orjson", the library that encodes and decodes
+    the documents. orjson is several times faster, but it writes NaN and
+    infinite floats as null and reads integers that do not fit into 64
+    bits as floats. Only choose it if the outputs do not contain such
+    numbers outside of binary arrays. Either backend reads documents
+    that were written by the other.
+
+    If binary_arrays is True, lists of at least MIN_BINARY_ARRAY_LENGTH
+    floats or integers, like the columns of Bokeh data sources, and the
+    base64 data of Bokeh's "__ndarray__" objects are stored as raw
+    little endian buffers after the JSON document instead of as text.
+    Such documents start with BINARY_JSON_MAGIC and are decoded to the
+    same objects as the original document. Older versions of cs-storage
+    cannot read them.
+    """
+    if backend == "orjson" and orjson is None:
+        raise ValueError("orjson is not installed.")
+    if backend not in ("json", "orjson"):
+        raise ValueError(f"Unknown JSON backend: {backend}")
+    JSON_SETTINGS.update(backend=backend, binary_arrays=binary_arrays)
+
+
+def _json_dumps(data):
+    if JSON_SETTINGS["backend"] == "orjson":
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            # E.g. integers that do not fit into 64 bits or keys that are
+            # not strings, which json handles.
+            pass
+    return json.dumps(data).encode()
+
+
+def _json_loads(data):
+    if JSON_SETTINGS["backend"] == "orjson":
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # E.g. NaN, which json accepts.
+            pass
+    return json.loads(data.decode())
+
+
+def _array_typecode(items):
+    """
+    Return the array typecode that stores items without changing them,
+    or None if there is none.
+    """
+    first = type(items[0])
+    if first is float and all(type(item) is float for item in items):
+        return "d"
+    # bool is a subclass of int, so the types are compared exactly.
+    if first is int and all(type(item) is int for item in items):
+        return "q"
+    return None
+
+
+class _BinaryArrays:
+    """
+    Moves the numeric arrays of a JSON document into buffers and back.
+    Each array is replaced by {"__cs_buffer__": index}.
+    """
+
+    KEY = "__cs_buffer__"
+
+    def __init__(self):
+        self.buffers = []
+
+    def extract(self, obj):
+        if isinstance(obj, dict):
+            if self.KEY in obj:
+                # The placeholder could not be told apart from the data.
+                raise ValueError(f"Documents with {self.KEY} keys are stored as text.")
+            extracted = {key: self.extract(value) for key, value in obj.items()}
+            ndarray = obj.get("__ndarray__")
+            if isinstance(ndarray, str):
+                data = binascii.a2b_base64(ndarray)
+                # Only canonical base64 is restored to the same text.
+                if _b64encode(data) == ndarray:
+                    extracted["__ndarray__"] = self._add("b64", data)
+            return extracted
+        if isinstance(obj, (list, tuple)):
+            if len(obj) >= MIN_BINARY_ARRAY_LENGTH:
+                typecode = _array_typecode(obj)
+                if typecode is not None:
+                    try:
+                        buffer = array.array(typecode, obj)
+                    except OverflowError:
+                        buffer = None
+                    if buffer is not None:
+                        if sys.byteorder == "big":
+                            buffer.byteswap()
+                        return self._add(typecode, buffer.tobytes())
+            return [self.extract(item) for item in obj]
+        return obj
+
+    def _add(self, kind, data):
+        self.buffers.append((kind, data))
+        return {self.KEY: len(self.buffers) - 1}
+
+    def restore(self, obj):
+        if isinstance(obj, dict):
+            if len(obj) == 1 and self.KEY in obj:
+                return self._get(obj[self.KEY])
+            return {key: self.restore(value) for key, value in obj.items()}
+        if isinstance(obj, list):
+            return [self.restore(item) for item in obj]
+        return obj
+
+    def _get(self, index):
+        kind, data = self.buffers[index]
+        if kind == "b64":
+            return _b64encode(data)
+        buffer = array.array(kind)
+        buffer.frombytes(data)
+        if sys.byteorder == "big":
+            buffer.byteswap()
+        return buffer.tolist()
+
+
+def _dumps_binary(data):
+    """
+    Encode data as BINARY_JSON_MAGIC, the length of the header, a JSON
+    header with the document and the kind and size of each buffer, and
+    the buffers. The buffers start at multiples of 8 bytes, so they can
+    be used as typed arrays in place.
+    """
+    arrays = _BinaryArrays()
+    header = _json_dumps(
+        {
+            "doc": arrays.extract(data),
+            "buffers": [[kind, len(buffer)] for kind, buffer in arrays.buffers],
+        }
+    )
+    parts = [BINARY_JSON_MAGIC, struct.pack("<Q", len(header)), header]
+    offset = sum(map(len, parts))
+    for _, buffer in arrays.buffers:
+        parts.append(b"\x00" * (-offset % 8))
+        parts.append(buffer)
+        offset += len(parts[-2]) + len(buffer)
+    return b"".join(parts)
+
+
+def _loads_binary(data):
+    view = memoryview(data)
+    start = len(BINARY_JSON_MAGIC)
+    (header_size,) = struct.unpack_from("<Q", view, start)
+    start += 8
+    header = _json_loads(bytes(view[start : start + header_size]))
+    offset = start + header_size
+    arrays = _BinaryArrays()
+    for kind, size in header["buffers"]:
+        offset += -offset % 8
+        arrays.buffers.append((kind, view[offset : offset + size]))
+        offset += size
+    return arrays.restore(header["doc"])
+
 
 class JSONSerializer(Serializer):
     def serialize(self, data):
-        return json.dumps(data).encode()
+        if JSON_SETTINGS["binary_arrays"]:
+            try:
+                return _dumps_binary(data)
+            except ValueError:
+                pass
+        return _json_dumps(data)
 
     def deserialize(self, data, json_serializable=True):
-        return json.loads(data.decode())
+        if data[: len(BINARY_JSON_MAGIC)] == BINARY_JSON_MAGIC:
+            return _loads_binary(data)
+        return _json_loads(data)
+
+    def iter_deserialize(self, fileobj, json_serializable=True, chunk_size=CHUNK_SIZE):
+        head = fileobj.read(len(BINARY_JSON_MAGIC))
+        if head == BINARY_JSON_MAGIC:
+            # Binary documents are converted to JSON text in one piece.
+            # json keeps NaN and infinite floats, which orjson does not.
+            yield json.dumps(self.deserialize(head + fileobj.read()))
+            return
+        yield from _iter_text(fileobj, chunk_size, head)
+
+    def to_json(self, data):
+        return data
+
+    def from_json(self, data):
+        return data
 
 
 class TextSerializer(Serializer):
@@ -50,8 +370,23 @@ class TextSerializer(Serializer):
     def deserialize(self, data, json_serializable=True):
         return data.decode()
 
+    def iter_deserialize(self, fileobj, json_serializable=True, chunk_size=CHUNK_SIZE):
+        return _iter_text(fileobj, chunk_size)
+
+    def to_json(self, data):
+        if isinstance(data, str):
+            return data
+        return super().to_json(data)
+
+    def from_json(self, data):
+        if isinstance(data, str):
+            return data
+        return super().from_json(data)
+
 
 class Base64Serializer(Serializer):
+    chunked = True
+
     def deserialize(self, data, json_serializable=True):
         if json_serializable:
             return base64.b64encode(data).decode("utf-8")
@@ -64,7 +399,88 @@ class Base64Serializer(Serializer):
         return data
 
     def from_string(self, data):
-        return base64.b64decode(data.encode("utf-8"))
+        # a2b_base64 reads ASCII strings in place. This is what
+        # base64.b64decode does after copying data to bytes.
+        return binascii.a2b_base64(data)
+
+    def serialize_to(self, data, fileobj, chunk_size=CHUNK_SIZE):
+        """
+        Decode base64 data in chunks of chunk_size characters straight
+        into fileobj. Base64 with line breaks is decoded in one piece,
+        because its groups of four characters do not line up with the
+        chunks.
+        """
+        if not isinstance(data, str) or "\n" in data:
+            return super().serialize_to(data, fileobj, chunk_size)
+        chunk_size -= chunk_size % 4
+        nbytes = 0
+        for start in range(0, len(data), chunk_size):
+            chunk = binascii.a2b_base64(data[start : start + chunk_size])
+            fileobj.write(chunk)
+            nbytes += len(chunk)
+        return nbytes
+
+    def deserialize_from(self, fileobj, json_serializable=True, chunk_size=CHUNK_SIZE):
+        if not json_serializable:
+            return fileobj.read()
+        return "".join(self.iter_deserialize(fileobj, True, chunk_size))
+
+    def iter_deserialize(self, fileobj, json_serializable=True, chunk_size=CHUNK_SIZE):
+        if not json_serializable:
+            yield from super().iter_deserialize(fileobj, False, chunk_size)
+            return
+        # Encode whole groups of three bytes, so that only the last
+        # chunk is padded.
+        chunk_size = max(chunk_size - chunk_size % 3, 3)
+        rest = b""
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            if rest:
+                chunk = rest + chunk
+            end = len(chunk) - len(chunk) % 3
+            rest = chunk[end:]
+            if end:
+                yield _b64encode(memoryview(chunk)[:end])
+        if rest:
+            yield _b64encode(rest)
+
+    def to_json(self, data):
+        if isinstance(data, str):
+            return data
+        return super().to_json(data)
+
+    def from_json(self, data):
+        if isinstance(data, bytes):
+            return data
+        return super().from_json(data)
+
+
+def _b64encode(data):
+    return binascii.b2a_base64(data, newline=False).decode("ascii")
+
+
+# Compression type and level for zip members, keyed by Serializer.ext.
+# Text outputs shrink several times with deflate. Level 1 gets most of
+# the size reduction for numeric text like Bokeh JSON and CSV at about
+# five times the speed of level 6, while HTML and Markdown compress
+# fast enough at level 6. PNG, JPEG, MP3, MP4 and PDF data is already
+# compressed and is stored as is. HDF5 files are often uncompressed
+# arrays that deflate well.
+COMPRESSION_POLICY = {
+    "json": (zipfile.ZIP_DEFLATED, 1),
+    "csv": (zipfile.ZIP_DEFLATED, 1),
+    "html": (zipfile.ZIP_DEFLATED, 6),
+    "md": (zipfile.ZIP_DEFLATED, 6),
+    "txt": (zipfile.ZIP_DEFLATED, 6),
+    "h5": (zipfile.ZIP_DEFLATED, 1),
+    "png": (zipfile.ZIP_STORED, None),
+    "jpeg": (zipfile.ZIP_STORED, None),
+    "mp3": (zipfile.ZIP_STORED, None),
+    "mp4": (zipfile.ZIP_STORED, None),
+    "pdf": (zipfile.ZIP_STORED, None),
+}
 
 
 def get_serializer(media_type):
@@ -83,32 +499,40 @@ def get_serializer(media_type):
     }[media_type]
 
 
+MEDIA_TYPES = [
+    "bokeh",
+    "table",
+    "CSV",
+    "PNG",
+    "JPEG",
+    "MP3",
+    "MP4",
+    "HDF5",
+    "PDF",
+    "Markdown",
+    "Text",
+]
+
+
 class Output:
     """Output mixin shared among LocalOutput and RemoteOutput"""
 
     id = fields.UUID(required=False)
     title = fields.Str()
-    media_type = fields.Str(
-        validate=validate.OneOf(
-            choices=[
-                "bokeh",
-                "table",
-                "CSV",
-                "PNG",
-                "JPEG",
-                "MP3",
-                "MP4",
-                "HDF5",
-                "PDF",
-                "Markdown",
-                "Text",
-            ]
-        )
-    )
+    media_type = fields.Str(validate=validate.OneOf(choices=MEDIA_TYPES))
 
 
 class RemoteOutput(Output, Schema):
     filename = fields.Str()
+    # Set by add_screenshot_links.
+    screenshot = fields.Str(required=False)
+    # Set for outputs that are stored as content addressed blobs.
+    digest = fields.Str(required=False)
+    # Set for CSV outputs that were also stored as columnar tables.
+    table = fields.Str(required=False)
+    # Set for outputs that were added with append. It overrides the
+    # category's ziplocation.
+    ziplocation = fields.Str(required=False)
 
 
 class RemoteOutputCategory(Schema):
@@ -135,134 +559,2066 @@ class LocalResult(Schema):
     downloadable = fields.Nested(LocalOutput, many=True)
 
 
-def serialize_to_json(loc_result):
-    LocalResult().load(loc_result)
-    result = copy.deepcopy(loc_result)
-    for category in ["renderable", "downloadable"]:
-        for output in result[category]:
-            serializer = get_serializer(output["media_type"])
-            as_bytes = serializer.serialize(output["data"])
-            output["data"] = serializer.deserialize(as_bytes, json_serializable=True)
-    return result
+# Schemas are stateless, so one instance of each is shared by all calls.
+LOCAL_RESULT_SCHEMA = LocalResult()
+REMOTE_RESULT_SCHEMA = RemoteResult()
 
+CATEGORIES = ("renderable", "downloadable")
+LOCAL_OUTPUT_KEYS = {"id", "title", "media_type", "data"}
+REMOTE_OUTPUT_KEYS = {
+    "id",
+    "title",
+    "media_type",
+    "filename",
+    "screenshot",
+    "digest",
+    "table",
+    "ziplocation",
+}
 
-def deserialize_from_json(json_result):
-    LocalResult().load(json_result)
-    result = copy.deepcopy(json_result)
-    for category in ["renderable", "downloadable"]:
-        for output in result[category]:
-            serializer = get_serializer(output["media_type"])
-            as_bytes = serializer.serialize(output["data"])
-            output["data"] = serializer.deserialize(as_bytes, json_serializable=False)
-    return result
 
+def _fast_validate_outputs(outputs, allowed_keys, required_keys, path):
+    if not isinstance(outputs, list):
+        raise ValidationError({path: ["Not a valid list."]})
+    for i, output in enumerate(outputs):
+        if not isinstance(output, dict):
+            raise ValidationError({path: {i: ["Invalid input type."]}})
+        missing = required_keys - output.keys()
+        if missing:
+            raise ValidationError(
+                {path: {i: {key: ["Missing data."] for key in sorted(missing)}}}
+            )
+        unknown = output.keys() - allowed_keys
+        if unknown:
+            raise ValidationError(
+                {path: {i: {key: ["Unknown field."] for key in sorted(unknown)}}}
+            )
+        if output["media_type"] not in MEDIA_TYPES:
+            raise ValidationError(
+                {
+                    path: {
+                        i: {"media_type": ["Must be one of: " + ", ".join(MEDIA_TYPES)]}
+                    }
+                }
+            )
+        if not isinstance(output["title"], str):
+            raise ValidationError({path: {i: {"title": ["Not a valid string."]}}})
 
-def write_pic(fs, output, protocol="gcs"):
-    if SCREENSHOT_ENABLED:
-        s = time.time()
-        try:
-            pic_data = screenshot(output)
-        except ScreenshotError:
-            print("failed to create screenshot for ", output["id"])
-            return
+
+def _fast_validate(result, remote=False):
+    """
+    Check the structure of a local or remote result: the categories,
+    the output keys, the media types and the titles. Unlike the full
+    schema load, the output data is never touched.
+    """
+    if not isinstance(result, dict):
+        raise ValidationError({"_schema": ["Invalid input type."]})
+    unknown = result.keys() - set(CATEGORIES)
+    if unknown:
+        raise ValidationError({key: ["Unknown field."] for key in sorted(unknown)})
+    for category, value in result.items():
+        if remote:
+            if not isinstance(value, dict):
+                raise ValidationError({category: ["Invalid input type."]})
+            unknown = value.keys() - {"outputs", "ziplocation"}
+            if unknown:
+                raise ValidationError(
+                    {category: {key: ["Unknown field."] for key in sorted(unknown)}}
+                )
+            outputs = value.get("outputs", [])
+            _fast_validate_outputs(
+                outputs,
+                REMOTE_OUTPUT_KEYS,
+                {"title", "media_type"},
+                category,
+            )
+            if "ziplocation" not in value and any(
+                "digest" not in output and "ziplocation" not in output
+                for output in outputs
+            ):
+                raise ValidationError({category: {"ziplocation": ["Missing data."]}})
         else:
-            with fs.open(f"{protocol}://{BUCKET}/{output['id']}.png", "wb") as f:
-                f.write(pic_data)
-            f = time.time()
-            print(f"Pic write finished in {f-s}s")
-    else:
-        import warnings
+            _fast_validate_outputs(
+                value, LOCAL_OUTPUT_KEYS, {"title", "media_type", "data"}, category
+            )
+
 
-        warnings.warn(
-            "Screenshot not enabled. Make sure you have installed "
-            "the optional packages listed in environment.yaml."
+def _validate(result, remote=False, validate="full"):
+    """
+    Validate a local or remote result.
+
+    validate is one of:
+        - "full": load the result with the LocalResult or RemoteResult
+          schema.
+        - "fast": only check the structure of the result, see
+          _fast_validate.
+        - "none": skip validation.
+    """
+    if validate == "full":
+        (REMOTE_RESULT_SCHEMA if remote else LOCAL_RESULT_SCHEMA).load(result)
+    elif validate == "fast":
+        _fast_validate(result, remote=remote)
+    elif validate != "none":
+        raise ValueError(
+            f"validate must be 'full', 'fast' or 'none', not {validate!r}."
         )
 
 
-def write(task_id, loc_result, do_upload=True, protocol="gcs"):
-    s = time.time()
-    LocalResult().load(loc_result)
-    rem_result = {}
-    for category in ["renderable", "downloadable"]:
-        buff = io.BytesIO()
-        zipfileobj = zipfile.ZipFile(buff, mode="w")
-        ziplocation = f"{task_id}_{category}.zip"
-        rem_result[category] = {"ziplocation": ziplocation, "outputs": []}
-        for output in loc_result[category]:
-            serializer = get_serializer(output["media_type"])
-            ser = serializer.serialize(output["data"])
-            output["id"] = str(uuid.uuid4())
-            filename = output["title"]
-            if not filename.endswith(f".{serializer.ext}"):
-                filename += f".{serializer.ext}"
-            zipfileobj.writestr(filename, ser)
-            rem_result[category]["outputs"].append(
-                {
-                    "id": output["id"],
-                    "title": output["title"],
-                    "media_type": output["media_type"],
-                    "filename": filename,
-                }
+def serialize_to_json(loc_result, validate="full"):
+    """
+    Convert the output data in loc_result to its JSON serializable form.
+    New output dicts are returned, but data that is already JSON
+    serializable is shared with loc_result instead of being copied.
+
+    validate is "full", "fast" or "none". See _validate.
+    """
+    _validate(loc_result, validate=validate)
+    return {
+        category: [
+            dict(
+                output,
+                data=get_serializer(output["media_type"]).to_json(output["data"]),
             )
-            if do_upload and category == "renderable":
+            for output in loc_result[category]
+        ]
+        for category in ["renderable", "downloadable"]
+    }
+
+
+def deserialize_from_json(json_result, validate="full"):
+    """
+    Inverse of serialize_to_json. Like serialize_to_json, data that does
+    not need to be converted is shared with json_result.
+    """
+    _validate(json_result, validate=validate)
+    return {
+        category: [
+            dict(
+                output,
+                data=get_serializer(output["media_type"]).from_json(output["data"]),
+            )
+            for output in json_result[category]
+        ]
+        for category in ["renderable", "downloadable"]
+    }
+
+
+def _screenshot_warning():
+    import warnings
+
+    warnings.warn(
+        "Screenshot not enabled. Make sure you have installed "
+        "the optional packages listed in environment.yaml."
+    )
+
+
+def _write_pics(upload, root, outputs, metrics=NULL_SINK, cache=None):
+    """
+    Screenshot all outputs in one batch and pass the pictures to
+    upload(path, data, metrics). Returns what upload returned. cache is
+    an optional ScreenshotCache.
+    """
+    if not SCREENSHOT_ENABLED:
+        _screenshot_warning()
+        return []
+    futures = []
+    results = screenshot_many(outputs, metrics=metrics, cache=cache)
+    for output, result in zip(outputs, results):
+        if result.error is not None:
+            print("failed to create screenshot for ", output["id"])
+            continue
+        pic_location = output.get("screenshot", f"{output['id']}.png")
+        futures.append(
+            upload(
+                f"{root}/{pic_location}",
+                result.data,
+                metrics.bind(media_type=output["media_type"]),
+            )
+        )
+    return futures
+
+
+def _upload(fs, path, data):
+    with fs.open(path, "wb") as f:
+        f.write(data)
+
+
+# Uploads of at least MULTIPART_THRESHOLD bytes are split into parts of
+# PART_SIZE bytes that are uploaded in parallel and joined by the
+# backend, e.g. with GCS compose. A compose request takes at most
+# MAX_MERGE_PARTS objects. Failed parts are retried after RETRY_DELAY
+# seconds, doubling with each attempt.
+MULTIPART_THRESHOLD = 2 ** 26
+PART_SIZE = 2 ** 24
+MAX_MERGE_PARTS = 32
+RETRY_DELAY = 0.5
+
+
+def _supports_multipart(fs):
+    return callable(getattr(fs, "merge", None))
+
+
+def _upload_part(fs, path, data, retries):
+    for attempt in itertools.count():
+        try:
+            return _upload(fs, path, data)
+        except Exception:
+            if attempt >= retries:
+                raise
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+
+
+def _merge(fs, path, part_paths, created):
+    """
+    Join part_paths into path. More than MAX_MERGE_PARTS parts are
+    joined in rounds, whose intermediate objects are added to created.
+    """
+    while len(part_paths) > MAX_MERGE_PARTS:
+        groups = [
+            part_paths[start : start + MAX_MERGE_PARTS]
+            for start in range(0, len(part_paths), MAX_MERGE_PARTS)
+        ]
+        part_paths = [f"{group[0]}.merged" for group in groups]
+        for merged, group in zip(part_paths, groups):
+            created.append(merged)
+            fs.merge(merged, group)
+    fs.merge(path, part_paths)
+
+
+def _multipart_upload(fs, path, data, part_size=PART_SIZE, max_workers=4, retries=3):
+    """
+    Upload data to path in parts of part_size bytes on max_workers
+    threads and join them with fs.merge. Each part is retried up to
+    retries times, so a transient error only costs one part. The parts
+    are stored as temporary objects next to path and removed afterwards.
+    """
+    view = memoryview(data)
+    prefix = f"{path}.{uuid.uuid4().hex}"
+    parts = [
+        (f"{prefix}.part{i:05d}", view[start : start + part_size])
+        for i, start in enumerate(range(0, len(data), part_size))
+    ]
+    created = [part_path for part_path, _ in parts]
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            _wait_all(
+                [
+                    executor.submit(_upload_part, fs, part_path, part, retries)
+                    for part_path, part in parts
+                ]
+            )
+        _merge(fs, path, created[:], created)
+    finally:
+        for part_path in created:
+            try:
+                fs.rm_file(part_path)
+            except FileNotFoundError:
+                pass
+
+
+def _stream_upload(fs, path, write_to, block_size=None):
+    """
+    Open path for writing and pass the file object to write_to. The
+    data is uploaded in chunks of block_size bytes while it is written,
+    so it is never held in memory in full.
+
+    If write_to fails, the upload is discarded. Buffered files, e.g.
+    gcsfs's, are not committed, so an object that already exists at
+    path is kept. Files that are written in place, e.g. on the memory
+    and local filesystems, are removed.
+    """
+    kwargs = {} if block_size is None else {"block_size": block_size}
+    in_place = False
+    try:
+        with fs.open(path, "wb", **kwargs) as f:
+            in_place = not isinstance(f, AbstractBufferedFile)
+            try:
+                write_to(f)
+            except BaseException:
+                if not in_place:
+                    # Cancel the upload, e.g. GCS's resumable upload.
+                    # Closing the file would upload the buffered data
+                    # and commit the truncated object.
+                    f.discard()
+                    f.closed = True
+                raise
+    except BaseException:
+        if in_place:
+            try:
+                fs.rm(path)
+            except FileNotFoundError:
+                pass
+        raise
+
+
+def _wait_all(futures, timeout=None):
+    """
+    Wait for all futures to finish. If any of them fails, the pending
+    futures are cancelled and the first exception is raised. If they
+    have not finished after timeout seconds, the pending futures are
+    cancelled and TimeoutError is raised.
+    """
+    done, not_done = wait(futures, timeout=timeout, return_when=FIRST_EXCEPTION)
+    for future in not_done:
+        future.cancel()
+    for future in futures:
+        if future.done() and not future.cancelled() and future.exception():
+            wait(not_done)
+            raise future.exception()
+    if not_done:
+        raise TimeoutError(f"Uploads did not finish within {timeout}s")
+
+
+def _remote_output(output, serializer):
+    """
+    Give output a new id and return its remote output.
+    """
+    output["id"] = str(uuid.uuid4())
+    filename = output["title"]
+    if not filename.endswith(f".{serializer.ext}"):
+        filename += f".{serializer.ext}"
+    return {
+        "id": output["id"],
+        "title": output["title"],
+        "media_type": output["media_type"],
+        "filename": filename,
+    }
+
+
+def _write_zip(
+    fileobj,
+    outputs,
+    pics=None,
+    compression=None,
+    metrics=NULL_SINK,
+    workers=1,
+    executor=None,
+):
+    """
+    Write outputs to a zip archive in fileobj and return the remote
+    outputs. fileobj does not need to be seekable. If pics is a list,
+    the outputs are deserialized to text for the screenshot template and
+    appended to it.
+
+    compression overrides entries of COMPRESSION_POLICY.
+
+    If workers is more than 1, the outputs are serialized and deflated
+    on that many threads while earlier members are written, see
+    _pack_member. Only the compression releases the GIL, so threads
+    do not speed up the serialization. executor, e.g. a
+    ProcessPoolExecutor with workers processes, is used instead of
+    threads if it is given. The archive is the same byte for byte
+    either way: all members get the fixed ZipInfo timestamp, so archives
+    of equal outputs are equal.
+    """
+    if executor is not None:
+        return _write_zip_to(
+            fileobj, outputs, pics, compression, metrics, executor, workers
+        )
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return _write_zip_to(
+                fileobj, outputs, pics, compression, metrics, executor, workers
+            )
+    return _write_zip_to(fileobj, outputs, pics, compression, metrics)
+
+
+def _write_zip_to(
+    fileobj, outputs, pics, compression, metrics, executor=None, workers=1
+):
+    """
+    Write the zip archive of _write_zip, packing the outputs on
+    executor if it is given.
+    """
+    policy = dict(COMPRESSION_POLICY, **(compression or {}))
+    rem_outputs = []
+    packed = _pack_members(executor, 2 * workers, outputs, policy, metrics)
+    with zipfile.ZipFile(fileobj, mode="w") as zipfileobj:
+        for output in outputs:
+            media_type = output["media_type"]
+            serializer = get_serializer(media_type)
+            rem_output = _remote_output(output, serializer)
+            compress_type, compresslevel = policy.get(
+                serializer.ext, (zipfile.ZIP_STORED, None)
+            )
+            if serializer.chunked and isinstance(output["data"], str):
+                _write_member(
+                    zipfileobj,
+                    rem_output["filename"],
+                    serializer,
+                    output["data"],
+                    compress_type,
+                    compresslevel,
+                    metrics.bind(media_type=media_type),
+                )
+            else:
+                if packed is not None:
+                    ser, compressed, timings = next(packed).result()
+                    mmetrics = metrics.bind(media_type=media_type)
+                    for timing in timings:
+                        mmetrics.emit(timing)
+                else:
+                    with metrics.timer("serialization", media_type=media_type) as timer:
+                        ser = serializer.serialize(output["data"])
+                        timer.nbytes = len(ser)
+                    compressed = None
+                if compressed is not None:
+                    zinfo = zipfile.ZipInfo(rem_output["filename"])
+                    zinfo.compress_type = compress_type
+                    # Like ZipFile.writestr, which decides on the zip64
+                    # extension by the size of the data.
+                    zinfo.file_size = len(ser)
+                    with zipfileobj.open(zinfo, "w") as member:
+                        # ZipFile has no API for precompressed data, so
+                        # the member's compressor is swapped for one that
+                        # hands it out.
+                        member._compressor = _Precompressed(compressed)
+                        member.write(ser)
+                else:
+                    with metrics.timer("zip", len(ser), media_type=media_type):
+                        zipfileobj.writestr(
+                            zipfile.ZipInfo(rem_output["filename"]),
+                            ser,
+                            compress_type=compress_type,
+                            compresslevel=compresslevel,
+                        )
+            rem_outputs.append(rem_output)
+            if pics is not None:
                 # This data will be rendered on an HTML template and needs
-                # to be deserialized from bytes to text.
-                write_pic(
-                    fs,
-                    dict(
-                        output, data=serializer.deserialize(ser, json_serializable=True)
-                    ),
-                    protocol=protocol,
+                # to be in its text form.
+                pics.append(dict(output, data=serializer.to_json(output["data"])))
+    return rem_outputs
+
+
+class _Precompressed:
+    """
+    Stands in for the compressor of a zip member whose data has been
+    compressed already. ZipFile still computes the CRC and sizes and
+    writes the headers.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def compress(self, data):
+        compressed, self.data = self.data, b""
+        return compressed
+
+    def flush(self):
+        return b""
+
+
+def _pack_member(serializer, data, compress_type, compresslevel, record):
+    """
+    Serialize data and, for ZIP_DEFLATED, compress it like ZipFile does.
+    Returns the serialized and the compressed data, or None for the
+    latter if the member is compressed when it is written, and the
+    timings of the phases if record is True. The compression is the
+    "zip" timing of the member. The writer emits the timings, so that
+    they are not lost in worker processes.
+    """
+    metrics = RecordingSink() if record else NULL_SINK
+    with metrics.timer("serialization") as timer:
+        ser = serializer.serialize(data)
+        timer.nbytes = len(ser)
+    compressed = None
+    if compress_type == zipfile.ZIP_DEFLATED:
+        with metrics.timer("zip", len(ser), packed=True):
+            level = (
+                zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel
+            )
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            compressed = compressor.compress(ser) + compressor.flush()
+    return ser, compressed, getattr(metrics, "timings", [])
+
+
+def _pack_member_in_process(json_settings, *args):
+    """
+    _pack_member for worker processes, which do not see the settings
+    of configure_json in the writer's process.
+    """
+    JSON_SETTINGS.update(json_settings)
+    return _pack_member(*args)
+
+
+def _pack_members(executor, window, outputs, policy, metrics):
+    """
+    Yield the futures of _pack_member for the outputs that are not
+    written in chunks, in order, or return None if executor is None.
+    At most window outputs are packed ahead of the writer, so that a
+    large result is not held in memory in full.
+    """
+    if executor is None:
+        return None
+    jobs = []
+    for output in outputs:
+        serializer = get_serializer(output["media_type"])
+        if serializer.chunked and isinstance(output["data"], str):
+            continue
+        compress_type, compresslevel = policy.get(
+            serializer.ext, (zipfile.ZIP_STORED, None)
+        )
+        jobs.append(
+            (serializer, output["data"], compress_type, compresslevel, metrics.enabled)
+        )
+    if isinstance(executor, ProcessPoolExecutor):
+        jobs = [(dict(JSON_SETTINGS),) + job for job in jobs]
+        pack = _pack_member_in_process
+    else:
+        pack = _pack_member
+
+    def futures():
+        pending = deque()
+        for job in jobs:
+            pending.append(executor.submit(pack, *job))
+            if len(pending) >= window:
+                yield pending.popleft()
+        yield from pending
+
+    return futures()
+
+
+def _write_member(
+    zipfileobj, filename, serializer, data, compress_type, compresslevel, metrics
+):
+    """
+    Serialize data in chunks straight into a new member of zipfileobj,
+    so that the serialized data is never held in memory in full. The
+    conversion is part of the "zip" timing.
+    """
+    # ZipFile.open takes the compression of new members from the
+    # archive's settings.
+    default = zipfileobj.compression, zipfileobj.compresslevel
+    zipfileobj.compression, zipfileobj.compresslevel = compress_type, compresslevel
+    # Unlike writestr, ZipFile.open does not know the size of the data
+    # and needs to be told to use the zip64 extension for large members.
+    # Base64 text decodes to at most three bytes per four characters.
+    force_zip64 = len(data) * 3 // 4 > zipfile.ZIP64_LIMIT
+    try:
+        with metrics.timer("zip", chunked=True) as timer:
+            with zipfileobj.open(filename, "w", force_zip64=force_zip64) as member:
+                timer.nbytes = serializer.serialize_to(data, member)
+    finally:
+        zipfileobj.compression, zipfileobj.compresslevel = default
+
+
+def _write_blobs(
+    executor, upload, fs, root, outputs, pics=None, do_upload=True, metrics=NULL_SINK
+):
+    """
+    Store each output as a blob under the SHA-256 digest of its
+    serialized data and return the remote outputs and the results of
+    upload(path, data, metrics, missing_only=True). Blobs that already
+    exist are not uploaded again.
+
+    The screenshot of a renderable output depends only on its media
+    type, title and data, so it is stored under a digest of those. If
+    pics is a list, the outputs whose screenshot does not exist yet are
+    appended to it.
+    """
+    rem_outputs, futures, uploaded, pic_candidates = [], [], set(), []
+    for output in outputs:
+        media_type = output["media_type"]
+        serializer = get_serializer(media_type)
+        with metrics.timer("serialization", media_type=media_type) as timer:
+            ser = serializer.serialize(output["data"])
+            timer.nbytes = len(ser)
+        rem_output = _remote_output(output, serializer)
+        rem_output["digest"] = hashlib.sha256(ser).hexdigest()
+        rem_outputs.append(rem_output)
+        if do_upload and rem_output["digest"] not in uploaded:
+            uploaded.add(rem_output["digest"])
+            futures.append(
+                upload(
+                    f"{root}/{BLOB_PREFIX}/{rem_output['digest']}",
+                    ser,
+                    metrics.bind(media_type=media_type),
+                    missing_only=True,
                 )
-        zipfileobj.close()
-        buff.seek(0)
-        if do_upload:
-            with fs.open(f"{protocol}://{BUCKET}/{ziplocation}", "wb") as f:
-                f.write(buff.read())
-    f = time.time()
-    print(f"Write finished in {f-s}s")
-    return rem_result
+            )
+        if pics is not None:
+            pic_key = json.dumps(
+                [output["media_type"], output["title"], rem_output["digest"]]
+            )
+            pic_digest = hashlib.sha256(pic_key.encode()).hexdigest()
+            rem_output["screenshot"] = f"{SCREENSHOT_PREFIX}/{pic_digest}.png"
+            pic_candidates.append((output, serializer, ser, rem_output["screenshot"]))
+
+    pic_exists = executor.map(
+        lambda pic_location: fs.exists(f"{root}/{pic_location}"),
+        [pic_location for _, _, _, pic_location in pic_candidates],
+    )
+    pic_locations = set()
+    for (output, serializer, ser, pic_location), exists in zip(
+        pic_candidates, list(pic_exists)
+    ):
+        if exists or pic_location in pic_locations:
+            continue
+        pic_locations.add(pic_location)
+        pics.append(
+            dict(
+                output,
+                data=serializer.deserialize(ser, json_serializable=True),
+                screenshot=pic_location,
+            )
+        )
+    return rem_outputs, futures
+
+
+def _write_tables(upload, root, task_id, outputs, rem_outputs, metrics=NULL_SINK):
+    """
+    Store the CSV outputs as columnar tables next to the zip files and
+    add their locations to the remote outputs. CSVs whose rows are not
+    all as long as their header are skipped. Returns what upload
+    returned.
+    """
+    futures = []
+    for output, rem_output in zip(outputs, rem_outputs):
+        if output["media_type"] != "CSV" or not isinstance(output["data"], str):
+            continue
+        with metrics.timer("serialization", media_type="CSV", table=True) as timer:
+            table = encode_table(output["data"])
+            timer.nbytes = len(table) if table is not None else None
+        if table is None:
+            continue
+        rem_output["table"] = f"{task_id}_{rem_output['id']}.table"
+        futures.append(
+            upload(
+                f"{root}/{rem_output['table']}",
+                table,
+                metrics.bind(media_type="CSV"),
+            )
+        )
+    return futures
+
+
+def _find_output(rem_result, output):
+    """
+    Return the remote category and the remote output whose id or title
+    is output.
+    """
+    for rem_category in rem_result.values():
+        selected = _select_outputs(rem_category["outputs"], [output])
+        if selected:
+            return rem_category, selected[0]
+    raise KeyError(output)
+
+
+def _ziplocation(rem_category, rem_output):
+    """
+    Location of the zip file that holds rem_output. Outputs that were
+    added with append are in their own zip files.
+    """
+    return rem_output.get("ziplocation") or rem_category["ziplocation"]
+
+
+def _zip_groups(rem_category, rem_outputs):
+    """
+    Group the rem_outputs that are stored in zip files by the location
+    of their zip file.
+    """
+    groups = {}
+    for rem_output in rem_outputs:
+        if "digest" not in rem_output:
+            ziplocation = _ziplocation(rem_category, rem_output)
+            groups.setdefault(ziplocation, []).append(rem_output)
+    return groups
+
+
+def _select_outputs(rem_outputs, outputs):
+    """
+    Select the remote outputs whose id or title is in outputs.
+    """
+    return [
+        rem_output
+        for rem_output in rem_outputs
+        if rem_output.get("id") in outputs or rem_output["title"] in outputs
+    ]
+
+
+def _local_output(rem_output, data):
+    return {
+        "id": rem_output.get("id", None),
+        "title": rem_output["title"],
+        "media_type": rem_output["media_type"],
+        "data": data,
+    }
+
+
+def _deserialize(rem_output, data, json_serializable, metrics=NULL_SINK):
+    media_type = rem_output["media_type"]
+    with metrics.timer("serialization", len(data), media_type=media_type):
+        return get_serializer(media_type).deserialize(data, json_serializable)
+
+
+def _read_zip(zipfileobj, rem_outputs, json_serializable=True, metrics=NULL_SINK):
+    return list(_iter_zip(zipfileobj, rem_outputs, json_serializable, metrics))
+
+
+def _iter_zip(zipfileobj, rem_outputs, json_serializable=True, metrics=NULL_SINK):
+    """
+    Yield the local outputs of rem_outputs from zipfileobj. Each member
+    is only read when its output is requested.
+    """
+    for rem_output in rem_outputs:
+        serializer = get_serializer(rem_output["media_type"])
+        if serializer.chunked and json_serializable:
+            # Deserialize straight from the member stream, so that the
+            # member's bytes are never held in memory in full. The
+            # conversion is part of the "unzip" timing.
+            with metrics.timer(
+                "unzip", media_type=rem_output["media_type"], chunked=True
+            ) as timer:
+                with zipfileobj.open(rem_output["filename"]) as member:
+                    rem_data = serializer.deserialize_from(member, json_serializable)
+                timer.nbytes = zipfileobj.getinfo(rem_output["filename"]).file_size
+            yield _local_output(rem_output, rem_data)
+            continue
+        with metrics.timer("unzip", media_type=rem_output["media_type"]) as timer:
+            data = zipfileobj.read(rem_output["filename"])
+            timer.nbytes = len(data)
+        # Drop the member's bytes before the output is handed out.
+        rem_data = _deserialize(rem_output, data, json_serializable, metrics)
+        del data
+        yield _local_output(rem_output, rem_data)
+
+
+def _download(fs, path, metrics=NULL_SINK):
+    with metrics.timer("download") as timer:
+        with fs.open(path, "rb") as f:
+            data = f.read()
+        timer.nbytes = len(data)
+    return data
+
+
+def _cached_download(fs, path, cache=None, metrics=NULL_SINK):
+    data = cache.get(path) if cache is not None else None
+    if data is None:
+        data = _download(fs, path, metrics)
+        if cache is not None:
+            cache.put(path, data)
+    return data
+
+
+# Block size for the range requests that are used to read selected
+# outputs. Reading the central directory and a member's local header
+# costs about one block each.
+RANGE_BLOCK_SIZE = 2 ** 16
+
+
+def _read_category_zip(
+    fs,
+    path,
+    rem_outputs,
+    json_serializable=True,
+    selective=False,
+    cache=None,
+    metrics=NULL_SINK,
+):
+    """
+    Read rem_outputs from the zip at path. If selective is True and the
+    zip is not cached, only the byte ranges of rem_outputs are fetched.
+    The range requests happen while the members are read, so they are
+    part of the "unzip" timings.
+    """
+    res = cache.get(path) if cache is not None else None
+    if res is None and not selective:
+        res = _download(fs, path, metrics)
+        if cache is not None:
+            cache.put(path, res)
+    if res is not None:
+        zipfileobj = zipfile.ZipFile(io.BytesIO(res))
+        return _read_zip(zipfileobj, rem_outputs, json_serializable, metrics)
+    with fs.open(path, "rb", block_size=RANGE_BLOCK_SIZE, cache_type="readahead") as f:
+        zipfileobj = zipfile.ZipFile(f)
+        return _read_zip(zipfileobj, rem_outputs, json_serializable, metrics)
+
+
+def _read_blob(
+    fs, root, rem_output, json_serializable=True, cache=None, metrics=NULL_SINK
+):
+    path = f"{root}/{BLOB_PREFIX}/{rem_output['digest']}"
+    data = _cached_download(
+        fs, path, cache, metrics.bind(media_type=rem_output["media_type"])
+    )
+    data = _deserialize(rem_output, data, json_serializable, metrics)
+    return _local_output(rem_output, data)
+
+
+def _read_category(
+    fs,
+    root,
+    rem_category,
+    json_serializable=True,
+    outputs=None,
+    cache=None,
+    metrics=NULL_SINK,
+):
+    """
+    Read the outputs of one category of a remote result. See read.
+    """
+    rem_outputs = rem_category["outputs"]
+    if outputs is not None:
+        rem_outputs = _select_outputs(rem_outputs, outputs)
+    zipped = {}
+    for ziplocation, group in _zip_groups(rem_category, rem_outputs).items():
+        group_outputs = _read_category_zip(
+            fs,
+            f"{root}/{ziplocation}",
+            group,
+            json_serializable,
+            selective=outputs is not None,
+            cache=cache,
+            metrics=metrics,
+        )
+        zipped.update(zip(map(id, group), group_outputs))
+    return [
+        (
+            _read_blob(fs, root, rem_output, json_serializable, cache, metrics)
+            if "digest" in rem_output
+            else zipped[id(rem_output)]
+        )
+        for rem_output in rem_outputs
+    ]
+
+
+def _iter_category(
+    fs,
+    root,
+    rem_category,
+    json_serializable=True,
+    outputs=None,
+    cache=None,
+    metrics=NULL_SINK,
+    block_size=None,
+):
+    """
+    Yield the outputs of one category of a remote result one at a time.
+    Unless the zip is cached, it is read through a file that fetches
+    block_size bytes per request, so only about one block and the
+    current output are held in memory. See StorageClient.iter_read.
+    """
+    rem_outputs = rem_category["outputs"]
+    if outputs is not None:
+        rem_outputs = _select_outputs(rem_outputs, outputs)
+    # Runs of outputs in the same zip file are read through one file.
+    runs = itertools.groupby(
+        rem_outputs,
+        lambda rem_output: (
+            None if "digest" in rem_output else _ziplocation(rem_category, rem_output)
+        ),
+    )
+    for ziplocation, run in runs:
+        if ziplocation is None:
+            for rem_output in run:
+                yield _read_blob(
+                    fs, root, rem_output, json_serializable, cache, metrics
+                )
+            continue
+        path = f"{root}/{ziplocation}"
+        res = cache.get(path) if cache is not None else None
+        if res is not None:
+            f = io.BytesIO(res)
+        else:
+            kwargs = {} if block_size is None else {"block_size": block_size}
+            f = fs.open(path, "rb", cache_type="readahead", **kwargs)
+        with f:
+            yield from _iter_zip(
+                zipfile.ZipFile(f), list(run), json_serializable, metrics
+            )
+
+
+ReadResult = namedtuple("ReadResult", ["index", "result", "error"])
+
+
+async def _async_filesystem(protocol, **storage_options):
+    """
+    Create a filesystem for protocol that can be used from the running
+    event loop. Backends that do not implement fsspec's async interface,
+    like the local and memory filesystems, are used from a thread.
+
+    Async filesystems are bound to the loop, e.g. by gcsfs's HTTP
+    session, so fsspec's instance cache is skipped: its key is the same
+    for every new loop and would return instances of closed loops.
+    """
+    if getattr(fs.get_filesystem_class(protocol), "async_impl", False):
+        filesystem = fs.filesystem(
+            protocol,
+            asynchronous=True,
+            loop=asyncio.get_running_loop(),
+            skip_instance_cache=True,
+            **storage_options,
+        )
+        if hasattr(filesystem, "set_session"):
+            await filesystem.set_session()
+        return filesystem
+    return fs.filesystem(protocol, **storage_options)
+
+
+async def _aclose_filesystem(filesystem):
+    """
+    Close the HTTP session of an async filesystem like gcsfs's.
+    """
+    session = getattr(filesystem, "_session", None)
+    if session is not None and not getattr(session, "closed", True):
+        await session.close()
 
 
-def read(rem_result, json_serializable=True, protocol="gcs"):
-    s = time.time()
-    RemoteResult().load(rem_result)
-    read = {"renderable": [], "downloadable": []}
-    for category in rem_result:
-        with fs.open(
-            f"{protocol}://{BUCKET}/{rem_result[category]['ziplocation']}", "rb",
+async def _run_sync(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def _acat(filesystem, path):
+    if filesystem.async_impl:
+        return await filesystem._cat_file(path)
+    return await _run_sync(filesystem.cat_file, path)
+
+
+async def _apipe(filesystem, path, data):
+    if filesystem.async_impl:
+        return await filesystem._pipe_file(path, data)
+    return await _run_sync(filesystem.pipe_file, path, data)
+
+
+async def _atimed_cat(filesystem, path, metrics=NULL_SINK):
+    with metrics.timer("download") as timer:
+        data = await _acat(filesystem, path)
+        timer.nbytes = len(data)
+    return data
+
+
+async def _atimed(timer, aw):
+    """
+    Await aw in the block of timer.
+    """
+    with timer:
+        return await aw
+
+
+async def _acached_cat(filesystem, path, cache=None, metrics=NULL_SINK):
+    data = cache.get(path) if cache is not None else None
+    if data is None:
+        data = await _atimed_cat(filesystem, path, metrics)
+        if cache is not None:
+            cache.put(path, data)
+    return data
+
+
+async def _agather_all(aws, timeout=None):
+    """
+    Async version of _wait_all: run aws concurrently and return their
+    results. If any of them fails or they have not finished after
+    timeout seconds, the others are cancelled and the first exception
+    or TimeoutError is raised.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    if not tasks:
+        return []
+    _, not_done = await asyncio.wait(
+        tasks, timeout=timeout, return_when=asyncio.FIRST_EXCEPTION
+    )
+    for task in not_done:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+    if not_done:
+        raise TimeoutError(f"Requests did not finish within {timeout}s")
+    return [task.result() for task in tasks]
+
+
+async def _awrite_pics(filesystem, root, outputs, metrics=NULL_SINK, cache=None):
+    if not SCREENSHOT_ENABLED:
+        _screenshot_warning()
+        return
+    uploads = []
+    results = await ascreenshot_many(outputs, metrics=metrics, cache=cache)
+    for output, result in zip(outputs, results):
+        if result.error is not None:
+            print("failed to create screenshot for ", output["id"])
+            continue
+        pic_location = output.get("screenshot", f"{output['id']}.png")
+        timer = metrics.timer(
+            "upload", len(result.data), media_type=output["media_type"]
+        )
+        uploads.append(
+            _atimed(timer, _apipe(filesystem, f"{root}/{pic_location}", result.data))
+        )
+    await _agather_all(uploads)
+
+
+async def _aread_zip(
+    filesystem,
+    sync_fs,
+    path,
+    rem_outputs,
+    json_serializable,
+    selective,
+    cache,
+    metrics=NULL_SINK,
+):
+    res = cache.get(path) if cache is not None else None
+    if res is None and selective:
+        # Range reads of the selected members go through the sync
+        # interface in a thread.
+        return await _run_sync(
+            _read_category_zip,
+            sync_fs,
+            path,
+            rem_outputs,
+            json_serializable,
+            True,
+            cache,
+            metrics,
+        )
+    if res is None:
+        res = await _atimed_cat(filesystem, path, metrics)
+        if cache is not None:
+            cache.put(path, res)
+    zipfileobj = zipfile.ZipFile(io.BytesIO(res))
+    return await _run_sync(
+        _read_zip, zipfileobj, rem_outputs, json_serializable, metrics
+    )
+
+
+async def _aread_category(
+    filesystem,
+    sync_fs,
+    root,
+    rem_category,
+    rem_outputs,
+    json_serializable,
+    selective,
+    cache,
+    metrics=NULL_SINK,
+):
+    groups = _zip_groups(rem_category, rem_outputs)
+    digests = list(
+        dict.fromkeys(
+            rem_output["digest"] for rem_output in rem_outputs if "digest" in rem_output
+        )
+    )
+    reads = [
+        _acached_cat(filesystem, f"{root}/{BLOB_PREFIX}/{digest}", cache, metrics)
+        for digest in digests
+    ]
+    for ziplocation, group in groups.items():
+        reads.append(
+            _aread_zip(
+                filesystem,
+                sync_fs,
+                f"{root}/{ziplocation}",
+                group,
+                json_serializable,
+                selective,
+                cache,
+                metrics,
+            )
+        )
+    results = await _agather_all(reads)
+    blobs = dict(zip(digests, results))
+    zipped = {}
+    for group, group_outputs in zip(groups.values(), results[len(digests) :]):
+        zipped.update(zip(map(id, group), group_outputs))
+
+    outputs = []
+    for rem_output in rem_outputs:
+        if "digest" in rem_output:
+            data = _deserialize(
+                rem_output, blobs[rem_output["digest"]], json_serializable, metrics
+            )
+            outputs.append(_local_output(rem_output, data))
+        else:
+            outputs.append(zipped[id(rem_output)])
+    return outputs
+
+
+class StorageClient:
+    """
+    Reads and writes results in one bucket through one fsspec filesystem
+    instance, so that credentials are looked up once and connections
+    are reused by all requests.
+
+    bucket defaults to the BUCKET environment variable. block_size is
+    the chunk size of streaming uploads, max_workers the number of
+    uploads or downloads in flight and timeout the number of seconds to
+    wait for them before TimeoutError is raised. cache is an optional
+    ReadCache that is used by all reads. metrics is a MetricsSink that
+    receives the timings of the phases of each read and write; it
+    defaults to the sink set with configure_metrics. storage_options
+    are passed to the filesystem, for example a project or token for
+    gcs.
+
+    Uploads of at least multipart_threshold bytes are split into parts
+    of part_size bytes that are uploaded on part_workers threads and
+    joined with the backend's merge, e.g. GCS compose. Each part and
+    each staged upload is retried up to retries times. Backends without merge and a
+    multipart_threshold of None upload objects in one piece.
+
+    The outputs of a zip file are serialized and compressed on
+    pack_workers threads. Only zlib releases the GIL, so threads speed
+    up the compression but not the serialization. If pack_processes is
+    True, the outputs are packed on a pool of pack_workers processes
+    instead, which also runs the serialization in parallel, but the
+    outputs are pickled to the processes. This pays off for JSON, e.g.
+    bokeh plots, whose data pickles much faster than it serializes, and
+    not for text and binary outputs. The pool is started on first use
+    and stopped by close. The zip files are the same in all modes.
+
+    Screenshots are looked up in a ScreenshotCache before they are
+    rendered if screenshot_cache, a ReadCache that usually has a
+    directory, is given or share_screenshots is True. The latter also
+    looks for and stores the pictures under {SCREENSHOT_PREFIX}/rendered
+    in the bucket, so that all workers that write to it share them.
+
+    If staging_directory is given, writes are write-behind: the zip
+    files and pictures are staged in staging_directory and write returns
+    before they are uploaded. See UploadQueue. At most
+    max_staging_bytes are staged at a time. Use flush to wait for the
+    uploads. Clients in several processes may share staging_directory:
+    each client stages in its own locked subdirectory and only takes
+    over the objects of clients that were closed or whose process
+    exited.
+
+    Arguments of the methods that default to None fall back to the
+    client's settings.
+    """
+
+    def __init__(
+        self,
+        bucket=None,
+        protocol="gcs",
+        block_size=None,
+        max_workers=1,
+        timeout=None,
+        cache=None,
+        metrics=None,
+        staging_directory=None,
+        max_staging_bytes=2 ** 30,
+        multipart_threshold=MULTIPART_THRESHOLD,
+        part_size=PART_SIZE,
+        part_workers=4,
+        retries=3,
+        screenshot_cache=None,
+        share_screenshots=False,
+        pack_workers=1,
+        pack_processes=False,
+        **storage_options,
+    ):
+        self.bucket = bucket if bucket is not None else BUCKET
+        self.protocol = protocol
+        self.block_size = block_size
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.cache = cache
+        self.metrics = metrics
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.part_workers = part_workers
+        self.retries = retries
+        self.screenshot_cache = screenshot_cache
+        self.share_screenshots = share_screenshots
+        self.pack_workers = pack_workers
+        self.pack_processes = pack_processes
+        self._pack_pools = {}
+        if protocol == "file":
+            # Blobs and screenshots are stored under prefixes that are
+            # directories on the local filesystem.
+            storage_options.setdefault("auto_mkdir", True)
+        self.storage_options = storage_options
+        self._fs = None
+        # Async filesystems by event loop. They are dropped with their
+        # loop.
+        self._async_fs = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.uploads = None
+        if staging_directory is not None:
+            # Objects that were staged before a restart are queued
+            # again right away.
+            self.uploads = UploadQueue(
+                staging_directory,
+                self._upload_staged,
+                max_bytes=max_staging_bytes,
+                max_workers=max_workers,
+                retries=retries,
+                retry_delay=RETRY_DELAY,
+            )
+
+    @property
+    def fs(self):
+        """
+        The filesystem instance. It is created on first use so that
+        clients that are only used for validation do not need the
+        backend to be installed.
+        """
+        if self._fs is None:
+            with self._lock:
+                if self._fs is None:
+                    self._fs = fs.filesystem(self.protocol, **self.storage_options)
+        return self._fs
+
+    @property
+    def root(self):
+        return f"{self.protocol}://{self.bucket}"
+
+    async def _afs(self):
+        """
+        The async filesystem of the running event loop. It is created
+        on first use in each loop and reused by the coroutines of that
+        loop.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            filesystem = self._async_fs.get(loop)
+        if filesystem is not None:
+            return filesystem
+        created = await _async_filesystem(self.protocol, **self.storage_options)
+        with self._lock:
+            filesystem = self._async_fs.setdefault(loop, created)
+        if filesystem is not created:
+            # Another coroutine of the loop created one first.
+            await _aclose_filesystem(created)
+        return filesystem
+
+    async def aclose(self):
+        """
+        Close the async filesystem of the running event loop, e.g. the
+        HTTP session of gcsfs. Call it before a loop that used the
+        coroutine methods is closed. The next call in the loop creates a
+        new filesystem.
+        """
+        with self._lock:
+            filesystem = self._async_fs.pop(asyncio.get_running_loop(), None)
+        if filesystem is not None:
+            await _aclose_filesystem(filesystem)
+
+    def _metrics(self):
+        return self.metrics if self.metrics is not None else get_metrics_sink()
+
+    def _screenshot_cache(self):
+        if self.screenshot_cache is None and not self.share_screenshots:
+            return None
+        return ScreenshotCache(
+            self.screenshot_cache,
+            self.fs if self.share_screenshots else None,
+            f"{self.root}/{SCREENSHOT_PREFIX}/rendered",
+        )
+
+    def _upload_object(self, path, data, metrics=NULL_SINK, missing_only=False):
+        """
+        Upload data to path. If missing_only is True, nothing is
+        uploaded if path already exists. Large objects are uploaded in
+        parts if the backend can join them.
+        """
+        if missing_only and self.fs.exists(path):
+            return
+        if (
+            self.multipart_threshold is not None
+            and len(data) >= self.multipart_threshold
+            and _supports_multipart(self.fs)
+        ):
+            with metrics.timer("upload", len(data), multipart=True):
+                _multipart_upload(
+                    self.fs,
+                    path,
+                    data,
+                    self.part_size,
+                    self.part_workers,
+                    self.retries,
+                )
+            return
+        with metrics.timer("upload", len(data)):
+            _upload(self.fs, path, data)
+
+    def _upload_staged(self, path, data, task_id=None, missing_only=False):
+        metrics = self._metrics().bind(task_id=task_id, staged=True)
+        self._upload_object(path, data, metrics, missing_only)
+
+    def flush(self, task_id=None, timeout=None):
+        """
+        Wait for the staged uploads of task_id, or of all tasks if it is
+        None. The first upload error is raised. This returns right away
+        if the client does not stage uploads.
+        """
+        if self.uploads is not None:
+            self.uploads.flush(task_id, timeout or self.timeout)
+
+    def close(self):
+        """
+        Wait for the staged uploads and stop the upload threads and the
+        packing processes.
+        """
+        if self.uploads is not None:
+            self.uploads.close()
+        with self._lock:
+            pools, self._pack_pools = self._pack_pools, {}
+        for pool in pools.values():
+            pool.shutdown()
+
+    def _pack_executor(self, workers):
+        """
+        The process pool with workers processes if the client packs
+        on processes and workers is more than 1, otherwise None.
+        """
+        if not self.pack_processes or workers <= 1:
+            return None
+        with self._lock:
+            pool = self._pack_pools.get(workers)
+            if pool is None:
+                # Forking a process that runs upload threads is unsafe.
+                pool = self._pack_pools[workers] = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+        return pool
+
+    def write(
+        self,
+        task_id,
+        loc_result,
+        do_upload=True,
+        max_workers=None,
+        stream=False,
+        block_size=None,
+        dedupe=False,
+        compression=None,
+        validate="full",
+        tables=False,
+        pack_workers=None,
+    ):
+        """
+        Write the outputs in loc_result to storage. The renderable
+        outputs are screenshotted in one batch. The category zip files
+        and the screenshots are uploaded on a thread pool with at most
+        max_workers uploads in flight. If any upload fails, the
+        remaining uploads are cancelled and the exception is raised.
+
+        If stream is True, the zip files are written straight into the
+        remote files and uploaded in chunks of block_size bytes as they
+        are built instead of being buffered in memory first.
+
+        If dedupe is True, each output is stored once as a blob under
+        the SHA-256 digest of its serialized data instead of in the
+        category zip files. The remote outputs refer to the digests and
+        blobs and screenshots that already exist are not uploaded or
+        rendered again. The screenshot locations are added to the remote
+        outputs.
+
+        The zip members are compressed according to COMPRESSION_POLICY.
+        compression is a dict of Serializer.ext to (compress_type,
+        compresslevel) pairs that overrides entries of the policy.
+
+        validate is "full", "fast" or "none". "fast" only checks the
+        structure of loc_result and does not touch the output data.
+
+        If tables is True, CSV outputs are also stored as columnar
+        tables next to the zip files, so that read_table can fetch pages
+        of them without downloading the whole output. See encode_table.
+
+        pack_workers is the number of threads, or processes if the
+        client has pack_processes, that serialize and compress the
+        outputs of a zip file. See StorageClient.
+
+        If the client stages uploads, the zip files are written straight
+        into the staging directory and the result cannot be read before
+        flush(task_id) returns. stream, max_workers and block_size do not
+        apply to staged uploads.
+
+        The timings of all phases are tagged with task_id and, except
+        for validation, with the category.
+        """
+        return self._write(
+            task_id,
+            loc_result,
+            task_id,
+            do_upload,
+            max_workers,
+            stream,
+            block_size,
+            dedupe,
+            compression,
+            validate,
+            tables,
+            pack_workers,
+        )
+
+    def _write(
+        self,
+        task_id,
+        loc_result,
+        name,
+        do_upload,
+        max_workers,
+        stream,
+        block_size,
+        dedupe,
+        compression,
+        validate,
+        tables,
+        pack_workers,
+    ):
+        """
+        Write loc_result to zip files named {name}_{category}.zip. The
+        categories that are missing from loc_result are skipped. See
+        write.
+        """
+        metrics = self._metrics().bind(task_id=task_id)
+        with metrics.timer("validation"):
+            _validate(loc_result, validate=validate)
+        max_workers = max_workers or self.max_workers
+        block_size = block_size or self.block_size
+        pack_workers = pack_workers or self.pack_workers
+        pack_executor = self._pack_executor(pack_workers)
+        filesystem = self.fs if do_upload else None
+        rem_result = {}
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        def upload(path, data, metrics, missing_only=False):
+            if self.uploads is not None:
+                self.uploads.put(path, data, task_id=task_id, missing_only=missing_only)
+                return None
+            return executor.submit(
+                self._upload_object, path, data, metrics, missing_only
+            )
+
+        try:
+            futures = []
+            for category in ["renderable", "downloadable"]:
+                if category not in loc_result:
+                    continue
+                ziplocation = f"{name}_{category}.zip"
+                path = f"{self.root}/{ziplocation}"
+                pics = [] if do_upload and category == "renderable" else None
+                cmetrics = metrics.bind(category=category)
+                if dedupe:
+                    rem_outputs, blob_futures = _write_blobs(
+                        executor,
+                        upload,
+                        filesystem,
+                        self.root,
+                        loc_result[category],
+                        pics,
+                        do_upload=do_upload,
+                        metrics=cmetrics,
+                    )
+                    futures += blob_futures
+                    rem_result[category] = {"outputs": rem_outputs}
+                else:
+                    if do_upload and self.uploads is not None:
+                        with self.uploads.open(path, task_id=task_id) as f:
+                            rem_outputs = _write_zip(
+                                f,
+                                loc_result[category],
+                                pics,
+                                compression,
+                                cmetrics,
+                                pack_workers,
+                                pack_executor,
+                            )
+                    elif do_upload and stream:
+                        # The upload of a streamed zip overlaps with the
+                        # serialization and zip phases.
+                        rem_outputs = []
+                        with cmetrics.timer("upload", stream=True):
+                            _stream_upload(
+                                filesystem,
+                                path,
+                                lambda f: rem_outputs.extend(
+                                    _write_zip(
+                                        f,
+                                        loc_result[category],
+                                        pics,
+                                        compression,
+                                        cmetrics,
+                                        pack_workers,
+                                        pack_executor,
+                                    )
+                                ),
+                                block_size=block_size,
+                            )
+                    else:
+                        buff = io.BytesIO()
+                        rem_outputs = _write_zip(
+                            buff,
+                            loc_result[category],
+                            pics,
+                            compression,
+                            cmetrics,
+                            pack_workers,
+                            pack_executor,
+                        )
+                        if do_upload:
+                            futures.append(upload(path, buff.getvalue(), cmetrics))
+                    rem_result[category] = {
+                        "ziplocation": ziplocation,
+                        "outputs": rem_outputs,
+                    }
+                if tables and do_upload:
+                    futures += _write_tables(
+                        upload,
+                        self.root,
+                        name,
+                        loc_result[category],
+                        rem_result[category]["outputs"],
+                        cmetrics,
+                    )
+                if pics:
+                    futures += _write_pics(
+                        upload, self.root, pics, cmetrics, self._screenshot_cache()
+                    )
+            _wait_all(
+                [future for future in futures if future is not None], self.timeout
+            )
+        finally:
+            # Uploads that are still running after a timeout are not
+            # waited for.
+            executor.shutdown(wait=False, cancel_futures=True)
+        return rem_result
+
+    def append(
+        self,
+        task_id,
+        rem_result,
+        new_outputs,
+        do_upload=True,
+        max_workers=None,
+        stream=False,
+        block_size=None,
+        dedupe=False,
+        compression=None,
+        validate="full",
+        tables=False,
+        pack_workers=None,
+    ):
+        """
+        Add new_outputs, a local result whose categories may be missing,
+        to the stored result rem_result of task_id and return the merged
+        remote result. rem_result is not changed.
+
+        The new outputs of each category are written to a new segment
+        zip file, {task_id}-{segment id}_{category}.zip, and the zip
+        files that are already stored are not rewritten or downloaded,
+        so the upload only costs as much as the new outputs. Each new
+        remote output refers to its segment with its own ziplocation and
+        read, iter_read and read_many read the merged result like any
+        other. New renderable outputs are screenshotted as in write.
+
+        See write for the other arguments.
+        """
+        with self._metrics().timer("validation", task_id=task_id):
+            _validate(rem_result, remote=True, validate=validate)
+        segment = f"{task_id}-{uuid.uuid4().hex[:12]}"
+        new_result = self._write(
+            task_id,
+            {category: outputs for category, outputs in new_outputs.items() if outputs},
+            segment,
+            do_upload,
+            max_workers,
+            stream,
+            block_size,
+            dedupe,
+            compression,
+            validate,
+            tables,
+            pack_workers,
+        )
+        merged = {
+            category: dict(rem_category, outputs=list(rem_category["outputs"]))
+            for category, rem_category in rem_result.items()
+        }
+        for category, rem_category in new_result.items():
+            if category not in merged:
+                merged[category] = rem_category
+                continue
+            for rem_output in rem_category["outputs"]:
+                if "digest" not in rem_output:
+                    rem_output["ziplocation"] = rem_category["ziplocation"]
+                merged[category]["outputs"].append(rem_output)
+        return merged
+
+    def write_pic(self, output):
+        """
+        Screenshot output and upload the picture to {output id}.png.
+        """
+        if not SCREENSHOT_ENABLED:
+            _screenshot_warning()
+            return
+        metrics = self._metrics()
+        (result,) = screenshot_many(
+            [output], metrics=metrics, cache=self._screenshot_cache()
+        )
+        if result.error is not None:
+            print("failed to create screenshot for ", output["id"])
+            return
+        with metrics.timer("upload", len(result.data), media_type=output["media_type"]):
+            _upload(self.fs, f"{self.root}/{output['id']}.png", result.data)
+
+    def read(
+        self,
+        rem_result,
+        json_serializable=True,
+        outputs=None,
+        cache=None,
+        validate="full",
+    ):
+        """
+        Read the outputs in rem_result from storage.
+
+        outputs is an optional list of output ids or titles. If it is
+        given, only those outputs are returned and only the zip's
+        central directory and the byte ranges of the selected members
+        are downloaded. Categories without selected outputs are not
+        downloaded at all.
+
+        cache is an optional ReadCache. Zip files and blobs are looked
+        up in the cache before they are downloaded and added to it
+        afterwards.
+
+        Outputs that were written with write(dedupe=True) are read from
+        their content addressed blobs.
+
+        validate is "full", "fast" or "none". See _validate.
+
+        The timings of the phases after validation are tagged with the
+        category.
+        """
+        metrics = self._metrics()
+        with metrics.timer("validation"):
+            _validate(rem_result, remote=True, validate=validate)
+        cache = cache or self.cache
+        read = {"renderable": [], "downloadable": []}
+        for category in rem_result:
+            read[category] = _read_category(
+                self.fs,
+                self.root,
+                rem_result[category],
+                json_serializable,
+                outputs,
+                cache,
+                metrics.bind(category=category),
+            )
+        return read
+
+    def iter_read(
+        self,
+        rem_result,
+        json_serializable=True,
+        outputs=None,
+        cache=None,
+        validate="full",
+    ):
+        """
+        Yield (category, output) for the outputs in rem_result one at a
+        time, in the order of rem_result. Each output is downloaded
+        and deserialized only when it is requested and nothing keeps a
+        reference to it afterwards, so consumers that handle the outputs
+        one by one run in about the memory of the largest output instead
+        of all of them.
+
+        The zip files are read through files that fetch block_size bytes
+        per request instead of being downloaded in full. Zip files that
+        are in the cache are read from it, but they are not added to it.
+
+        See read for the other arguments.
+        """
+        metrics = self._metrics()
+        with metrics.timer("validation"):
+            _validate(rem_result, remote=True, validate=validate)
+        cache = cache or self.cache
+        for category in rem_result:
+            for output in _iter_category(
+                self.fs,
+                self.root,
+                rem_result[category],
+                json_serializable,
+                outputs,
+                cache,
+                metrics.bind(category=category),
+                self.block_size,
+            ):
+                yield category, output
+
+    def read_many(
+        self,
+        rem_results,
+        json_serializable=True,
+        outputs=None,
+        cache=None,
+        validate="full",
+        max_workers=8,
+    ):
+        """
+        Read many remote results concurrently and yield a
+        ReadResult(index, result, error) for each of them as soon as it
+        is ready. index is the position of the remote result in
+        rem_results.
+
+        The zip files of all results are fetched on a thread pool with
+        at most max_workers downloads in flight, through the client's
+        filesystem instance whose connections are shared by all
+        downloads. A failed read does not stop the others: its result is
+        None and error is the exception that was raised.
+
+        See read for the other arguments.
+        """
+        cache = cache or self.cache
+        metrics = self._metrics()
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        pending = {}
+        results = {}
+        try:
+            for index, rem_result in enumerate(rem_results):
+                try:
+                    with metrics.timer("validation"):
+                        _validate(rem_result, remote=True, validate=validate)
+                except ValidationError as e:
+                    yield ReadResult(index, None, e)
+                    continue
+                results[index] = {"renderable": [], "downloadable": []}
+                for category in rem_result:
+                    future = executor.submit(
+                        _read_category,
+                        self.fs,
+                        self.root,
+                        rem_result[category],
+                        json_serializable,
+                        outputs,
+                        cache,
+                        metrics.bind(category=category),
+                    )
+                    pending[future] = (index, category)
+                if not rem_result:
+                    yield ReadResult(index, results.pop(index), None)
+
+            remaining = {}
+            for index, _ in pending.values():
+                remaining[index] = remaining.get(index, 0) + 1
+            for future in as_completed(list(pending), timeout=self.timeout):
+                index, category = pending.pop(future)
+                if index not in results:
+                    # Another category of this result already failed.
+                    continue
+                if future.exception() is not None:
+                    del results[index]
+                    yield ReadResult(index, None, future.exception())
+                    continue
+                results[index][category] = future.result()
+                remaining[index] -= 1
+                if remaining[index] == 0:
+                    yield ReadResult(index, results.pop(index), None)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def read_screenshot(self, screenshot_id, cache=None):
+        if not screenshot_id.endswith(".png"):
+            screenshot_id += ".png"
+        return _cached_download(
+            self.fs,
+            f"{self.root}/{screenshot_id}",
+            cache or self.cache,
+            self._metrics(),
+        )
+
+    def read_chunks(
+        self,
+        rem_result,
+        output,
+        json_serializable=True,
+        chunk_size=CHUNK_SIZE,
+        validate="full",
+    ):
+        """
+        Yield the data of one output of rem_result in chunks instead of
+        returning it as one string, for callers that only forward it,
+        e.g. to an HTTP response. output is the output's id or title.
+        Only the byte range of the output is downloaded and it is
+        deserialized in chunks of about chunk_size bytes. See
+        Serializer.iter_deserialize for the type of the chunks.
+        """
+        _validate(rem_result, remote=True, validate=validate)
+        rem_category, rem_output = _find_output(rem_result, output)
+        serializer = get_serializer(rem_output["media_type"])
+        if "digest" in rem_output:
+            path = f"{self.root}/{BLOB_PREFIX}/{rem_output['digest']}"
+            with self.fs.open(path, "rb") as f:
+                yield from serializer.iter_deserialize(f, json_serializable, chunk_size)
+            return
+        path = f"{self.root}/{_ziplocation(rem_category, rem_output)}"
+        with self.fs.open(
+            path, "rb", block_size=RANGE_BLOCK_SIZE, cache_type="readahead"
         ) as f:
-            res = f.read()
+            with zipfile.ZipFile(f).open(rem_output["filename"]) as member:
+                yield from serializer.iter_deserialize(
+                    member, json_serializable, chunk_size
+                )
 
-        buff = io.BytesIO(res)
-        zipfileobj = zipfile.ZipFile(buff)
+    def read_table(
+        self,
+        rem_result,
+        output,
+        offset=0,
+        limit=None,
+        columns=None,
+        validate="full",
+    ):
+        """
+        Read limit rows starting at row offset of a CSV output and return
+        a Table(columns, rows, num_rows). The first row of the CSV is its
+        header and is not counted. output is the output's id or title.
+        columns is an optional list of column names. All rows and
+        columns are read if limit and columns are None.
 
-        for rem_output in rem_result[category]["outputs"]:
-            ser = get_serializer(rem_output["media_type"])
-            rem_data = ser.deserialize(
-                zipfileobj.read(rem_output["filename"]), json_serializable
+        For outputs that were written with write(tables=True), only the
+        table's footer and the row groups and columns that are needed
+        are downloaded. Other CSV outputs are read in full.
+        """
+        _validate(rem_result, remote=True, validate=validate)
+        rem_category, rem_output = _find_output(rem_result, output)
+        if rem_output["media_type"] != "CSV":
+            raise ValueError(f"{output} is not a CSV output.")
+        metrics = self._metrics().bind(media_type="CSV")
+        if "table" not in rem_output:
+            (loc_output,) = _read_category(
+                self.fs,
+                self.root,
+                dict(rem_category, outputs=[rem_output]),
+                json_serializable=False,
+                cache=self.cache,
+                metrics=metrics,
             )
-            read[category].append(
-                {
-                    "id": rem_output.get("id", None),
-                    "title": rem_output["title"],
-                    "media_type": rem_output["media_type"],
-                    "data": rem_data,
-                }
+            return table_from_csv(loc_output["data"], offset, limit, columns)
+        with metrics.timer("download", table=True):
+            return _read_stored_table(
+                self.fs,
+                f"{self.root}/{rem_output['table']}",
+                offset,
+                limit,
+                columns,
             )
-    f = time.time()
-    print(f"Read finished in {f-s}s")
-    return read
 
+    async def awrite(
+        self,
+        task_id,
+        loc_result,
+        do_upload=True,
+        compression=None,
+        validate="full",
+    ):
+        """
+        Coroutine version of write. The zip files are built in a thread
+        so that the event loop is not blocked. Both zip files and all
+        screenshots are uploaded concurrently through fsspec's async
+        interface. If any upload fails, the others are cancelled and the
+        exception is raised.
+        """
+        metrics = self._metrics().bind(task_id=task_id)
+        with metrics.timer("validation"):
+            _validate(loc_result, validate=validate)
+        filesystem = await self._afs() if do_upload else None
+        rem_result = {}
+        uploads = []
+        for category in ["renderable", "downloadable"]:
+            if category not in loc_result:
+                continue
+            ziplocation = f"{task_id}_{category}.zip"
+            pics = [] if do_upload and category == "renderable" else None
+            cmetrics = metrics.bind(category=category)
+            buff = io.BytesIO()
+            rem_outputs = await _run_sync(
+                _write_zip,
+                buff,
+                loc_result[category],
+                pics,
+                compression,
+                cmetrics,
+                self.pack_workers,
+                self._pack_executor(self.pack_workers),
+            )
+            rem_result[category] = {"ziplocation": ziplocation, "outputs": rem_outputs}
+            if do_upload:
+                data = buff.getvalue()
+                uploads.append(
+                    _atimed(
+                        cmetrics.timer("upload", len(data)),
+                        _apipe(filesystem, f"{self.root}/{ziplocation}", data),
+                    )
+                )
+            if pics:
+                uploads.append(
+                    _awrite_pics(
+                        filesystem,
+                        self.root,
+                        pics,
+                        cmetrics,
+                        self._screenshot_cache(),
+                    )
+                )
+        await _agather_all(uploads, self.timeout)
+        return rem_result
 
-def read_screenshot(screenshot_id, protocol="gcs"):
-    if not screenshot_id.endswith(".png"):
-        screenshot_id += ".png"
-    with fs.open(f"{protocol}://{BUCKET}/{screenshot_id}", "rb") as f:
-        return f.read()
+    async def aread(
+        self,
+        rem_result,
+        json_serializable=True,
+        outputs=None,
+        cache=None,
+        validate="full",
+    ):
+        """
+        Coroutine version of read. The zip files and blobs of both
+        categories are downloaded concurrently through fsspec's async
+        interface and unzipped in a thread.
+        """
+        metrics = self._metrics()
+        with metrics.timer("validation"):
+            _validate(rem_result, remote=True, validate=validate)
+        cache = cache or self.cache
+        filesystem = await self._afs()
+        categories = []
+        reads = []
+        for category in rem_result:
+            rem_outputs = rem_result[category]["outputs"]
+            if outputs is not None:
+                rem_outputs = _select_outputs(rem_outputs, outputs)
+            categories.append(category)
+            reads.append(
+                _aread_category(
+                    filesystem,
+                    self.fs,
+                    self.root,
+                    rem_result[category],
+                    rem_outputs,
+                    json_serializable,
+                    outputs is not None,
+                    cache,
+                    metrics.bind(category=category),
+                )
+            )
+        read = {"renderable": [], "downloadable": []}
+        read.update(zip(categories, await _agather_all(reads, self.timeout)))
+        return read
+
+    async def aread_screenshot(self, screenshot_id, cache=None):
+        """
+        Coroutine version of read_screenshot.
+        """
+        if not screenshot_id.endswith(".png"):
+            screenshot_id += ".png"
+        filesystem = await self._afs()
+        return await _acached_cat(
+            filesystem,
+            f"{self.root}/{screenshot_id}",
+            cache or self.cache,
+            self._metrics(),
+        )
+
+
+_CLIENTS = {}
+
+
+def get_client(protocol="gcs"):
+    """
+    Return the default client for protocol. It writes to the bucket in
+    the BUCKET environment variable and is shared by the module level
+    functions below.
+    """
+    key = (protocol, BUCKET)
+    client = _CLIENTS.get(key)
+    if client is None:
+        client = _CLIENTS.setdefault(key, StorageClient(BUCKET, protocol))
+    return client
+
+
+def write(task_id, loc_result, do_upload=True, protocol="gcs", **kwargs):
+    """
+    Write loc_result with the default client. See StorageClient.write.
+    """
+    return get_client(protocol).write(task_id, loc_result, do_upload, **kwargs)
+
+
+def append(task_id, rem_result, new_outputs, protocol="gcs", **kwargs):
+    """
+    Add new_outputs to rem_result with the default client. See
+    StorageClient.append.
+    """
+    return get_client(protocol).append(task_id, rem_result, new_outputs, **kwargs)
+
+
+def write_pic(fs, output, protocol="gcs"):
+    """
+    Screenshot output with the default client. fs is not used and only
+    kept for backwards compatibility. See StorageClient.write_pic.
+    """
+    return get_client(protocol).write_pic(output)
+
+
+def read(rem_result, json_serializable=True, protocol="gcs", **kwargs):
+    """
+    Read rem_result with the default client. See StorageClient.read.
+    """
+    return get_client(protocol).read(rem_result, json_serializable, **kwargs)
+
+
+def iter_read(rem_result, json_serializable=True, protocol="gcs", **kwargs):
+    """
+    Read rem_result one output at a time with the default client. See
+    StorageClient.iter_read.
+    """
+    return get_client(protocol).iter_read(rem_result, json_serializable, **kwargs)
+
+
+def read_many(rem_results, json_serializable=True, protocol="gcs", **kwargs):
+    """
+    Read rem_results with the default client. See
+    StorageClient.read_many.
+    """
+    return get_client(protocol).read_many(rem_results, json_serializable, **kwargs)
+
+
+def read_chunks(rem_result, output, protocol="gcs", **kwargs):
+    """
+    Read one output in chunks with the default client. See
+    StorageClient.read_chunks.
+    """
+    return get_client(protocol).read_chunks(rem_result, output, **kwargs)
+
+
+def read_table(rem_result, output, protocol="gcs", **kwargs):
+    """
+    Read a page of a CSV output with the default client. See
+    StorageClient.read_table.
+    """
+    return get_client(protocol).read_table(rem_result, output, **kwargs)
+
+
+def read_screenshot(screenshot_id, protocol="gcs", cache=None):
+    return get_client(protocol).read_screenshot(screenshot_id, cache)
 
 
 def add_screenshot_links(rem_result):
     for rem_output in rem_result["renderable"]["outputs"]:
-        rem_output["screenshot"] = f"{rem_output['id']}.png"
+        # Outputs written with write(dedupe=True) already have a link.
+        rem_output.setdefault("screenshot", f"{rem_output['id']}.png")
     return rem_result
+
+
+async def awrite(task_id, loc_result, do_upload=True, protocol="gcs", **kwargs):
+    """
+    Coroutine version of write. See StorageClient.awrite.
+    """
+    return await get_client(protocol).awrite(task_id, loc_result, do_upload, **kwargs)
+
+
+async def aread(rem_result, json_serializable=True, protocol="gcs", **kwargs):
+    """
+    Coroutine version of read. See StorageClient.aread.
+    """
+    return await get_client(protocol).aread(rem_result, json_serializable, **kwargs)
+
+
+async def aread_screenshot(screenshot_id, protocol="gcs", cache=None):
+    """
+    Coroutine version of read_screenshot.
+    """
+    return await get_client(protocol).aread_screenshot(screenshot_id, cache)
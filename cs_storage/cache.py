@@ -0,0 +1,207 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class ReadCache:
+    """
+    Two tiered cache for objects read from storage. Result zips and
+    screenshots are stored under task ID or UUID based keys and are
+    never rewritten, so cached copies never go stale.
+
+    An in-memory LRU cache with a budget of max_memory_bytes sits in
+    front of an optional on-disk cache in directory with a budget of
+    max_disk_bytes. When a budget is exceeded, the least recently used
+    entries are evicted. Objects that are larger than a tier's budget
+    are not stored in that tier.
+
+    Hit, miss and eviction counts are available from stats().
+    """
+
+    def __init__(
+        self,
+        max_memory_bytes=2 ** 28,
+        directory=None,
+        max_disk_bytes=2 ** 30,
+    ):
+        self.max_memory_bytes = max_memory_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = dict(
+            memory_hits=0,
+            disk_hits=0,
+            misses=0,
+            memory_evictions=0,
+            disk_evictions=0,
+        )
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._disk_bytes = sum(size for _, _, size in self._disk_entries())
+
+    def get(self, key):
+        """
+        Return the data stored under key or None if it is not cached.
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return self._memory[key]
+        data = self._get_disk(key)
+        with self._lock:
+            if data is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["disk_hits"] += 1
+            self._put_memory(key, data)
+        return data
+
+    def put(self, key, data):
+        """
+        Store data under key in both tiers.
+        """
+        with self._lock:
+            self._put_memory(key, data)
+        self._put_disk(key, data)
+
+    def stats(self):
+        """
+        Return the hit, miss and eviction counts and the current size of
+        each tier in bytes.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["hits"] = stats["memory_hits"] + stats["disk_hits"]
+            stats["memory_bytes"] = self._memory_bytes
+            stats["disk_bytes"] = self._disk_bytes
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            for path, _, _ in self._disk_entries():
+                os.remove(path)
+            self._disk_bytes = 0
+
+    def _put_memory(self, key, data):
+        if len(data) > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self._stats["memory_evictions"] += 1
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def _disk_entries(self):
+        if self.directory is None:
+            return []
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith("tmp"):
+                stat = entry.stat()
+                entries.append((entry.path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def _get_disk(self, key):
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # The modification time tracks when an entry was last used.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def _put_disk(self, key, data):
+        if self.directory is None or len(data) > self.max_disk_bytes:
+            return
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        # Write to a temporary file first so that readers in other
+        # threads or processes never see a partial entry.
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix="tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._disk_bytes += len(data)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[1])
+        self._disk_bytes = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self._disk_bytes -= size
+            self._stats["disk_evictions"] += 1
+
+
+class ScreenshotCache:
+    """
+    Cache of screenshots keyed by screenshot_key, the digest of the
+    rendered template and the viewport. Identical outputs render to the
+    same page, so their pictures can be reused across tasks.
+
+    Lookups try local, a ReadCache that usually has a directory, and
+    then the object {prefix}/{key}.png on the filesystem fs if fs is
+    given, e.g. a prefix in the results bucket that is shared by all
+    workers. Pictures that are found in fs are added to local. Pictures
+    that are put are added to local and uploaded to fs.
+    """
+
+    def __init__(self, local=None, fs=None, prefix=None):
+        if fs is not None and prefix is None:
+            raise ValueError("prefix is required if fs is given.")
+        self.local = local
+        self.fs = fs
+        self.prefix = prefix
+
+    def get(self, key):
+        """
+        Return the picture stored under key or None if it is not cached.
+        """
+        data = self.local.get(key) if self.local is not None else None
+        if data is None and self.fs is not None:
+            try:
+                data = self.fs.cat_file(self._path(key))
+            except FileNotFoundError:
+                return None
+            if self.local is not None:
+                self.local.put(key, data)
+        return data
+
+    def put(self, key, data):
+        if self.local is not None:
+            self.local.put(key, data)
+        if self.fs is not None:
+            self.fs.pipe_file(self._path(key), data)
+
+    def _path(self, key):
+        return f"{self.prefix}/{key}.png"
@@ -0,0 +1,146 @@
+import time
+from collections import namedtuple
+
+# A timing of one phase of a read or write. seconds is the wall time
+# spent in the phase and nbytes the number of bytes it handled, or None
+# if that is not known. tags is a dict like {"task_id": ..., "category":
+# ..., "media_type": ...}. If the phase raised, tags["error"] is the
+# name of the exception class.
+Timing = namedtuple("Timing", ["phase", "seconds", "nbytes", "tags"])
+
+PHASES = (
+    "validation",
+    "serialization",
+    "zip",
+    "screenshot",
+    "upload",
+    "download",
+    "unzip",
+)
+
+
+class MetricsSink:
+    """
+    Receives a Timing for each phase of a read or write. Subclasses set
+    enabled to True and implement emit. This base class is disabled: it
+    hands out a shared no-op timer, so that instrumented code does not
+    read the clock or build any Timing objects.
+    """
+
+    enabled = False
+
+    def emit(self, timing):
+        pass
+
+    def timer(self, phase, nbytes=None, **tags):
+        """
+        Return a context manager that emits the time spent in its
+        block. Set nbytes or tags on it in the block if the byte count
+        or a tag is only known there.
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, phase, nbytes, tags)
+
+    def bind(self, **tags):
+        """
+        Return a sink that adds tags to every timing emitted through it.
+        """
+        if not self.enabled:
+            return self
+        return _BoundSink(self, tags)
+
+
+class CallbackSink(MetricsSink):
+    """
+    Pass each Timing to callback. callback may be called from several
+    threads at once.
+    """
+
+    enabled = True
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def emit(self, timing):
+        self.callback(timing)
+
+
+class RecordingSink(MetricsSink):
+    """
+    Keep all timings in the timings list.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.timings = []
+
+    def emit(self, timing):
+        self.timings.append(timing)
+
+
+class _BoundSink(MetricsSink):
+    enabled = True
+
+    def __init__(self, sink, tags):
+        self.sink = sink
+        self.tags = tags
+
+    def emit(self, timing):
+        self.sink.emit(timing._replace(tags=dict(self.tags, **timing.tags)))
+
+
+class _Timer:
+    __slots__ = ("sink", "phase", "nbytes", "tags", "_start")
+
+    def __init__(self, sink, phase, nbytes, tags):
+        self.sink = sink
+        self.phase = phase
+        self.nbytes = nbytes
+        self.tags = tags
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._start
+        tags = self.tags
+        if exc_type is not None:
+            tags = dict(tags, error=exc_type.__name__)
+        self.sink.emit(Timing(self.phase, seconds, self.nbytes, tags))
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    nbytes = property(lambda self: None, lambda self, value: None)
+    tags = property(lambda self: {}, lambda self, value: None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+NULL_SINK = MetricsSink()
+
+_SINK = NULL_SINK
+
+
+def configure_metrics(sink=None):
+    """
+    Set the sink that is used by clients that were not given one,
+    including the default clients of the module level functions. None
+    restores the no-op sink.
+    """
+    global _SINK
+    _SINK = sink if sink is not None else NULL_SINK
+
+
+def get_metrics_sink():
+    return _SINK
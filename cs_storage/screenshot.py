@@ -1,6 +1,13 @@
 import asyncio
+import atexit
+import contextlib
+import hashlib
 import os
-import tempfile
+import threading
+import warnings
+from collections import namedtuple
+
+from .metrics import NULL_SINK
 
 try:
     # These dependencies are optional. The storage component may be used
@@ -18,11 +25,25 @@ except ImportError:
 
 CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
 
+# Maximum time in milliseconds to wait for the template to signal that
+# the output has been rendered before the screenshot is taken anyway.
+RENDER_TIMEOUT = 10000
+
+# Size of the browser window. Pictures are clipped to it.
+VIEWPORT = dict(width=1920, height=1080)
+
 
 class ScreenshotError(Exception):
     pass
 
 
+# cached is True if data was taken from a screenshot cache instead of
+# being rendered.
+ScreenshotResult = namedtuple(
+    "ScreenshotResult", ["data", "error", "cached"], defaults=(False,)
+)
+
+
 def get_template():
     if not SCREENSHOT_ENABLED:
         return None
@@ -42,11 +63,283 @@ def write_template(output):
     return TEMPLATE.render(**kwargs)
 
 
-async def _screenshot(template_path, pic_path):
+# The template puts the output's ID, which is new on every write, into
+# the page. Keys are computed from the page of the output with this ID
+# instead, so that outputs with equal data share their screenshot.
+KEY_OUTPUT_ID = "cs-output"
+
+
+def screenshot_key(html, viewport=VIEWPORT):
+    """
+    Key of the screenshot of the rendered template html. It is the
+    SHA-256 digest of everything that determines the picture, so outputs
+    that render to the same page share their screenshot. Render html
+    with the ID KEY_OUTPUT_ID.
+    """
+    h = hashlib.sha256(f"{viewport['width']}x{viewport['height']}\n".encode())
+    h.update(html.encode("utf-8"))
+    return h.hexdigest()
+
+
+class BrowserPool:
+    """
+    A long-lived pool of headless browsers that is shared across
+    screenshot calls. Launching Chromium often takes longer than
+    rendering an output, so the browsers and their pages are reused
+    instead of being launched for every screenshot.
+
+    pyppeteer objects are bound to the event loop that created them.
+    The pool runs its own event loop on a background thread and all
+    browser work is submitted to that loop, so the pool may be used
+    from any thread.
+
+    Parameters:
+        - size: number of browsers in the pool.
+        - pages_per_browser: number of pages that may be open on a
+          single browser at the same time.
+        - max_pages: number of pages a browser serves before it is
+          restarted. This keeps memory leaks in Chromium in check.
+        - health_check_timeout: seconds to wait for a browser to respond
+          to a health check.
+        - launch_kwargs: extra keyword arguments passed to launch.
+    """
+
+    def __init__(
+        self,
+        size=1,
+        pages_per_browser=4,
+        max_pages=100,
+        health_check_timeout=5,
+        launch_kwargs=None,
+    ):
+        self.size = size
+        self.pages_per_browser = pages_per_browser
+        self.max_pages = max_pages
+        self.health_check_timeout = health_check_timeout
+        self.launch_kwargs = dict(
+            handleSIGINT=False,
+            handleSIGTERM=False,
+            handleSIGHUP=False,
+            args=["--no-sandbox"],
+        )
+        self.launch_kwargs.update(launch_kwargs or {})
+        self.launches = 0
+        self._loop = None
+        self._thread = None
+        self._slots = []
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever,
+                    name="cs-storage-browser-pool",
+                    daemon=True,
+                )
+                self._thread.start()
+            return self._loop
+
+    def run(self, coro):
+        """
+        Run coro on the pool's event loop and block until it is done.
+        """
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    async def arun(self, coro):
+        """
+        Run coro on the pool's event loop and wait for it from another
+        event loop without blocking it.
+        """
+        loop = self._ensure_loop()
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+    async def _setup(self):
+        # asyncio primitives must be created on the pool's event loop.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size * self.pages_per_browser)
+            self._slots = [_BrowserSlot() for _ in range(self.size)]
+
+    async def _launch(self, slot):
+        await self._close_browser(slot)
+        slot.browser = await launch(**self.launch_kwargs)
+        slot.served = 0
+        self.launches += 1
+
+    async def _close_browser(self, slot):
+        browser, slot.browser, slot.pages = slot.browser, None, []
+        if browser is not None:
+            try:
+                await browser.close()
+            except Exception:
+                # The browser may already be dead.
+                pass
+
+    @contextlib.asynccontextmanager
+    async def page(self):
+        """
+        Check out a page from the pool. The page is returned to the pool
+        when the block exits, or closed if the block raised.
+        """
+        await self._setup()
+        await self._semaphore.acquire()
+        slot = min(
+            (slot for slot in self._slots if slot.active < self.pages_per_browser),
+            key=lambda slot: slot.active,
+        )
+        slot.active += 1
+        page = None
+        try:
+            async with slot.lock:
+                restart = (
+                    slot.browser is None
+                    or not slot.healthy()
+                    or (slot.served >= self.max_pages and slot.active == 1)
+                )
+                if restart:
+                    await self._launch(slot)
+                while slot.pages and page is None:
+                    page = slot.pages.pop()
+                    if page.isClosed():
+                        page = None
+                if page is None:
+                    page = await slot.browser.newPage()
+            yield page
+        except Exception:
+            if page is not None and not page.isClosed():
+                try:
+                    await page.close()
+                except Exception:
+                    pass
+            raise
+        else:
+            slot.pages.append(page)
+        finally:
+            slot.served += 1
+            slot.active -= 1
+            self._semaphore.release()
+
+    async def _health_check(self):
+        await self._setup()
+        restarted = 0
+        for slot in self._slots:
+            if slot.browser is None:
+                continue
+            try:
+                await asyncio.wait_for(
+                    slot.browser.version(), timeout=self.health_check_timeout
+                )
+                healthy = slot.healthy()
+            except Exception:
+                healthy = False
+            if not healthy:
+                async with slot.lock:
+                    await self._launch(slot)
+                restarted += 1
+        return restarted
+
+    def health_check(self):
+        """
+        Ping each running browser and restart the ones that do not
+        respond. Returns the number of browsers that were restarted.
+        """
+        return self.run(self._health_check())
+
+    async def _close(self):
+        for slot in self._slots:
+            await self._close_browser(slot)
+
+    def close(self):
+        """
+        Close all browsers and stop the pool's event loop.
+        """
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        loop.close()
+        self._slots, self._semaphore, self._thread = [], None, None
+
+
+class _BrowserSlot:
+    def __init__(self):
+        self.browser = None
+        self.pages = []
+        self.active = 0
+        self.served = 0
+        self.lock = asyncio.Lock()
+
+    def healthy(self):
+        process = self.browser.process
+        return process is None or process.poll() is None
+
+
+POOL_CONFIG = {}
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool():
+    """
+    Get the shared browser pool, creating it with POOL_CONFIG if needed.
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = BrowserPool(**POOL_CONFIG)
+        return _POOL
+
+
+def configure_pool(**kwargs):
+    """
+    Replace the shared browser pool with one created from kwargs. See
+    BrowserPool for the available options.
+    """
+    shutdown_pool()
+    POOL_CONFIG.clear()
+    POOL_CONFIG.update(kwargs)
+
+
+def shutdown_pool():
+    """
+    Close the shared browser pool. It is re-created on the next screenshot.
     """
-    Use pyppeteer, a python port of puppeteer, to open the
-    template at template_path and take a screenshot of the
-    output that is rendered within it.
+    global _POOL
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.close()
+
+
+atexit.register(shutdown_pool)
+
+
+async def _wait_for_render(page, render_timeout):
+    """
+    Wait for the template to set window.csRenderComplete. If the signal
+    does not arrive within render_timeout milliseconds, e.g. because a
+    CDN script failed to load, the screenshot is taken anyway.
+    """
+    try:
+        await page.waitForFunction(
+            "window.csRenderComplete === true", {"timeout": render_timeout}
+        )
+    except asyncio.TimeoutError:
+        warnings.warn(f"Render signal not received within {render_timeout}ms.")
+
+
+async def _screenshot(page, html, render_timeout=RENDER_TIMEOUT):
+    """
+    Use pyppeteer, a python port of puppeteer, to load the rendered
+    template html into page and take a screenshot of the output that
+    is rendered within it. The template signals when the output has
+    been rendered and the picture is returned as bytes.
 
     The output is rendered within a Bootstrap card element.
     This element is only as big as the elements that it contains.
@@ -59,16 +352,11 @@ async def _screenshot(template_path, pic_path):
     puppeteer should be used for creating these screenshots. The
     downside of using puppeteer is that it is written in nodejs.
     """
-    browser = await launch(
-        handleSIGINT=False,
-        handleSIGTERM=False,
-        handleSIGHUP=False,
-        args=["--no-sandbox"],
-    )
-    page = await browser.newPage()
-    await page.goto(f"file://{template_path}")
-    await page.setViewport(dict(width=1920, height=1080))
-    await page.waitFor(1000)
+    await page.setViewport(VIEWPORT)
+    # Pages are reused, so clear the signal left by the previous output.
+    await page.evaluate("() => { window.csRenderComplete = false; }")
+    await page.setContent(html)
+    await _wait_for_render(page, render_timeout)
     element = await page.querySelector("#output")
     if element is None:
         raise ScreenshotError("Unable to take screenshot.")
@@ -76,38 +364,122 @@ async def _screenshot(template_path, pic_path):
     clip = dict(
         x=boundingbox["x"],
         y=boundingbox["y"],
-        width=min(boundingbox["width"], 1920),
-        height=min(boundingbox["height"], 1080),
+        width=min(boundingbox["width"], VIEWPORT["width"]),
+        height=min(boundingbox["height"], VIEWPORT["height"]),
+    )
+    return await page.screenshot(type="png", clip=clip)
+
+
+async def _use_cache(method, *args):
+    """
+    Call a method of a screenshot cache in a thread, because it may do
+    disk or network I/O, so that the pool's event loop stays free for
+    rendering. The cache is optional, so its errors are only warned
+    about and None is returned.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(None, method, *args)
+    except Exception as e:
+        warnings.warn(f"Screenshot cache {method.__name__} failed: {e!r}")
+        return None
+
+
+async def _pooled_screenshot(pool, output, debug, render_timeout, metrics, cache):
+    cached = None
+    try:
+        with metrics.timer("screenshot", media_type=output["media_type"]) as timer:
+            html = write_template(output)
+            if debug:
+                with open(f'{output["title"]}.html', "w") as f:
+                    f.write(html)
+            if cache is not None:
+                key = screenshot_key(write_template(dict(output, id=KEY_OUTPUT_ID)))
+                cached = await _use_cache(cache.get, key)
+                timer.tags = dict(timer.tags, cached=cached is not None)
+            if cached is not None:
+                pic_bytes = cached
+            else:
+                async with pool.page() as page:
+                    pic_bytes = await _screenshot(page, html, render_timeout)
+                if cache is not None:
+                    await _use_cache(cache.put, key, pic_bytes)
+            timer.nbytes = len(pic_bytes)
+    except Exception as e:
+        if not isinstance(e, ScreenshotError):
+            e = ScreenshotError(f"Unable to take screenshot: {e!r}")
+        return ScreenshotResult(None, e)
+    return ScreenshotResult(pic_bytes, None, cached is not None)
+
+
+async def _screenshot_many(pool, outputs, debug, render_timeout, metrics, cache):
+    return await asyncio.gather(
+        *(
+            _pooled_screenshot(pool, output, debug, render_timeout, metrics, cache)
+            for output in outputs
+        )
     )
-    await page.screenshot(path=f"{pic_path}", type_="png", clip=clip)
-    await browser.close()
 
 
-def screenshot(output, debug=False):
+def screenshot_many(
+    outputs, debug=False, render_timeout=None, metrics=NULL_SINK, cache=None
+):
     """
-    Create screenshot of outputs. The intermediate results are
-    written to temporary files and a picture, represented as a
+    Create screenshots of a list of outputs. The outputs are rendered
+    concurrently in separate pages of the shared browser pool and the
+    pictures are kept in memory.
+
+    Returns a list of ScreenshotResult(data, error) in the same order
+    as outputs. A failed screenshot does not fail the batch: its data
+    is None and error is the ScreenshotError that was raised.
+
+    render_timeout is the maximum time in milliseconds to wait for an
+    output to finish rendering. It defaults to RENDER_TIMEOUT.
+
+    metrics is a MetricsSink that receives a "screenshot" timing for
+    each output.
+
+    cache is an optional object with get(key) and put(key, data)
+    methods, e.g. a ScreenshotCache. Pictures are looked up under
+    screenshot_key of the template rendered with KEY_OUTPUT_ID before a
+    page is rendered and added afterwards. The timings of outputs that were looked up
+    are tagged with cached=True or cached=False.
+    """
+    if not SCREENSHOT_ENABLED:
+        return None
+    if render_timeout is None:
+        render_timeout = RENDER_TIMEOUT
+    pool = get_pool()
+    return pool.run(
+        _screenshot_many(pool, outputs, debug, render_timeout, metrics, cache)
+    )
+
+
+async def ascreenshot_many(
+    outputs, debug=False, render_timeout=None, metrics=NULL_SINK, cache=None
+):
+    """
+    Coroutine version of screenshot_many for callers that run their own
+    event loop. The pages are still rendered on the pool's event loop.
+    """
+    if not SCREENSHOT_ENABLED:
+        return None
+    if render_timeout is None:
+        render_timeout = RENDER_TIMEOUT
+    pool = get_pool()
+    return await pool.arun(
+        _screenshot_many(pool, outputs, debug, render_timeout, metrics, cache)
+    )
+
+
+def screenshot(output, debug=False, render_timeout=None):
+    """
+    Create screenshot of outputs. The picture, represented as a
     stream of bytes, is returned.
     """
     if not SCREENSHOT_ENABLED:
         return None
-    html = write_template(output)
-    with tempfile.NamedTemporaryFile(suffix=".html") as temp:
-        if debug:
-            with open(f'{output["title"]}.html', "w") as f:
-                f.write(html)
-        temp.write(html.encode("utf-8"))
-        temp.seek(0)
-        template_path = temp.name
-        with tempfile.NamedTemporaryFile(suffix=".png") as pic:
-            pic_path = pic.name
-            try:
-                loop = asyncio.get_running_loop()
-            except RuntimeError:
-                loop = asyncio.get_event_loop()
-
-            loop.run_until_complete(
-                _screenshot(template_path, pic_path)
-            )
-            pic_bytes = pic.read()
-    return pic_bytes
+    (result,) = screenshot_many([output], debug=debug, render_timeout=render_timeout)
+    if result.error is not None:
+        raise result.error
+    return result.data
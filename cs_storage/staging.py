@@ -0,0 +1,272 @@
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Queues on Windows do not recover the objects of other queues.
+    fcntl = None
+
+
+class UploadQueue:
+    """
+    Write-behind queue that stages objects in a local directory and
+    uploads them on a thread pool, so that writers do not wait for the
+    network.
+
+    Each staged object is a data file and a metadata file with the
+    object's destination path. Both are synced to disk and the metadata
+    file is written last, so only completely staged objects are ever
+    uploaded. Objects are removed from the directory once they are
+    uploaded.
+
+    Several queues, e.g. of the worker processes of one node, may share
+    directory. Each queue stages its objects in its own subdirectory
+    and holds a lock on it while it is open. Objects that are still
+    staged when a queue is closed or its process exits are uploaded by
+    the next queue that is created on the same directory.
+
+    upload(path, data, **meta) uploads one object. It is retried up to
+    retries times with an exponential backoff that starts at retry_delay
+    seconds. Objects that still fail stay staged and their error is
+    raised by flush.
+
+    put and open block while max_bytes or more are staged.
+    """
+
+    def __init__(
+        self,
+        directory,
+        upload,
+        max_bytes=2 ** 30,
+        max_workers=4,
+        retries=3,
+        retry_delay=0.5,
+    ):
+        self.directory = directory
+        self.upload = upload
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._staged_bytes = 0
+        self._cond = threading.Condition()
+        # Uploads that are in flight or that failed and have not been
+        # reported by flush yet, mapped to their task IDs.
+        self._futures = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        os.makedirs(directory, exist_ok=True)
+        # The directory only gets its queue- name once it is locked, so
+        # that other queues never take it for the directory of a closed
+        # queue.
+        path = tempfile.mkdtemp(dir=directory, prefix="tmp")
+        self._lock_file = _lock(path)
+        self._path = os.path.join(directory, f"queue-{os.path.basename(path)[3:]}")
+        os.rename(path, self._path)
+        self._recover()
+
+    @property
+    def staged_bytes(self):
+        with self._cond:
+            return self._staged_bytes
+
+    def put(self, path, data, task_id=None, **meta):
+        """
+        Stage data for upload to path. task_id and meta are passed to
+        upload and task_id can be used to flush the task's uploads.
+        """
+        with self.open(path, task_id, **meta) as f:
+            f.write(data)
+
+    @contextmanager
+    def open(self, path, task_id=None, **meta):
+        """
+        Stage the data that is written to the yielded file for upload to
+        path. It is queued when the block exits without an exception.
+        """
+        self._wait_for_space()
+        name = uuid.uuid4().hex
+        fd, tmp_path = tempfile.mkstemp(dir=self._path, prefix="tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                yield f
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._data_path(name))
+        except BaseException:
+            _remove(tmp_path)
+            raise
+        meta = dict(meta, path=path, task_id=task_id)
+        fd, tmp_path = tempfile.mkstemp(dir=self._path, prefix="tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._meta_path(name))
+        self._submit(name, meta)
+
+    def flush(self, task_id=None, timeout=None):
+        """
+        Wait until the uploads of task_id, or all uploads if it is None,
+        are finished. If any of them failed, the first error is raised.
+        If they have not finished after timeout seconds, TimeoutError is
+        raised.
+        """
+        with self._cond:
+            futures = [
+                future
+                for future, future_task_id in self._futures.items()
+                if task_id is None or future_task_id == task_id
+            ]
+        _, not_done = wait(futures, timeout=timeout)
+        if not_done:
+            raise TimeoutError(
+                f"{len(not_done)} uploads did not finish within {timeout}s"
+            )
+        with self._cond:
+            for future in futures:
+                self._futures.pop(future, None)
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+    def close(self, wait=True):
+        """
+        Stop the upload threads. The queue's directory is removed if no
+        objects are staged in it. Otherwise it is unlocked, so that the
+        next queue on the same directory uploads them.
+        """
+        self._executor.shutdown(wait=wait)
+        if wait and not any(
+            entry.name.endswith(".data") for entry in os.scandir(self._path)
+        ):
+            shutil.rmtree(self._path, ignore_errors=True)
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _data_path(self, name):
+        return os.path.join(self._path, f"{name}.data")
+
+    def _meta_path(self, name):
+        return os.path.join(self._path, f"{name}.json")
+
+    def _recover(self):
+        """
+        Move the objects of the queue directories in directory that are
+        not locked, i.e. whose queue was closed or whose process exited,
+        into this queue's directory and queue them. The files of objects
+        that were not staged completely are removed with the old
+        directories.
+        """
+        for entry in os.scandir(self.directory):
+            if (
+                not entry.name.startswith("queue-")
+                or not entry.is_dir()
+                or entry.path == self._path
+            ):
+                continue
+            lock_file = _lock(entry.path)
+            if lock_file is None:
+                continue
+            try:
+                self._adopt(entry.path)
+            finally:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                lock_file.close()
+
+    def _adopt(self, path):
+        try:
+            entries = sorted(os.scandir(path), key=lambda e: e.stat().st_mtime)
+        except FileNotFoundError:
+            # Another queue adopted and removed the directory first.
+            return
+        names = {entry.name for entry in entries}
+        for entry in entries:
+            name, ext = os.path.splitext(entry.name)
+            if ext == ".json" and f"{name}.data" in names:
+                os.replace(os.path.join(path, f"{name}.data"), self._data_path(name))
+                os.replace(entry.path, self._meta_path(name))
+                with open(self._meta_path(name)) as f:
+                    self._submit(name, json.load(f))
+
+    def _wait_for_space(self):
+        with self._cond:
+            while self._staged_bytes >= self.max_bytes:
+                in_flight = [future for future in self._futures if not future.done()]
+                if not in_flight:
+                    # Only failed uploads are left, so waiting would
+                    # never end.
+                    errors = [future.exception() for future in self._futures]
+                    if errors:
+                        raise errors[0]
+                    return
+                self._cond.wait()
+
+    def _submit(self, name, meta):
+        size = os.path.getsize(self._data_path(name))
+        with self._cond:
+            self._staged_bytes += size
+            future = self._executor.submit(self._upload, name, meta, size)
+            self._futures[future] = meta.get("task_id")
+        future.add_done_callback(self._done)
+
+    def _upload(self, name, meta, size):
+        with open(self._data_path(name), "rb") as f:
+            data = f.read()
+        meta = dict(meta)
+        path = meta.pop("path")
+        for attempt in itertools.count():
+            try:
+                self.upload(path, data, **meta)
+                break
+            except Exception:
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self.retry_delay * 2 ** attempt)
+        # The metadata file goes first, so that an interrupted removal
+        # leaves an incomplete object that is discarded on recovery.
+        _remove(self._meta_path(name))
+        _remove(self._data_path(name))
+        with self._cond:
+            self._staged_bytes -= size
+
+    def _done(self, future):
+        with self._cond:
+            if future.exception() is None:
+                self._futures.pop(future, None)
+            self._cond.notify_all()
+
+
+def _lock(path):
+    """
+    Lock the queue directory path. Returns the open lock file, which
+    holds the lock until it is closed, or None if another queue holds
+    it or the directory was removed.
+    """
+    if fcntl is None:
+        return None
+    try:
+        lock_file = open(os.path.join(path, "lock"), "a")
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
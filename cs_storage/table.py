@@ -0,0 +1,170 @@
+import csv
+import io
+import json
+import struct
+import zlib
+from collections import namedtuple
+
+# Rows of a paged read. columns are the names of the selected columns,
+# rows lists of their cells as strings and num_rows the number of data
+# rows in the whole table.
+Table = namedtuple("Table", ["columns", "rows", "num_rows"])
+
+# Number of rows per row group. A paged read downloads the selected
+# columns of every row group that overlaps the page.
+ROW_GROUP_SIZE = 10000
+
+# Tables start and end with this header.
+TABLE_MAGIC = b"CSTABLE1"
+
+# Number of bytes at the end of a table that are fetched by the first
+# request of a read. The footer is usually within them, so that it does
+# not take a second request.
+FOOTER_READ_SIZE = 2 ** 16
+
+_TRAILER = struct.Struct("<Q")
+
+
+def _parse_csv(text):
+    """
+    Split CSV text into its header and data rows. Returns None if the
+    rows are not all as long as the header, because such a CSV cannot
+    be stored by column.
+    """
+    reader = csv.reader(io.StringIO(text, newline=""))
+    header = next(reader, None)
+    if header is None:
+        return None
+    rows = list(reader)
+    if any(len(row) != len(header) for row in rows):
+        return None
+    return header, rows
+
+
+def encode_table(text, row_group_size=ROW_GROUP_SIZE):
+    """
+    Encode CSV text as a columnar table or return None if it cannot be
+    stored by column.
+
+    The rows are split into groups of row_group_size rows and each
+    column of a group is stored as a deflated JSON list of its cells.
+    A footer after the column chunks has the column names, the number
+    of rows and the byte range of each chunk, so that a reader can
+    fetch the chunks of selected rows and columns with range requests:
+
+        TABLE_MAGIC, chunks, footer JSON, footer size, TABLE_MAGIC
+    """
+    parsed = _parse_csv(text)
+    if parsed is None:
+        return None
+    header, rows = parsed
+    parts = [TABLE_MAGIC]
+    offset = len(TABLE_MAGIC)
+    row_groups = []
+    for start in range(0, len(rows), row_group_size):
+        group = rows[start : start + row_group_size]
+        chunks = []
+        for column in zip(*group):
+            chunk = zlib.compress(json.dumps(column).encode(), 1)
+            parts.append(chunk)
+            chunks.append([offset, len(chunk)])
+            offset += len(chunk)
+        row_groups.append({"num_rows": len(group), "columns": chunks})
+    footer = json.dumps(
+        {"columns": header, "num_rows": len(rows), "row_groups": row_groups}
+    ).encode()
+    parts += [footer, _TRAILER.pack(len(footer)), TABLE_MAGIC]
+    return b"".join(parts)
+
+
+def read_footer(fs, path):
+    """
+    Read the footer of the table at path. This takes one request for
+    the size and one or two range requests.
+    """
+    size = fs.size(path)
+    start = max(size - FOOTER_READ_SIZE, 0)
+    tail = fs.cat_file(path, start=start, end=size)
+    end = len(tail) - len(TABLE_MAGIC)
+    if tail[end:] != TABLE_MAGIC:
+        raise ValueError(f"{path} is not a table.")
+    (footer_size,) = _TRAILER.unpack_from(tail, end - _TRAILER.size)
+    footer_end = end - _TRAILER.size
+    if footer_size <= footer_end:
+        footer = tail[footer_end - footer_size : footer_end]
+    else:
+        footer_end += start
+        footer = fs.cat_file(path, start=footer_end - footer_size, end=footer_end)
+    return json.loads(footer)
+
+
+def _select(all_columns, columns):
+    if columns is None:
+        return list(range(len(all_columns)))
+    missing = [column for column in columns if column not in all_columns]
+    if missing:
+        raise KeyError(f"Unknown columns: {', '.join(map(str, missing))}")
+    return [all_columns.index(column) for column in columns]
+
+
+def _pages(row_groups, offset, limit):
+    """
+    Yield (index, first, last) for the row groups that overlap the rows
+    offset to offset + limit, where first and last are the bounds of
+    the selected rows within the group.
+    """
+    stop = None if limit is None else offset + limit
+    group_start = 0
+    for index, group in enumerate(row_groups):
+        group_stop = group_start + group["num_rows"]
+        first = max(offset, group_start)
+        last = group_stop if stop is None else min(stop, group_stop)
+        if first < last:
+            yield index, first - group_start, last - group_start
+        group_start = group_stop
+
+
+def read_table(fs, path, offset=0, limit=None, columns=None):
+    """
+    Read limit rows starting at row offset of the selected columns from
+    the table at path. All columns are read if columns is None. Only
+    the footer and the chunks of the selected row groups and columns
+    are downloaded. They are fetched in one call to fs.cat_ranges, which
+    runs the range requests concurrently on async filesystems.
+    """
+    footer = read_footer(fs, path)
+    indexes = _select(footer["columns"], columns)
+    pages = list(_pages(footer["row_groups"], offset, limit))
+    ranges = [
+        footer["row_groups"][index]["columns"][column]
+        for index, _, _ in pages
+        for column in indexes
+    ]
+    chunks = iter(
+        fs.cat_ranges(
+            [path] * len(ranges),
+            [start for start, _ in ranges],
+            [start + size for start, size in ranges],
+        )
+    )
+    rows = []
+    for _, first, last in pages:
+        cells = [json.loads(zlib.decompress(next(chunks))) for _ in indexes]
+        rows.extend(map(list, zip(*(column[first:last] for column in cells))))
+    return Table([footer["columns"][i] for i in indexes], rows, footer["num_rows"])
+
+
+def table_from_csv(text, offset=0, limit=None, columns=None):
+    """
+    Select rows and columns from CSV text like read_table does from a
+    stored table. This is used for outputs that have no table.
+    """
+    reader = csv.reader(io.StringIO(text, newline=""))
+    header = next(reader, [])
+    indexes = _select(header, columns)
+    rows = list(reader)
+    stop = None if limit is None else offset + limit
+    page = [
+        [row[i] if i < len(row) else "" for i in indexes] for row in rows[offset:stop]
+    ]
+    return Table([header[i] for i in indexes], page, len(rows))
@@ -0,0 +1,67 @@
+import os
+
+import cs_storage
+
+
+def test_memory_lru():
+    cache = cs_storage.ReadCache(max_memory_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    assert cache.get("a") == b"aaaa"
+    # "b" is the least recently used entry.
+    cache.put("c", b"cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"aaaa"
+    assert cache.get("c") == b"cccc"
+    # Entries larger than the budget are not cached.
+    cache.put("d", b"d" * 11)
+    assert cache.get("d") is None
+
+    stats = cache.stats()
+    assert stats["hits"] == stats["memory_hits"] == 3
+    assert stats["misses"] == 2
+    assert stats["memory_evictions"] == 1
+    assert stats["memory_bytes"] == 8
+
+
+def test_disk_tier(tmp_path):
+    cache = cs_storage.ReadCache(
+        max_memory_bytes=4, directory=str(tmp_path), max_disk_bytes=10
+    )
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    # "a" was evicted from memory but is still on disk.
+    assert cache.get("a") == b"aaaa"
+    assert cache.stats()["disk_hits"] == 1
+
+    os.utime(cache._path("b"), (0, 0))
+    cache.put("c", b"cccc")
+    stats = cache.stats()
+    assert stats["disk_evictions"] == 1
+    assert stats["disk_bytes"] == 8
+
+    # The disk tier survives restarts.
+    cache = cs_storage.ReadCache(directory=str(tmp_path), max_disk_bytes=10)
+    assert cache.stats()["disk_bytes"] == 8
+    assert cache.get("a") == b"aaaa"
+    assert cache.get("b") is None
+    assert cache.get("c") == b"cccc"
+
+
+def test_clear(tmp_path, monkeypatch):
+    (tmp_path / "notes.md").write_text("notes")
+    monkeypatch.chdir(tmp_path)
+    # A cache without a directory does not touch the working directory.
+    cache = cs_storage.ReadCache()
+    cache.put("a", b"aaaa")
+    cache.clear()
+    assert cache.get("a") is None
+    assert os.listdir(tmp_path) == ["notes.md"]
+
+    cache = cs_storage.ReadCache(directory=str(tmp_path / "cache"))
+    cache.put("a", b"aaaa")
+    cache.clear()
+    assert cache.get("a") is None
+    assert cache.stats()["disk_bytes"] == 0
+    assert os.listdir(tmp_path / "cache") == []
+    assert sorted(os.listdir(tmp_path)) == ["cache", "notes.md"]
@@ -1,7 +1,15 @@
+import asyncio
 import io
 import json
 import os
+import threading
+import tracemalloc
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 
+import fsspec
+import fsspec.asyn
+import fsspec.implementations.memory
 import pytest
 from marshmallow import exceptions
 
@@ -85,6 +93,64 @@ def test_JSONSerializer():
     assert act == {"hello": "world"}
 
 
+@pytest.fixture
+def json_settings(monkeypatch):
+    monkeypatch.setattr(cs_storage, "JSON_SETTINGS", dict(cs_storage.JSON_SETTINGS))
+
+
+@pytest.mark.parametrize("backend", ["json", "orjson"])
+def test_binary_json(json_settings, memory_bucket, backend):
+    if backend == "orjson":
+        pytest.importorskip("orjson")
+    ser = cs_storage.JSONSerializer("json")
+    doc = {
+        "x": [i / 7 for i in range(100)],
+        "y": list(range(-50, 50)),
+        "flags": [True, False] * 50,
+        "mixed": [1, 2.0] * 50,
+        "nan": [float("nan"), float("inf"), -0.0] * 30,
+        "short": [0.5, 1.5],
+        "nested": [{"data": {"top": [1.0] * 64}}],
+        "image": {"__ndarray__": "AAECAwQFBgc=", "dtype": "uint8", "shape": [8]},
+        "text": "hello",
+        "none": None,
+    }
+    plain = ser.serialize(doc)
+    cs_storage.configure_json(backend, binary_arrays=True)
+    binary = ser.serialize(doc)
+    assert binary.startswith(cs_storage.BINARY_JSON_MAGIC)
+    assert len(binary) < len(plain)
+    # Compare the JSON text, because NaN != NaN.
+    assert json.dumps(ser.deserialize(binary)) == json.dumps(doc)
+    assert [type(item) for item in ser.deserialize(binary)["mixed"][:2]] == [
+        int,
+        float,
+    ]
+    text = "".join(ser.iter_deserialize(io.BytesIO(binary), chunk_size=7))
+    assert json.dumps(json.loads(text)) == json.dumps(doc)
+
+    # Plain documents are still read and written without binary arrays.
+    assert json.dumps(ser.deserialize(plain)) == json.dumps(doc)
+    cs_storage.configure_json()
+    assert ser.serialize(doc) == plain
+    assert json.dumps(ser.deserialize(binary)) == json.dumps(doc)
+
+    # Documents with the placeholder key are stored as text.
+    cs_storage.configure_json(backend, binary_arrays=True)
+    doc = {"__cs_buffer__": 0, "x": [1.0] * 100}
+    assert ser.deserialize(ser.serialize(doc)) == doc
+
+    loc_res = {
+        "renderable": [{"media_type": "bokeh", "title": "plot", "data": doc}],
+        "downloadable": [],
+    }
+    rem_res = cs_storage.write("123", loc_res, protocol="memory")
+    assert cs_storage.read(rem_res, protocol="memory")["renderable"][0]["data"] == doc
+
+    with pytest.raises(ValueError):
+        cs_storage.configure_json("simplejson")
+
+
 def test_text_serializer():
     ser = cs_storage.TextSerializer("txt")
 
@@ -159,6 +225,41 @@ def exp_loc_res(png, jpg, bokeh_plot):
     }
 
 
+@pytest.fixture
+def memory_bucket(monkeypatch):
+    """
+    Point cs_storage at a bucket on fsspec's in-memory filesystem so that
+    the read and write paths can be tested without network access.
+    """
+    monkeypatch.setattr(cs_storage, "BUCKET", "cs-storage-test")
+    mem_fs = fsspec.filesystem("memory")
+    yield mem_fs
+    if mem_fs.exists("/cs-storage-test"):
+        mem_fs.rm("/cs-storage-test", recursive=True)
+
+
+@pytest.fixture
+def simple_loc_res(png):
+    return {
+        "renderable": [
+            {"media_type": "table", "title": "table stuff", "data": "<table/>"},
+            {"media_type": "PNG", "title": "PNG data", "data": png},
+        ],
+        "downloadable": [
+            {"media_type": "CSV", "title": "CSV file", "data": "comma,sep,values\n"},
+            {"media_type": "MP4", "title": "MP4 data", "data": b"MP4 bytes"},
+            {"media_type": "Markdown", "title": "md", "data": "**hello world**"},
+        ],
+    }
+
+
+def without_ids(loc_res):
+    return {
+        category: [{k: v for k, v in output.items() if k != "id"} for output in outputs]
+        for category, outputs in loc_res.items()
+    }
+
+
 def test_cs_storage(exp_loc_res):
     dummy_uuid = "c7a65ad2-0c2c-45d7-b0f7-d9fd524c49b3"
     task_id = "1868c4a7-b03c-4fe4-ab45-0aa95c0bfa53"
@@ -195,6 +296,585 @@ def test_cs_storage(exp_loc_res):
     )
 
 
+def test_concurrent_write(memory_bucket, simple_loc_res):
+    task_id = "1868c4a7-b03c-4fe4-ab45-0aa95c0bfa53"
+    rem_res = cs_storage.write(
+        task_id, simple_loc_res, protocol="memory", max_workers=4
+    )
+    assert memory_bucket.exists(f"/cs-storage-test/{task_id}_renderable.zip")
+    assert memory_bucket.exists(f"/cs-storage-test/{task_id}_downloadable.zip")
+    loc_res = cs_storage.read(rem_res, json_serializable=False, protocol="memory")
+    assert without_ids(loc_res) == without_ids(simple_loc_res)
+
+
+def test_concurrent_write_failure(memory_bucket, simple_loc_res, monkeypatch):
+    upload = cs_storage._upload
+
+    def flaky_upload(fs, path, data):
+        if path.endswith("_downloadable.zip"):
+            raise OSError("upload failed")
+        return upload(fs, path, data)
+
+    monkeypatch.setattr(cs_storage, "_upload", flaky_upload)
+    with pytest.raises(OSError, match="upload failed"):
+        cs_storage.write("123", simple_loc_res, protocol="memory", max_workers=4)
+
+
+def test_write_screenshots(memory_bucket, simple_loc_res, monkeypatch):
+    def screenshot_many(outputs, **kwargs):
+        assert [output["media_type"] for output in outputs] == ["table", "PNG"]
+        return [
+            cs_storage.ScreenshotResult(b"table pic", None),
+            cs_storage.ScreenshotResult(None, cs_storage.ScreenshotError()),
+        ]
+
+    monkeypatch.setattr(cs_storage, "SCREENSHOT_ENABLED", True)
+    monkeypatch.setattr(cs_storage, "screenshot_many", screenshot_many)
+    rem_res = cs_storage.write("123", simple_loc_res, protocol="memory")
+    table_id, png_id = [output["id"] for output in rem_res["renderable"]["outputs"]]
+    assert memory_bucket.cat(f"/cs-storage-test/{table_id}.png") == b"table pic"
+    assert not memory_bucket.exists(f"/cs-storage-test/{png_id}.png")
+
+
+def test_streaming_write(memory_bucket, simple_loc_res):
+    rem_res = cs_storage.write(
+        "123", simple_loc_res, protocol="memory", stream=True, block_size=64
+    )
+    loc_res = cs_storage.read(rem_res, json_serializable=False, protocol="memory")
+    assert without_ids(loc_res) == without_ids(simple_loc_res)
+
+
+def test_streaming_write_failure(memory_bucket, simple_loc_res):
+    simple_loc_res["downloadable"][0]["data"] = b"CSV data must be text"
+    with pytest.raises(AttributeError):
+        cs_storage.write("123", simple_loc_res, protocol="memory", stream=True)
+    assert memory_bucket.exists("/cs-storage-test/123_renderable.zip")
+    assert not memory_bucket.exists("/cs-storage-test/123_downloadable.zip")
+
+
+class BufferedMemoryFile(fsspec.spec.AbstractBufferedFile):
+    """
+    Non-seekable write file that, like gcsfs's, uploads its blocks as
+    they are written and commits the object when it is closed. Reads
+    are range requests that are recorded in the filesystem's reads.
+    """
+
+    def _initiate_upload(self):
+        self.parts = []
+
+    def _upload_chunk(self, final=False):
+        self.parts.append(self.buffer.getvalue())
+        if final:
+            fsspec.implementations.memory.MemoryFile(
+                self.fs, self.fs._strip_protocol(self.path), b"".join(self.parts)
+            ).commit()
+        return True
+
+    def discard(self):
+        self.fs.discarded.append(self.path)
+
+    def _fetch_range(self, start, end):
+        data = self.fs.cat_file(self.path, start, end)
+        self.fs.reads.append((self.path, len(data)))
+        return data
+
+
+class BufferedMemoryFileSystem(fsspec.implementations.memory.MemoryFileSystem):
+    """
+    In-memory filesystem whose files are BufferedMemoryFiles. It shares
+    memory://'s store.
+    """
+
+    protocol = "bufferedmemory"
+    discarded = []
+    reads = []
+
+    @classmethod
+    def _strip_protocol(cls, path):
+        if path.startswith("bufferedmemory://"):
+            path = path[len("bufferedmemory://") :]
+        return super()._strip_protocol(path)
+
+    def _open(self, path, mode="rb", block_size=None, autocommit=True, **kwargs):
+        return BufferedMemoryFile(
+            self, path, mode, block_size or 2 ** 10, autocommit, **kwargs
+        )
+
+
+@pytest.fixture
+def buffered_memory(monkeypatch):
+    fsspec.register_implementation(
+        "bufferedmemory", BufferedMemoryFileSystem, clobber=True
+    )
+    monkeypatch.setattr(BufferedMemoryFileSystem, "discarded", [])
+    monkeypatch.setattr(BufferedMemoryFileSystem, "reads", [])
+    return BufferedMemoryFileSystem
+
+
+def test_streaming_write_failure_keeps_object(
+    memory_bucket, buffered_memory, simple_loc_res
+):
+    client = cs_storage.StorageClient(protocol="bufferedmemory")
+    rem_res = client.write("123", simple_loc_res, stream=True)
+    path = "/cs-storage-test/123_downloadable.zip"
+    stored = memory_bucket.cat_file(path)
+
+    simple_loc_res["downloadable"][0]["data"] = b"CSV data must be text"
+    with pytest.raises(AttributeError):
+        client.write("123", simple_loc_res, stream=True)
+    # The failed upload is discarded instead of being committed and
+    # removed, so the object that was stored before is kept.
+    assert buffered_memory.discarded == [path]
+    assert memory_bucket.cat_file(path) == stored
+    assert client.read(rem_res, json_serializable=False)["downloadable"]
+
+
+def test_read_selected_outputs(memory_bucket, simple_loc_res):
+    rem_res = cs_storage.write("123", simple_loc_res, protocol="memory")
+    png_id = rem_res["renderable"]["outputs"][1]["id"]
+
+    loc_res = cs_storage.read(
+        rem_res, json_serializable=False, protocol="memory", outputs=[png_id]
+    )
+    assert loc_res["downloadable"] == []
+    assert loc_res["renderable"] == [
+        dict(simple_loc_res["renderable"][1], id=png_id),
+    ]
+
+    # The renderable zip is not touched when only downloadables are read.
+    memory_bucket.rm("/cs-storage-test/123_renderable.zip")
+    loc_res = cs_storage.read(
+        rem_res, protocol="memory", outputs=["md", "CSV file", "missing"]
+    )
+    assert loc_res["renderable"] == []
+    assert [output["data"] for output in loc_res["downloadable"]] == [
+        "comma,sep,values\n",
+        "**hello world**",
+    ]
+
+
+def test_read_selected_outputs_transfer(memory_bucket, buffered_memory):
+    loc_res = {
+        "renderable": [],
+        "downloadable": [
+            {"media_type": "MP4", "title": "video", "data": os.urandom(2 ** 22)},
+            {"media_type": "Markdown", "title": "md", "data": "**hello world**"},
+            {"media_type": "HDF5", "title": "h5", "data": os.urandom(2 ** 22)},
+        ],
+    }
+    client = cs_storage.StorageClient(protocol="bufferedmemory")
+    rem_res = client.write("123", loc_res)
+    size = memory_bucket.size("/cs-storage-test/123_downloadable.zip")
+
+    loc_res = client.read(rem_res, outputs=["md"])
+    assert [output["data"] for output in loc_res["downloadable"]] == ["**hello world**"]
+    # Only the central directory and the range of the selected member
+    # are fetched, not the two large members.
+    nbytes = sum(n for _, n in buffered_memory.reads)
+    assert 0 < nbytes <= 3 * cs_storage.RANGE_BLOCK_SIZE
+    assert nbytes < size / 20
+
+
+def test_read_cache(memory_bucket, simple_loc_res):
+    rem_res = cs_storage.write("123", simple_loc_res, protocol="memory")
+    cs_storage.add_screenshot_links(rem_res)
+    pic = rem_res["renderable"]["outputs"][0]["screenshot"]
+    memory_bucket.pipe(f"/cs-storage-test/{pic}", b"pic")
+
+    cache = cs_storage.ReadCache()
+    exp = cs_storage.read(rem_res, protocol="memory", cache=cache)
+    assert cs_storage.read_screenshot(pic, protocol="memory", cache=cache) == b"pic"
+    assert cache.stats()["misses"] == 3
+
+    # Repeated reads are served from the cache.
+    memory_bucket.rm("/cs-storage-test", recursive=True)
+    assert cs_storage.read(rem_res, protocol="memory", cache=cache) == exp
+    assert cs_storage.read(rem_res, protocol="memory", outputs=["md"], cache=cache)
+    assert cs_storage.read_screenshot(pic, protocol="memory", cache=cache) == b"pic"
+    assert cache.stats()["hits"] == 4
+
+
+def test_dedupe(memory_bucket, simple_loc_res, monkeypatch):
+    rendered = []
+
+    def screenshot_many(outputs, **kwargs):
+        rendered.extend(output["title"] for output in outputs)
+        return [cs_storage.ScreenshotResult(b"pic", None) for _ in outputs]
+
+    def uploads():
+        return sorted(memory_bucket.find("/cs-storage-test"))
+
+    monkeypatch.setattr(cs_storage, "SCREENSHOT_ENABLED", True)
+    monkeypatch.setattr(cs_storage, "screenshot_many", screenshot_many)
+    simple_loc_res["downloadable"].append(
+        {"media_type": "MP4", "title": "same MP4", "data": b"MP4 bytes"}
+    )
+    rem_res = cs_storage.write("123", simple_loc_res, protocol="memory", dedupe=True)
+    assert rendered == ["table stuff", "PNG data"]
+    # The two identical MP4 outputs share one blob.
+    mp4, same_mp4 = rem_res["downloadable"]["outputs"][1::2]
+    assert mp4["digest"] == same_mp4["digest"]
+    assert mp4["filename"] == "MP4 data.mp4"
+    assert len(uploads()) == 7
+
+    first_uploads = uploads()
+    rem_res2 = cs_storage.write("456", simple_loc_res, protocol="memory", dedupe=True)
+    assert rendered == ["table stuff", "PNG data"]
+    assert uploads() == first_uploads
+
+    cs_storage.add_screenshot_links(rem_res2)
+    pics = [output["screenshot"] for output in rem_res2["renderable"]["outputs"]]
+    assert all(pic.startswith("screenshots/") for pic in pics)
+    assert cs_storage.read_screenshot(pics[0], protocol="memory") == b"pic"
+
+    loc_res = cs_storage.read(rem_res2, json_serializable=False, protocol="memory")
+    assert without_ids(loc_res) == without_ids(simple_loc_res)
+    loc_res = cs_storage.read(rem_res2, protocol="memory", outputs=["same MP4"])
+    assert [output["id"] for output in loc_res["downloadable"]] == [
+        rem_res2["downloadable"]["outputs"][3]["id"]
+    ]
+
+
+def test_storage_client(memory_bucket, simple_loc_res):
+    client = cs_storage.StorageClient(
+        "other-bucket", protocol="memory", block_size=64, max_workers=4
+    )
+    try:
+        rem_res = client.write("123", simple_loc_res, stream=True)
+        assert memory_bucket.exists("/other-bucket/123_renderable.zip")
+        assert not memory_bucket.exists("/cs-storage-test/123_renderable.zip")
+        loc_res = client.read(rem_res, json_serializable=False)
+        assert without_ids(loc_res) == without_ids(simple_loc_res)
+        assert client.fs is client.fs
+    finally:
+        memory_bucket.rm("/other-bucket", recursive=True)
+
+    # The module functions delegate to a default client per protocol and
+    # bucket.
+    client = cs_storage.get_client("memory")
+    assert client.bucket == "cs-storage-test"
+    assert client is cs_storage.get_client("memory")
+    rem_res = cs_storage.write("123", simple_loc_res, protocol="memory")
+    assert client.read(rem_res) == cs_storage.read(rem_res, protocol="memory")
+
+
+def test_file_protocol(tmp_path, simple_loc_res):
+    client = cs_storage.StorageClient(str(tmp_path), protocol="file")
+    rem_res = client.write("123", simple_loc_res, dedupe=True)
+    assert (tmp_path / cs_storage.BLOB_PREFIX).is_dir()
+    loc_res = client.read(rem_res, json_serializable=False)
+    assert without_ids(loc_res) == without_ids(simple_loc_res)
+
+
+def test_write_behind(memory_bucket, simple_loc_res, tmp_path, monkeypatch):
+    release = threading.Event()
+    upload = cs_storage._upload
+
+    def slow_upload(fs, path, data):
+        release.wait(5)
+        upload(fs, path, data)
+
+    monkeypatch.setattr(cs_storage, "_upload", slow_upload)
+    client = cs_storage.StorageClient(
+        protocol="memory", staging_directory=str(tmp_path / "staging")
+    )
+    try:
+        rem_res = client.write("123", simple_loc_res)
+        # write returned before the zip files were uploaded.
+        assert not memory_bucket.exists("/cs-storage-test/123_renderable.zip")
+        assert client.uploads.staged_bytes > 0
+        release.set()
+        client.flush("123")
+        loc_res = client.read(rem_res, json_serializable=False)
+        assert without_ids(loc_res) == without_ids(simple_loc_res)
+
+        rem_res = client.write("456", simple_loc_res, dedupe=True)
+        client.flush()
+        assert client.read(rem_res) == cs_storage.read(rem_res, protocol="memory")
+    finally:
+        release.set()
+        client.close()
+    assert os.listdir(tmp_path / "staging") == []
+
+
+@pytest.mark.parametrize("retries", [0, 1])
+def test_write_behind_retries(memory_bucket, tmp_path, monkeypatch, retries):
+    monkeypatch.setattr(cs_storage, "RETRY_DELAY", 0)
+    failed = []
+    upload = cs_storage._upload
+
+    def flaky_upload(fs, path, data):
+        if not failed:
+            failed.append(path)
+            raise OSError("upload failed")
+        upload(fs, path, data)
+
+    monkeypatch.setattr(cs_storage, "_upload", flaky_upload)
+    client = cs_storage.StorageClient(
+        protocol="memory", staging_directory=str(tmp_path), retries=retries
+    )
+    loc_res = {
+        "renderable": [],
+        "downloadable": [{"media_type": "Text", "title": "text", "data": "text"}],
+    }
+    try:
+        client.write("123", loc_res)
+        if retries:
+            client.flush()
+            assert memory_bucket.exists("/cs-storage-test/123_downloadable.zip")
+        else:
+            with pytest.raises(OSError, match="upload failed"):
+                client.flush()
+    finally:
+        client.close()
+
+
+class ComposeMemoryFileSystem(fsspec.implementations.memory.MemoryFileSystem):
+    """
+    In-memory filesystem with a merge method like gcsfs's, which joins
+    objects with GCS compose. It shares memory://'s store.
+    """
+
+    protocol = "composememory"
+    merges = []
+
+    @classmethod
+    def _strip_protocol(cls, path):
+        if path.startswith("composememory://"):
+            path = path[len("composememory://") :]
+        return super()._strip_protocol(path)
+
+    def merge(self, path, paths):
+        assert len(paths) <= cs_storage.MAX_MERGE_PARTS
+        self.merges.append((path, list(paths)))
+        self.pipe_file(path, b"".join(self.cat_file(part) for part in paths))
+
+
+def test_multipart_upload(memory_bucket, simple_loc_res, monkeypatch):
+    fsspec.register_implementation(
+        "composememory", ComposeMemoryFileSystem, clobber=True
+    )
+    monkeypatch.setattr(ComposeMemoryFileSystem, "merges", [])
+    monkeypatch.setattr(cs_storage, "RETRY_DELAY", 0)
+    loc_res = {
+        "renderable": [],
+        "downloadable": [
+            {"media_type": "MP4", "title": "video", "data": os.urandom(50_000)}
+        ],
+    }
+    failed = []
+    upload = cs_storage._upload
+
+    def flaky_upload(fs, path, data):
+        if path.endswith(".part00003") and not failed:
+            failed.append(path)
+            raise OSError("upload failed")
+        upload(fs, path, data)
+
+    monkeypatch.setattr(cs_storage, "_upload", flaky_upload)
+    client = cs_storage.StorageClient(
+        protocol="composememory",
+        multipart_threshold=10_000,
+        part_size=1_000,
+        metrics=cs_storage.RecordingSink(),
+    )
+    rem_res = client.write("123", loc_res)
+    assert len(failed) == 1
+    # The 51 parts take two rounds of merges.
+    size = memory_bucket.size("/cs-storage-test/123_downloadable.zip")
+    assert -(-size // 1_000) == 51
+    merges = ComposeMemoryFileSystem.merges
+    assert [len(paths) for _, paths in merges] == [32, 19, 2]
+    assert merges[-1][0] == "composememory://cs-storage-test/123_downloadable.zip"
+    # Only the category zip file is left.
+    assert memory_bucket.find("/cs-storage-test") == [
+        "/cs-storage-test/123_downloadable.zip",
+        "/cs-storage-test/123_renderable.zip",
+    ]
+    assert [
+        timing.tags.get("multipart")
+        for timing in client.metrics.timings
+        if timing.phase == "upload"
+    ] == [None, True]
+    loc_res_read = client.read(rem_res, json_serializable=False)
+    assert without_ids(loc_res_read) == without_ids(loc_res)
+
+    # Small objects and backends without merge are uploaded in one piece.
+    del merges[:]
+    client.write(
+        "456",
+        {
+            "renderable": [],
+            "downloadable": [{"media_type": "Text", "title": "t", "data": "small"}],
+        },
+    )
+    rem_res = cs_storage.StorageClient(
+        protocol="memory", multipart_threshold=10_000, part_size=1_000
+    ).write("789", loc_res)
+    assert merges == []
+    loc_res_read = cs_storage.read(rem_res, json_serializable=False, protocol="memory")
+    assert without_ids(loc_res_read) == without_ids(loc_res)
+
+
+def test_write_timeout(memory_bucket, simple_loc_res, monkeypatch):
+    release = threading.Event()
+
+    def slow_upload(fs, path, data):
+        release.wait(5)
+
+    monkeypatch.setattr(cs_storage, "_upload", slow_upload)
+    client = cs_storage.StorageClient(protocol="memory", timeout=0.1)
+    try:
+        with pytest.raises(TimeoutError):
+            client.write("123", simple_loc_res)
+    finally:
+        release.set()
+
+
+def test_read_many(memory_bucket, simple_loc_res):
+    rem_results = [
+        cs_storage.write(str(i), simple_loc_res, protocol="memory") for i in range(4)
+    ]
+    memory_bucket.rm("/cs-storage-test/2_downloadable.zip")
+    rem_results.append({"bad": "data"})
+
+    results = list(
+        cs_storage.read_many(
+            rem_results, json_serializable=False, protocol="memory", max_workers=3
+        )
+    )
+    assert sorted(result.index for result in results) == [0, 1, 2, 3, 4]
+    for index, result, error in results:
+        if index in (2, 4):
+            assert result is None
+            assert isinstance(error, (FileNotFoundError, exceptions.ValidationError))
+        else:
+            assert error is None
+            assert result == cs_storage.read(
+                rem_results[index], json_serializable=False, protocol="memory"
+            )
+
+
+def test_compression_policy(memory_bucket, simple_loc_res):
+    def compress_types(ziplocation):
+        with memory_bucket.open(f"/cs-storage-test/{ziplocation}") as f:
+            return {
+                info.filename: info.compress_type
+                for info in zipfile.ZipFile(f).infolist()
+            }
+
+    rem_res = cs_storage.write("123", simple_loc_res, protocol="memory")
+    assert compress_types("123_renderable.zip") == {
+        "table stuff.html": zipfile.ZIP_DEFLATED,
+        "PNG data.png": zipfile.ZIP_STORED,
+    }
+    assert compress_types("123_downloadable.zip") == {
+        "CSV file.csv": zipfile.ZIP_DEFLATED,
+        "MP4 data.mp4": zipfile.ZIP_STORED,
+        "md.md": zipfile.ZIP_DEFLATED,
+    }
+    loc_res = cs_storage.read(rem_res, json_serializable=False, protocol="memory")
+    assert without_ids(loc_res) == without_ids(simple_loc_res)
+
+    cs_storage.write(
+        "456",
+        simple_loc_res,
+        protocol="memory",
+        compression={"csv": (zipfile.ZIP_STORED, None), "mp4": (zipfile.ZIP_BZIP2, 9)},
+    )
+    assert compress_types("456_downloadable.zip") == {
+        "CSV file.csv": zipfile.ZIP_STORED,
+        "MP4 data.mp4": zipfile.ZIP_BZIP2,
+        "md.md": zipfile.ZIP_DEFLATED,
+    }
+
+
+def test_parallel_packing(memory_bucket, simple_loc_res):
+    outputs = simple_loc_res["renderable"] + simple_loc_res["downloadable"]
+    outputs += [
+        {"media_type": "bokeh", "title": "plot", "data": {"x": list(range(10000))}},
+        {"media_type": "CSV", "title": "big", "data": "a,b\n1,2\n" * 10000},
+        {
+            "media_type": "MP4",
+            "title": "video",
+            "data": cs_storage.Base64Serializer("mp4").deserialize(b"MP4" * 100),
+        },
+    ]
+    compression = {"md": (zipfile.ZIP_DEFLATED, 9), "mp4": (zipfile.ZIP_BZIP2, None)}
+    archives = []
+    for workers in [1, 2, 4]:
+        buff = io.BytesIO()
+        rem_outputs = cs_storage._write_zip(
+            buff, outputs, compression=compression, workers=workers
+        )
+        archives.append(buff.getvalue())
+    # The archives do not depend on the number of threads or the time.
+    assert archives[1] == archives[0]
+    assert archives[2] == archives[0]
+
+    # Members that are compressed when they are written keep their level.
+    for compression in [
+        {"csv": (zipfile.ZIP_BZIP2, 1)},
+        {"csv": (zipfile.ZIP_LZMA, None), "html": (zipfile.ZIP_DEFLATED, 1)},
+    ]:
+        serial, parallel = io.BytesIO(), io.BytesIO()
+        cs_storage._write_zip(serial, outputs, compression=compression)
+        cs_storage._write_zip(parallel, outputs, compression=compression, workers=2)
+        assert parallel.getvalue() == serial.getvalue()
+    with zipfile.ZipFile(io.BytesIO(archives[0])) as zipfileobj:
+        assert zipfileobj.testzip() is None
+        assert [info.filename for info in zipfileobj.infolist()] == [
+            rem_output["filename"] for rem_output in rem_outputs
+        ]
+
+    rem_res = cs_storage.write("123", simple_loc_res, protocol="memory", pack_workers=4)
+    loc_res = cs_storage.read(rem_res, json_serializable=False, protocol="memory")
+    assert without_ids(loc_res) == without_ids(simple_loc_res)
+
+
+def test_process_packing(memory_bucket, simple_loc_res):
+    outputs = simple_loc_res["renderable"] + [
+        {"media_type": "bokeh", "title": "plot", "data": {"x": list(range(10000))}},
+        {"media_type": "CSV", "title": "big", "data": "a,b\n1,2\n" * 10000},
+    ]
+    compression = {"json": (zipfile.ZIP_DEFLATED, 9), "csv": (zipfile.ZIP_BZIP2, 1)}
+    serial, parallel = io.BytesIO(), io.BytesIO()
+    cs_storage._write_zip(serial, outputs, compression=compression)
+    metrics = cs_storage.RecordingSink()
+    cs_storage.configure_json(binary_arrays=True)
+    try:
+        with ProcessPoolExecutor(2) as executor:
+            cs_storage._write_zip(
+                parallel,
+                outputs,
+                compression=compression,
+                metrics=metrics,
+                workers=2,
+                executor=executor,
+            )
+        binary = io.BytesIO()
+        cs_storage._write_zip(binary, outputs, compression=compression)
+    finally:
+        cs_storage.configure_json()
+    # The workers use the JSON settings of the writer.
+    assert parallel.getvalue() == binary.getvalue() != serial.getvalue()
+    # The timings of the workers are emitted by the writer.
+    serialized = [t for t in metrics.timings if t.phase == "serialization"]
+    assert [t.tags["media_type"] for t in serialized] == [
+        output["media_type"] for output in outputs
+    ]
+
+    client = cs_storage.StorageClient(
+        protocol="memory", pack_workers=2, pack_processes=True
+    )
+    rem_res = client.write("123", simple_loc_res)
+    assert list(client._pack_pools) == [2]
+    client.close()
+    assert client._pack_pools == {}
+    loc_res = client.read(rem_res, json_serializable=False)
+    assert without_ids(loc_res) == without_ids(simple_loc_res)
+
+
 def test_cs_storage_serialization(exp_loc_res):
     as_string = cs_storage.serialize_to_json(exp_loc_res)
     assert json.dumps(as_string)
@@ -202,6 +882,274 @@ def test_cs_storage_serialization(exp_loc_res):
     assert as_bytes == exp_loc_res
 
 
+def test_json_conversion_without_copies(simple_loc_res):
+    simple_loc_res["renderable"].append(
+        {"media_type": "bokeh", "title": "plot", "data": {"doc": {"x": [1.5, 2]}}}
+    )
+    as_json = cs_storage.serialize_to_json(simple_loc_res)
+    assert json.dumps(as_json)
+    assert cs_storage.deserialize_from_json(as_json) == simple_loc_res
+    # Data that is already JSON serializable is not copied.
+    bokeh_data = simple_loc_res["renderable"][-1]["data"]
+    assert as_json["renderable"][-1]["data"] is bokeh_data
+    assert as_json["renderable"][-1] is not simple_loc_res["renderable"][-1]
+
+
+def test_json_conversion_memory():
+    """
+    Converting a large base64 video that is already in its JSON form
+    used to allocate about three copies of it.
+    """
+    video = cs_storage.Base64Serializer("mp4").deserialize(os.urandom(2 ** 23))
+    json_result = {
+        "renderable": [],
+        "downloadable": [{"media_type": "MP4", "title": "video", "data": video}],
+    }
+    tracemalloc.start()
+    try:
+        as_json = cs_storage.serialize_to_json(json_result)
+        _, peak = tracemalloc.get_traced_memory()
+        assert peak < len(video) / 10
+        tracemalloc.reset_peak()
+
+        as_bytes = cs_storage.deserialize_from_json(as_json)
+        _, peak = tracemalloc.get_traced_memory()
+        assert peak < 1.1 * len(as_bytes["downloadable"][0]["data"])
+    finally:
+        tracemalloc.stop()
+
+
+def test_chunked_serialization():
+    data = os.urandom(1000)
+    ser = cs_storage.Base64Serializer("mp4")
+    as_str = ser.deserialize(data)
+    buff = io.BytesIO()
+    assert ser.serialize_to(as_str, buff, chunk_size=100) == len(data)
+    assert buff.getvalue() == data
+
+    chunks = list(ser.iter_deserialize(io.BytesIO(data), chunk_size=100))
+    assert all(len(chunk) <= 4 * 100 / 3 for chunk in chunks)
+    assert "".join(chunks) == as_str
+    assert ser.deserialize_from(io.BytesIO(data), chunk_size=100) == as_str
+    assert b"".join(ser.iter_deserialize(io.BytesIO(data), False, 100)) == data
+
+    text = "π ≈ 3.14159 " * 100
+    ser = cs_storage.TextSerializer("txt")
+    chunks = list(ser.iter_deserialize(io.BytesIO(ser.serialize(text)), chunk_size=7))
+    assert len(chunks) > 1
+    assert "".join(chunks) == text
+
+
+def test_chunked_write_and_read_memory(tmp_path):
+    """
+    Base64 outputs are decoded into and encoded from the zip members in
+    chunks instead of in one piece.
+    """
+    video = cs_storage.Base64Serializer("mp4").deserialize(os.urandom(2 ** 23))
+    loc_res = {
+        "renderable": [],
+        "downloadable": [{"media_type": "MP4", "title": "video", "data": video}],
+    }
+    client = cs_storage.StorageClient(str(tmp_path), protocol="file")
+    tracemalloc.start()
+    try:
+        rem_res = client.write("123", loc_res, stream=True)
+        _, peak = tracemalloc.get_traced_memory()
+        # A few chunks instead of the decoded video.
+        assert peak < len(video) / 4
+        tracemalloc.reset_peak()
+
+        loc_res = client.read(rem_res)
+        _, peak = tracemalloc.get_traced_memory()
+        # The zip, the encoded chunks and the joined string. Encoding the
+        # whole member used to take another copy of the video and of
+        # its base64 bytes.
+        assert peak < 2.9 * len(video)
+    finally:
+        tracemalloc.stop()
+    assert loc_res["downloadable"][0]["data"] == video
+
+
+def test_chunked_write_zip64(memory_bucket, monkeypatch):
+    """
+    Members that are written in chunks use the zip64 extension if they
+    are too large for a plain zip entry.
+    """
+    monkeypatch.setattr(zipfile, "ZIP64_LIMIT", 2 ** 12)
+    data = os.urandom(2 ** 13)
+    video = cs_storage.Base64Serializer("mp4").deserialize(data)
+    loc_res = {
+        "renderable": [],
+        "downloadable": [{"media_type": "MP4", "title": "video", "data": video}],
+    }
+    for stream in [False, True]:
+        rem_res = cs_storage.write("123", loc_res, protocol="memory", stream=stream)
+        loc_res_read = cs_storage.read(
+            rem_res, json_serializable=False, protocol="memory"
+        )
+        assert loc_res_read["downloadable"][0]["data"] == data
+
+
+def test_read_chunks(memory_bucket, simple_loc_res):
+    png = simple_loc_res["renderable"][1]["data"]
+    for dedupe in [False, True]:
+        rem_res = cs_storage.write(
+            "123", simple_loc_res, protocol="memory", dedupe=dedupe
+        )
+        chunks = cs_storage.read_chunks(
+            rem_res, "PNG data", protocol="memory", chunk_size=1024
+        )
+        assert "".join(chunks) == cs_storage.Base64Serializer("png").deserialize(png)
+        chunks = cs_storage.read_chunks(
+            rem_res, "md", protocol="memory", json_serializable=False
+        )
+        assert "".join(chunks) == "**hello world**"
+    with pytest.raises(KeyError):
+        list(cs_storage.read_chunks(rem_res, "missing", protocol="memory"))
+
+
+def test_iter_read(memory_bucket, simple_loc_res):
+    for dedupe in [False, True]:
+        rem_res = cs_storage.write(
+            "123", simple_loc_res, protocol="memory", dedupe=dedupe
+        )
+        loc_res = {"renderable": [], "downloadable": []}
+        for category, output in cs_storage.iter_read(rem_res, protocol="memory"):
+            loc_res[category].append(output)
+        assert loc_res == cs_storage.read(rem_res, protocol="memory")
+
+    selected = cs_storage.iter_read(
+        rem_res, json_serializable=False, protocol="memory", outputs=["md"]
+    )
+    assert [(category, output["data"]) for category, output in selected] == [
+        ("downloadable", "**hello world**")
+    ]
+
+    # Outputs are only read when they are requested.
+    rem_res = cs_storage.write("456", simple_loc_res, protocol="memory")
+    metrics = cs_storage.RecordingSink()
+    client = cs_storage.StorageClient(protocol="memory", metrics=metrics)
+    outputs = client.iter_read(rem_res, json_serializable=False)
+    category, output = next(outputs)
+    assert (category, output["title"]) == ("renderable", "table stuff")
+    assert [timing.phase for timing in metrics.timings] == [
+        "validation",
+        "unzip",
+        "serialization",
+    ]
+    assert [output["title"] for _, output in outputs] == [
+        "PNG data",
+        "CSV file",
+        "MP4 data",
+        "md",
+    ]
+
+    cache = cs_storage.ReadCache()
+    client.read(rem_res, cache=cache)
+    del metrics.timings[:]
+    assert list(client.iter_read(rem_res, cache=cache)) == [
+        (category, output)
+        for category, outputs in client.read(rem_res, cache=cache).items()
+        for output in outputs
+    ]
+    assert "download" not in [timing.phase for timing in metrics.timings]
+
+
+def test_read_table(memory_bucket, simple_loc_res):
+    rows = "".join(f"{i},{i * i}\n" for i in range(100))
+    simple_loc_res["downloadable"].append(
+        {"media_type": "CSV", "title": "squares", "data": "x,y\n" + rows}
+    )
+    rem_res = cs_storage.write("123", simple_loc_res, protocol="memory", tables=True)
+    squares = rem_res["downloadable"]["outputs"][-1]
+    assert squares["table"] == f"123_{squares['id']}.table"
+    assert memory_bucket.exists(f"/cs-storage-test/{squares['table']}")
+    cs_storage.RemoteResult().load(rem_res)
+
+    table = cs_storage.read_table(
+        rem_res, "squares", protocol="memory", offset=10, limit=3, columns=["y"]
+    )
+    assert table == cs_storage.Table(["y"], [["100"], ["121"], ["144"]], 100)
+
+    # Outputs without a table are read in full.
+    del squares["table"]
+    assert (
+        cs_storage.read_table(
+            rem_res, squares["id"], protocol="memory", offset=10, limit=3, columns=["y"]
+        )
+        == table
+    )
+    assert cs_storage.read_table(rem_res, "CSV file", protocol="memory") == (
+        cs_storage.Table(["comma", "sep", "values"], [], 0)
+    )
+    with pytest.raises(ValueError):
+        cs_storage.read_table(rem_res, "md", protocol="memory")
+
+
+def test_append(memory_bucket, simple_loc_res):
+    metrics = cs_storage.RecordingSink()
+    client = cs_storage.StorageClient(protocol="memory", metrics=metrics)
+    rem_res = client.write("123", simple_loc_res)
+    zips = set(memory_bucket.find("/cs-storage-test"))
+    del metrics.timings[:]
+
+    new_outputs = {
+        "downloadable": [
+            {"media_type": "Text", "title": "step 1", "data": "first step"},
+            {"media_type": "CSV", "title": "step 1 csv", "data": "a,b\n1,2\n"},
+        ]
+    }
+    appended = client.append("123", rem_res, new_outputs, tables=True)
+    # Only the new segment and table were uploaded.
+    uploaded = [timing.nbytes for timing in metrics.timings if timing.phase == "upload"]
+    assert len(uploaded) == 2
+    assert sum(uploaded) < 1000
+    assert zips < set(memory_bucket.find("/cs-storage-test"))
+    assert len(rem_res["downloadable"]["outputs"]) == 3
+    segment = appended["downloadable"]["outputs"][-1]["ziplocation"]
+    assert segment.startswith("123-") and segment.endswith("_downloadable.zip")
+    cs_storage.RemoteResult().load(appended)
+
+    appended = client.append(
+        "123",
+        appended,
+        {
+            "renderable": [{"media_type": "Markdown", "title": "step 2", "data": "#"}],
+            "downloadable": [],
+        },
+    )
+    expected = without_ids(simple_loc_res)
+    expected["downloadable"] += new_outputs["downloadable"]
+    expected["renderable"].append(
+        {"media_type": "Markdown", "title": "step 2", "data": "#"}
+    )
+    loc_res = client.read(appended, json_serializable=False)
+    assert without_ids(loc_res) == without_ids(expected)
+    assert [
+        (category, output["title"])
+        for category, output in client.iter_read(appended, json_serializable=False)
+    ] == [
+        (category, output["title"])
+        for category, outputs in expected.items()
+        for output in outputs
+    ]
+    assert asyncio.run(client.aread(appended)) == client.read(appended)
+    selected = client.read(appended, outputs=["md", "step 1", "step 2"])
+    assert [output["data"] for output in selected["downloadable"]] == [
+        "**hello world**",
+        "first step",
+    ]
+    assert "".join(client.read_chunks(appended, "step 1")) == "first step"
+    assert client.read_table(appended, "step 1 csv").rows == [["1", "2"]]
+
+    # Appending to a result that does not have the category yet.
+    appended = client.append("456", {}, new_outputs, dedupe=True)
+    loc_res = client.read(appended, json_serializable=False)
+    assert without_ids(loc_res) == without_ids(
+        {"renderable": [], "downloadable": new_outputs["downloadable"]}
+    )
+
+
 def test_add_screenshot_links():
     rem_res = {"renderable": {"outputs": [{"id": "1234"}, {"id": "4567"}]}}
 
@@ -229,3 +1177,214 @@ def test_errors():
         cs_storage.write("123", {"bad": "data"})
     with pytest.raises(exceptions.ValidationError):
         cs_storage.read({"bad": "data"})
+
+
+@pytest.mark.parametrize("validate", ["full", "fast"])
+def test_validate_errors(validate):
+    bad_results = [
+        {"bad": "data"},
+        {"renderable": [{"media_type": "GIF", "title": "gif", "data": b""}]},
+        {"renderable": [{"media_type": "PNG", "title": "no data", "extra": 1}]},
+        {"downloadable": {"media_type": "PNG", "title": "not a list", "data": b""}},
+    ]
+    if validate == "fast":
+        # The full schema does not require these keys, but write does.
+        bad_results.append({"renderable": [{"media_type": "PNG", "data": b""}]})
+    for bad_result in bad_results:
+        with pytest.raises(exceptions.ValidationError):
+            cs_storage.write("123", bad_result, validate=validate)
+        with pytest.raises(exceptions.ValidationError):
+            cs_storage.serialize_to_json(bad_result, validate=validate)
+
+    bad_rem_results = [
+        {"bad": "data"},
+        {"renderable": {"outputs": [{"media_type": "GIF", "title": "gif"}]}},
+        {"renderable": {"outputs": [], "ziplocation": "a.zip", "extra": 1}},
+    ]
+    for bad_rem_result in bad_rem_results:
+        with pytest.raises(exceptions.ValidationError):
+            cs_storage.read(bad_rem_result, validate=validate)
+
+
+def test_metrics(memory_bucket, simple_loc_res):
+    metrics = cs_storage.RecordingSink()
+    client = cs_storage.StorageClient(protocol="memory", metrics=metrics)
+    rem_res = client.write("123", simple_loc_res)
+    phases = [timing.phase for timing in metrics.timings]
+    assert phases.count("validation") == 1
+    assert phases.count("serialization") == phases.count("zip") == 5
+    assert phases.count("upload") == 2
+    assert all(timing.tags["task_id"] == "123" for timing in metrics.timings)
+    (csv_zip,) = [
+        timing
+        for timing in metrics.timings
+        if timing.phase == "zip" and timing.tags["media_type"] == "CSV"
+    ]
+    assert csv_zip.tags["category"] == "downloadable"
+    assert csv_zip.nbytes == len("comma,sep,values\n")
+
+    del metrics.timings[:]
+    client.read(rem_res)
+    phases = [timing.phase for timing in metrics.timings]
+    assert phases.count("download") == 2
+    assert phases.count("unzip") == 5
+    # The base64 PNG and MP4 data is encoded while it is unzipped.
+    assert phases.count("serialization") == 3
+    assert sum(
+        timing.nbytes for timing in metrics.timings if timing.phase == "download"
+    ) == sum(
+        memory_bucket.size(f"/cs-storage-test/123_{category}.zip")
+        for category in ["renderable", "downloadable"]
+    )
+
+    del metrics.timings[:]
+    memory_bucket.rm("/cs-storage-test/123_renderable.zip")
+    with pytest.raises(FileNotFoundError):
+        client.read(rem_res)
+    assert metrics.timings[-1].tags["error"] == "FileNotFoundError"
+
+
+def test_metrics_disabled_by_default(memory_bucket, simple_loc_res):
+    timings = []
+    cs_storage.configure_metrics(cs_storage.CallbackSink(timings.append))
+    try:
+        cs_storage.write("123", simple_loc_res, protocol="memory")
+    finally:
+        cs_storage.configure_metrics(None)
+    assert timings
+    del timings[:]
+    cs_storage.write("123", simple_loc_res, protocol="memory")
+    assert timings == []
+    assert cs_storage.NULL_SINK.timer("upload") is cs_storage.NULL_SINK.timer("zip")
+
+
+def test_validate_modes(memory_bucket, simple_loc_res, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("schema should not be loaded")
+
+    monkeypatch.setattr(cs_storage.LOCAL_RESULT_SCHEMA, "load", fail)
+    monkeypatch.setattr(cs_storage.REMOTE_RESULT_SCHEMA, "load", fail)
+    for validate in ["fast", "none"]:
+        rem_res = cs_storage.write(
+            "123", simple_loc_res, protocol="memory", validate=validate
+        )
+        loc_res = cs_storage.read(
+            rem_res, json_serializable=False, protocol="memory", validate=validate
+        )
+        assert without_ids(loc_res) == without_ids(simple_loc_res)
+        as_json = cs_storage.serialize_to_json(simple_loc_res, validate=validate)
+        assert (
+            cs_storage.deserialize_from_json(as_json, validate=validate)
+            == simple_loc_res
+        )
+
+    with pytest.raises(ValueError):
+        cs_storage.read(rem_res, validate="partial")
+
+
+@pytest.fixture(params=["sync", "async"])
+def async_memory_bucket(request, memory_bucket, monkeypatch):
+    """
+    memory_bucket used through a filesystem that implements fsspec's
+    async interface, or through the thread fallback for sync backends.
+    """
+    if request.param == "async":
+        asyn_wrapper = pytest.importorskip("fsspec.implementations.asyn_wrapper")
+
+        async def async_filesystem(protocol, **storage_options):
+            return asyn_wrapper.AsyncFileSystemWrapper(memory_bucket)
+
+        monkeypatch.setattr(cs_storage, "_async_filesystem", async_filesystem)
+    return memory_bucket
+
+
+class LoopMemoryFileSystem(fsspec.asyn.AsyncFileSystem):
+    """
+    Async filesystem on memory://'s store that, like gcsfs, can only be
+    used from the loop it was created for.
+    """
+
+    protocol = "loopmemory"
+    instances = []
+
+    def __init__(self, *args, loop=None, **kwargs):
+        super().__init__(*args, loop=loop, **kwargs)
+        self.bound_loop = loop
+        self.instances.append(self)
+
+    @classmethod
+    def _strip_protocol(cls, path):
+        if path.startswith("loopmemory://"):
+            path = path[len("loopmemory://") :]
+        return fsspec.implementations.memory.MemoryFileSystem._strip_protocol(path)
+
+    async def _cat_file(self, path, start=None, end=None, **kwargs):
+        assert asyncio.get_running_loop() is self.bound_loop
+        path = self._strip_protocol(path)
+        return fsspec.filesystem("memory").cat_file(path, start, end)
+
+
+def test_async_filesystem_per_loop(memory_bucket, monkeypatch):
+    fsspec.register_implementation("loopmemory", LoopMemoryFileSystem, clobber=True)
+    monkeypatch.setattr(LoopMemoryFileSystem, "instances", [])
+    memory_bucket.pipe("/cs-storage-test/pic.png", b"pic")
+    client = cs_storage.StorageClient(protocol="loopmemory")
+
+    async def read_twice():
+        pics = [await client.aread_screenshot("pic") for _ in range(2)]
+        await client.aclose()
+        return pics
+
+    # Each loop gets its own filesystem, which is shared by the calls in
+    # the loop.
+    assert asyncio.run(read_twice()) == [b"pic", b"pic"]
+    assert asyncio.run(read_twice()) == [b"pic", b"pic"]
+    first, second = LoopMemoryFileSystem.instances
+    assert first.bound_loop is not second.bound_loop
+
+
+def test_async_api(async_memory_bucket, simple_loc_res):
+    async def write_and_read():
+        rem_res = await cs_storage.awrite("123", simple_loc_res, protocol="memory")
+        loc_res, selected = await asyncio.gather(
+            cs_storage.aread(rem_res, json_serializable=False, protocol="memory"),
+            cs_storage.aread(rem_res, protocol="memory", outputs=["md", "PNG data"]),
+        )
+        return rem_res, loc_res, selected
+
+    rem_res, loc_res, selected = asyncio.run(write_and_read())
+    assert without_ids(loc_res) == without_ids(simple_loc_res)
+    assert cs_storage.read(rem_res, protocol="memory") == asyncio.run(
+        cs_storage.aread(rem_res, protocol="memory")
+    )
+    assert [output["title"] for output in selected["renderable"]] == ["PNG data"]
+    assert [output["title"] for output in selected["downloadable"]] == ["md"]
+
+    rem_res = cs_storage.write("456", simple_loc_res, protocol="memory", dedupe=True)
+    loc_res = asyncio.run(
+        cs_storage.aread(rem_res, json_serializable=False, protocol="memory")
+    )
+    assert without_ids(loc_res) == without_ids(simple_loc_res)
+
+    async_memory_bucket.pipe("/cs-storage-test/pic.png", b"pic")
+    assert asyncio.run(cs_storage.aread_screenshot("pic", protocol="memory")) == b"pic"
+
+    # Like write, awrite skips the categories that are missing.
+    partial = {"downloadable": simple_loc_res["downloadable"]}
+    rem_res = asyncio.run(cs_storage.awrite("789", partial, protocol="memory"))
+    assert list(rem_res) == list(cs_storage.write("789", partial, protocol="memory"))
+    loc_res = cs_storage.read(rem_res, json_serializable=False, protocol="memory")
+    assert without_ids(loc_res) == without_ids(dict(partial, renderable=[]))
+
+
+def test_awrite_failure(async_memory_bucket, simple_loc_res, monkeypatch):
+    apipe = cs_storage._apipe
+
+    async def flaky_apipe(filesystem, path, data):
+        if path.endswith("_downloadable.zip"):
+            raise OSError("upload failed")
+        return await apipe(filesystem, path, data)
+
+    monkeypatch.setattr(cs_storage, "_apipe", flaky_apipe)
+    with pytest.raises(OSError, match="upload failed"):
+        asyncio.run(cs_storage.awrite("123", simple_loc_res, protocol="memory"))
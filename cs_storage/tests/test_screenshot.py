@@ -1,8 +1,14 @@
+import asyncio
+import importlib
 import json
 import os
 
+import pytest
+
 import cs_storage
 
+screenshot_module = importlib.import_module("cs_storage.screenshot")
+
 
 CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
 
@@ -48,3 +54,266 @@ def test_use_with_dask():
     results = c.gather(futures)
     for result in results:
         assert isinstance(result, bytes)
+
+
+class FakeProcess:
+    def __init__(self):
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+
+class FakeElement:
+    async def boundingBox(self):
+        return {"x": 0, "y": 0, "width": 2000, "height": 100}
+
+
+class FakePage:
+    def __init__(self):
+        self.closed = False
+        self.html = None
+
+    def isClosed(self):
+        return self.closed
+
+    async def close(self):
+        self.closed = True
+
+    async def setViewport(self, viewport):
+        pass
+
+    async def setContent(self, html):
+        self.html = html
+
+    async def evaluate(self, script):
+        self.rendered = False
+
+    async def waitForFunction(self, script, options):
+        assert script == "window.csRenderComplete === true"
+        if "slow output" in self.html:
+            raise asyncio.TimeoutError()
+
+    async def querySelector(self, selector):
+        if "broken output" in self.html:
+            return None
+        return FakeElement()
+
+    async def screenshot(self, **kwargs):
+        assert kwargs["clip"]["width"] == 1920
+        return f"png:{self.html.count('<table/>')}".encode()
+
+
+class FakeBrowser:
+    def __init__(self):
+        self.process = FakeProcess()
+        self.closed = False
+
+    async def newPage(self):
+        return FakePage()
+
+    async def version(self):
+        if self.process.poll() is not None:
+            raise ConnectionError("browser crashed")
+        return "HeadlessChrome/fake"
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_launch(monkeypatch):
+    browsers = []
+
+    async def launch(**kwargs):
+        browsers.append(FakeBrowser())
+        return browsers[-1]
+
+    monkeypatch.setattr(screenshot_module, "launch", launch)
+    return browsers
+
+
+async def use_page(pool):
+    async with pool.page() as page:
+        return page
+
+
+def test_browser_pool_reuses_pages(fake_launch):
+    pool = cs_storage.BrowserPool(size=1, max_pages=3)
+    try:
+        pages = [pool.run(use_page(pool)) for _ in range(3)]
+        assert len(fake_launch) == 1
+        assert pages[0] is pages[1] is pages[2]
+
+        # The browser is restarted once it has served max_pages pages.
+        pool.run(use_page(pool))
+        assert len(fake_launch) == 2
+        assert fake_launch[0].closed
+    finally:
+        pool.close()
+    assert fake_launch[1].closed
+
+
+def test_browser_pool_restarts_crashed_browser(fake_launch):
+    pool = cs_storage.BrowserPool(size=2)
+    try:
+        pool.run(use_page(pool))
+        assert pool.health_check() == 0
+
+        fake_launch[0].process.returncode = -9
+        assert pool.health_check() == 1
+        assert len(fake_launch) == 2
+
+        # Pages are not handed out from a crashed browser.
+        fake_launch[1].process.returncode = -9
+        page = pool.run(use_page(pool))
+        assert len(fake_launch) == 3
+        assert not page.isClosed()
+    finally:
+        pool.close()
+
+
+def test_browser_pool_closes_failed_pages(fake_launch):
+    pool = cs_storage.BrowserPool()
+
+    async def fail():
+        async with pool.page() as page:
+            raise cs_storage.ScreenshotError(page)
+
+    try:
+        with pytest.raises(cs_storage.ScreenshotError) as excinfo:
+            pool.run(fail())
+        assert excinfo.value.args[0].isClosed()
+        assert pool.run(use_page(pool)) is not excinfo.value.args[0]
+    finally:
+        pool.close()
+
+
+def test_screenshot_many(fake_launch, monkeypatch):
+    jinja2 = pytest.importorskip("jinja2")
+    with open(f"{screenshot_module.CURRENT_DIR}/templates/index.html") as f:
+        template = jinja2.Template(f.read())
+    monkeypatch.setattr(screenshot_module, "SCREENSHOT_ENABLED", True)
+    monkeypatch.setattr(screenshot_module, "TEMPLATE", template)
+    monkeypatch.setattr(screenshot_module, "_POOL", None)
+
+    outputs = [
+        {"id": str(i), "title": title, "media_type": "table", "data": "<table/>"}
+        for i, title in enumerate(["first", "broken output", "slow output"])
+    ]
+    metrics = cs_storage.RecordingSink()
+    try:
+        results = cs_storage.screenshot_many(
+            outputs, render_timeout=10, metrics=metrics
+        )
+    finally:
+        cs_storage.shutdown_pool()
+
+    assert [result.data for result in results] == [b"png:1", None, b"png:1"]
+    assert results[0].error is None
+    assert isinstance(results[1].error, cs_storage.ScreenshotError)
+    assert len(fake_launch) == 1
+    assert [timing.phase for timing in metrics.timings] == ["screenshot"] * 3
+    assert sorted(timing.nbytes or 0 for timing in metrics.timings) == [0, 5, 5]
+
+
+def test_screenshot_cache(fake_launch, monkeypatch, tmp_path):
+    jinja2 = pytest.importorskip("jinja2")
+    fsspec = pytest.importorskip("fsspec")
+    with open(f"{screenshot_module.CURRENT_DIR}/templates/index.html") as f:
+        template = jinja2.Template(f.read())
+    monkeypatch.setattr(screenshot_module, "SCREENSHOT_ENABLED", True)
+    monkeypatch.setattr(screenshot_module, "TEMPLATE", template)
+    monkeypatch.setattr(screenshot_module, "_POOL", None)
+    mem_fs = fsspec.filesystem("memory")
+    prefix = "memory://cs-storage-test/screenshots/rendered"
+
+    def output(id, data="<table/>"):
+        return {"id": id, "title": "table", "media_type": "table", "data": data}
+
+    def bokeh(id):
+        data = {"doc": {"version": "1.4.0", "roots": {}}, "root_id": "1001"}
+        return {"id": id, "title": "plot", "media_type": "bokeh", "data": data}
+
+    def cache():
+        return cs_storage.ScreenshotCache(
+            cs_storage.ReadCache(directory=str(tmp_path / "cache")), mem_fs, prefix
+        )
+
+    metrics = cs_storage.RecordingSink()
+    try:
+        first = cs_storage.screenshot_many(
+            [output("1"), output("2", "<table/><table/>")],
+            metrics=metrics,
+            cache=cache(),
+        )
+        # Outputs with another ID render to the same page.
+        second = cs_storage.screenshot_many(
+            [output("3"), output("4", "<p/>")], metrics=metrics, cache=cache()
+        )
+        # Pictures are found in the bucket when the local cache is empty.
+        cache().local.clear()
+        local = cs_storage.ReadCache()
+        shared = cs_storage.ScreenshotCache(local, mem_fs, prefix)
+        third = cs_storage.screenshot_many([output("5")], cache=shared)
+        # The ID is in the page of bokeh outputs, but not in their key.
+        bokeh_first = cs_storage.screenshot_many([bokeh("6")], cache=shared)
+        bokeh_second = cs_storage.screenshot_many([bokeh("7")], cache=shared)
+    finally:
+        cs_storage.shutdown_pool()
+        if mem_fs.exists("/cs-storage-test"):
+            mem_fs.rm("/cs-storage-test", recursive=True)
+
+    assert [(r.data, r.cached) for r in first] == [
+        (b"png:1", False),
+        (b"png:2", False),
+    ]
+    assert [(r.data, r.cached) for r in second] == [
+        (b"png:1", True),
+        (b"png:0", False),
+    ]
+    assert [(r.data, r.cached) for r in third] == [(b"png:1", True)]
+    assert [r.cached for r in bokeh_first + bokeh_second] == [False, True]
+    assert bokeh_second[0].data == bokeh_first[0].data
+    assert local.stats()["memory_bytes"] == len(b"png:1") + len(bokeh_first[0].data)
+    # The cached flags of one batch may be emitted in any order.
+    assert sorted(timing.tags["cached"] for timing in metrics.timings) == [
+        False,
+        False,
+        False,
+        True,
+    ]
+    html = screenshot_module.write_template(output("1"))
+    assert cs_storage.screenshot_key(html) != cs_storage.screenshot_key(
+        html, dict(width=800, height=600)
+    )
+
+
+def test_screenshot_cache_errors(fake_launch, monkeypatch):
+    jinja2 = pytest.importorskip("jinja2")
+    with open(f"{screenshot_module.CURRENT_DIR}/templates/index.html") as f:
+        template = jinja2.Template(f.read())
+    monkeypatch.setattr(screenshot_module, "SCREENSHOT_ENABLED", True)
+    monkeypatch.setattr(screenshot_module, "TEMPLATE", template)
+    monkeypatch.setattr(screenshot_module, "_POOL", None)
+
+    class BrokenCache:
+        def get(self, key):
+            raise OSError("bucket unreachable")
+
+        def put(self, key, data):
+            raise PermissionError("read-only cache")
+
+    output = {"id": "1", "title": "table", "media_type": "table", "data": "<table/>"}
+    try:
+        # A failing cache is skipped and the picture is still rendered.
+        with pytest.warns(UserWarning) as record:
+            (result,) = cs_storage.screenshot_many([output], cache=BrokenCache())
+    finally:
+        cs_storage.shutdown_pool()
+    assert result.error is None
+    assert result.data is not None
+    assert not result.cached
+    messages = [str(warning.message) for warning in record]
+    assert any("get failed" in message for message in messages)
+    assert any("put failed" in message for message in messages)
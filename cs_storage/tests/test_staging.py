@@ -0,0 +1,137 @@
+import os
+import threading
+
+import pytest
+
+import cs_storage
+
+
+class Uploads:
+    def __init__(self, failures=0):
+        self.uploaded = {}
+        self.paths = []
+        self.failures = failures
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, path, data, task_id=None, **meta):
+        self.release.wait(5)
+        if self.failures:
+            self.failures -= 1
+            raise OSError("upload failed")
+        self.uploaded[path] = (data, task_id)
+        self.paths.append(path)
+
+
+def staged_files(directory):
+    return sorted(
+        name for _, _, names in os.walk(directory) for name in names if name != "lock"
+    )
+
+
+def test_upload_and_flush(tmp_path):
+    uploads = Uploads(failures=2)
+    queue = cs_storage.UploadQueue(str(tmp_path), uploads, retries=2, retry_delay=0)
+    try:
+        queue.put("memory://bucket/a", b"aaa", task_id="1")
+        with queue.open("memory://bucket/b", task_id="2") as f:
+            f.write(b"bb")
+        queue.flush("1")
+        queue.flush()
+    finally:
+        queue.close()
+    assert uploads.uploaded == {
+        "memory://bucket/a": (b"aaa", "1"),
+        "memory://bucket/b": (b"bb", "2"),
+    }
+    assert queue.staged_bytes == 0
+    assert staged_files(tmp_path) == []
+
+
+def test_failed_uploads_stay_staged(tmp_path):
+    uploads = Uploads(failures=2)
+    queue = cs_storage.UploadQueue(str(tmp_path), uploads, retries=1, retry_delay=0)
+    try:
+        queue.put("memory://bucket/a", b"aaa", task_id="1")
+        with pytest.raises(OSError, match="upload failed"):
+            queue.flush("1")
+        # Errors are only raised once.
+        queue.flush()
+    finally:
+        queue.close()
+    assert len(staged_files(tmp_path)) == 2
+
+    # A new queue on the same directory uploads the staged object.
+    queue = cs_storage.UploadQueue(str(tmp_path), uploads)
+    try:
+        queue.flush()
+    finally:
+        queue.close()
+    assert uploads.uploaded == {"memory://bucket/a": (b"aaa", "1")}
+    assert staged_files(tmp_path) == []
+
+
+def test_recovery_discards_incomplete_objects(tmp_path):
+    (tmp_path / "queue-old").mkdir()
+    (tmp_path / "queue-old" / "tmpabc").write_bytes(b"partial")
+    (tmp_path / "queue-old" / "123.data").write_bytes(b"no metadata")
+    uploads = Uploads()
+    queue = cs_storage.UploadQueue(str(tmp_path), uploads)
+    queue.close()
+    assert uploads.uploaded == {}
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.skipif(os.name == "nt", reason="Queues are not locked on Windows.")
+def test_shared_directory(tmp_path):
+    uploads = Uploads()
+    uploads.release.clear()
+    first = cs_storage.UploadQueue(str(tmp_path), uploads)
+    second = None
+    try:
+        first.put("memory://bucket/a", b"aaa")
+        with first.open("memory://bucket/b") as f:
+            f.write(b"b")
+            # A queue that is created on the directory of a live queue
+            # does not touch its objects.
+            second = cs_storage.UploadQueue(str(tmp_path), uploads)
+            f.write(b"bb")
+        second.put("memory://bucket/c", b"c")
+        uploads.release.set()
+        first.flush()
+        second.flush()
+    finally:
+        uploads.release.set()
+        first.close()
+        if second is not None:
+            second.close()
+    assert uploads.uploaded == {
+        "memory://bucket/a": (b"aaa", None),
+        "memory://bucket/b": (b"bbb", None),
+        "memory://bucket/c": (b"c", None),
+    }
+    # Every object is uploaded once.
+    assert len(uploads.paths) == 3
+    assert os.listdir(tmp_path) == []
+
+
+def test_backpressure(tmp_path):
+    uploads = Uploads()
+    uploads.release.clear()
+    queue = cs_storage.UploadQueue(str(tmp_path), uploads, max_bytes=4, max_workers=1)
+    try:
+        queue.put("memory://bucket/a", b"aaaa")
+        assert queue.staged_bytes == 4
+        put = threading.Thread(target=queue.put, args=("memory://bucket/b", b"b"))
+        put.start()
+        put.join(0.2)
+        # The second put waits until the first object is uploaded.
+        assert put.is_alive()
+        uploads.release.set()
+        put.join(5)
+        assert not put.is_alive()
+        queue.flush()
+    finally:
+        uploads.release.set()
+        queue.close()
+    assert sorted(uploads.uploaded) == ["memory://bucket/a", "memory://bucket/b"]
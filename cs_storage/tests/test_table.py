@@ -0,0 +1,72 @@
+import csv
+import importlib
+import io
+
+import fsspec
+import pytest
+
+import cs_storage
+
+table_module = importlib.import_module("cs_storage.table")
+
+
+def make_csv(num_rows):
+    f = io.StringIO()
+    writer = csv.writer(f)
+    writer.writerow(["a", "b", "c"])
+    for i in range(num_rows):
+        writer.writerow([i, f"row {i}", f'quoted, "{i}"\nline'])
+    return f.getvalue()
+
+
+@pytest.fixture
+def mem_fs():
+    mem_fs = fsspec.filesystem("memory")
+    yield mem_fs
+    if mem_fs.exists("/cs-storage-test"):
+        mem_fs.rm("/cs-storage-test", recursive=True)
+
+
+def test_read_pages(mem_fs, monkeypatch):
+    text = make_csv(25)
+    path = "memory://cs-storage-test/table"
+    mem_fs.pipe_file(path, cs_storage.encode_table(text, row_group_size=10))
+    requested = []
+    cat_ranges = mem_fs.cat_ranges
+
+    def record(paths, starts, ends, **kwargs):
+        requested.extend(zip(starts, ends))
+        return cat_ranges(paths, starts, ends, **kwargs)
+
+    monkeypatch.setattr(mem_fs, "cat_ranges", record)
+
+    full = cs_storage.table_from_csv(text)
+    assert table_module.read_table(mem_fs, path) == full
+    assert full.num_rows == 25
+    assert full.rows[3] == ["3", "row 3", 'quoted, "3"\nline']
+
+    # Rows 8 to 12 span the first two row groups.
+    del requested[:]
+    page = table_module.read_table(mem_fs, path, offset=8, limit=5, columns=["c", "a"])
+    assert page == cs_storage.table_from_csv(text, 8, 5, ["c", "a"])
+    assert page.columns == ["c", "a"]
+    assert [row[1] for row in page.rows] == ["8", "9", "10", "11", "12"]
+    assert len(requested) == 4
+
+    assert table_module.read_table(mem_fs, path, offset=30).rows == []
+    with pytest.raises(KeyError):
+        table_module.read_table(mem_fs, path, columns=["d"])
+
+
+def test_large_footer(mem_fs, monkeypatch):
+    monkeypatch.setattr(table_module, "FOOTER_READ_SIZE", 16)
+    text = make_csv(5)
+    path = "memory://cs-storage-test/table"
+    mem_fs.pipe_file(path, cs_storage.encode_table(text, row_group_size=2))
+    assert table_module.read_table(mem_fs, path) == cs_storage.table_from_csv(text)
+
+
+def test_ragged_csv():
+    assert cs_storage.encode_table("a,b\n1,2\n3\n") is None
+    assert cs_storage.encode_table("") is None
+    assert cs_storage.table_from_csv("a,b\n1,2\n3\n").rows == [["1", "2"], ["3", ""]]